@@ -15,7 +15,7 @@ import logging
 
 from collections import defaultdict
 
-from src.search       import run_search
+from src.search       import run_search, resume_search
 from src.loggingutils import setup_logging, log_appstats
 from src.unit_testing import run_tests
 from src.utils        import ENCODING
@@ -73,6 +73,15 @@ def search_command(search_parameters_filename):
     return
 
 
+def resume_command(checkpoint_filename):
+    assert isinstance(checkpoint_filename, str)
+
+    logger.info("Resuming a search from a checkpoint.")
+
+    resume_search(checkpoint_filename)
+    return
+
+
 def lookup_command(weapon_name):
 
     armour_dict = {
@@ -226,6 +235,9 @@ def run():
         if sys.argv[1].lower() == "search":
             search_parameters_filename = sys.argv[2]
             search_command(search_parameters_filename)
+        elif sys.argv[1].lower() == "resume":
+            checkpoint_filename = sys.argv[2]
+            resume_command(checkpoint_filename)
         elif sys.argv[1].lower() == "legacy":
             search_parameters_filename = sys.argv[2]
             legacy_command(search_parameters_filename)
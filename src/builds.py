@@ -9,10 +9,16 @@ a build to file (and serialize/deserialize to text).
 """
 
 import json
+import importlib.util
 from copy import copy
+from array import array
+from itertools import product
 
 from collections import namedtuple, Counter
 
+# NumPy is only needed for BatchedLookupFromSkills, so it only gets imported once one is used (see _import_numpy()).
+np = None
+
 from .database_armour      import (ArmourDiscriminator,
                                   ArmourVariant,
                                   ArmourSlot,
@@ -22,6 +28,7 @@ from .database_charms      import (CharmInfo,
 from .database_decorations import Decoration
 from .database_misc        import (POWERCHARM_ATTACK_POWER,
                                   POWERTALON_ATTACK_POWER)
+from .database_skills      import Skill
 from .database_weapons     import (RAW_SHARPNESS_MODIFIERS,
                                   weapon_db)
 
@@ -30,10 +37,12 @@ from .query_charms      import calculate_skills_dict_from_charm
 from .query_decorations import calculate_decorations_skills_contribution
 from .query_skills      import (HANDICRAFT_MAX_LEVEL,
                                RAW_BLUNDER_MULTIPLIER,
+                               skills_affecting_efr,
                                clipped_skills_defaultdict,
                                calculate_set_bonus_skills,
                                calculate_skills_contribution)
 from .query_weapons     import (WeaponAugmentTracker,
+                               IBWeaponAugmentType,
                                WeaponUpgradeTracker,
                                calculate_final_weapon_values,
                                get_weapon_config_humanreadable)
@@ -194,6 +203,342 @@ def lookup_from_skills(weapon, skills_dict, skill_states_dict, weapon_augments_t
     return ret
 
 
+# Returns a list of the raw sharpness modifier lookup_from_skills() would use at each Handicraft level.
+def _raw_sharpness_modifiers_by_handicraft_level(weapon_final_values):
+    ret = []
+    for handicraft_level in range(HANDICRAFT_MAX_LEVEL + 1):
+        if weapon_final_values.constant_sharpness:
+            handicraft_level = HANDICRAFT_MAX_LEVEL
+        _, highest_sharpness_level = _actual_sharpness_level_values(weapon_final_values.maximum_sharpness, handicraft_level)
+        ret.append(RAW_SHARPNESS_MODIFIERS[highest_sharpness_level])
+    return ret
+
+
+# A batched version of lookup_from_skills() that calculates the EFR of every weapon combination in a list at once,
+# for the same skills. This needs NumPy (see NUMPY_AVAILABLE).
+#
+# Other than the weapon, EFR only depends on the skills, which (for a fixed list of weapon combinations) only differ
+# by the weapon's own skill, and by whether the weapon is raw. So we only have to work out the skills' contribution
+# once for each of these, and the rest is simple arithmetic that we do over arrays of precomputed weapon values.
+# This gives us exactly the same EFR values as lookup_from_skills().
+#
+# weapon_combos is a list of tuples that start with (weapon, weapon_augments_tracker, weapon_upgrades_tracker).
+# The rest of each tuple is ignored, but gets returned as-is by above().
+#
+# ceiling_efrs is an optional list of the highest EFR each weapon combination could possibly reach. If provided,
+# above() can also skip weapon combinations by their ceiling EFRs.
+class BatchedLookupFromSkills:
+
+    __slots__ = [
+            "_weapon_combos",
+            "_subgroups",
+            "_true_raw",
+            "_affinity",
+            "_sharpness_modifiers",
+            "_ceiling_efrs",
+        ]
+
+    def __init__(self, weapon_combos, ceiling_efrs=None):
+        _import_numpy()
+        assert isinstance(weapon_combos, list)
+        assert (ceiling_efrs is None) or (len(ceiling_efrs) == len(weapon_combos))
+
+        self._weapon_combos = weapon_combos
+
+        true_raw = []
+        affinity = []
+        sharpness_modifiers = [] # [[modifier for each handicraft level]]
+        subgroups = {} # {(weapon_skill, is_raw): [index]}
+
+        for (i, combo) in enumerate(weapon_combos):
+            (weapon, weapon_augments_tracker, weapon_upgrades_tracker) = combo[:3]
+            weapon_final_values = calculate_final_weapon_values(weapon, weapon_augments_tracker, weapon_upgrades_tracker)
+
+            true_raw.append(weapon_final_values.true_raw)
+            affinity.append(weapon_final_values.affinity)
+
+            sharpness_modifiers.append(_raw_sharpness_modifiers_by_handicraft_level(weapon_final_values))
+
+            h = (weapon_final_values.skill, weapon.is_raw) # lookup_from_skills() uses the weapon's is_raw.
+            if h not in subgroups:
+                subgroups[h] = []
+            subgroups[h].append(i)
+
+        self._true_raw = np.array(true_raw, dtype=np.float64)
+        self._affinity = np.array(affinity, dtype=np.float64)
+        self._sharpness_modifiers = np.array(sharpness_modifiers, dtype=np.float64).reshape(-1, HANDICRAFT_MAX_LEVEL + 1)
+        self._subgroups = [(k[0], k[1], np.array(v, dtype=np.intp)) for (k, v) in subgroups.items()]
+        self._ceiling_efrs = None if (ceiling_efrs is None) else np.array(ceiling_efrs, dtype=np.float64)
+        return
+
+    # Returns a NumPy array of the EFR of every weapon combination, in the same order as weapon_combos.
+    def efrs(self, skills_dict, skill_states_dict):
+        assert isinstance(skills_dict, dict)
+        assert isinstance(skill_states_dict, dict)
+        _import_numpy() # We might have been sent to a worker process that hasn't imported NumPy yet.
+
+        ret = np.empty(len(self._weapon_combos), dtype=np.float64)
+
+        for (weapon_skill, weapon_is_raw, indices) in self._subgroups:
+            if weapon_skill is None:
+                w_skills_dict = clipped_skills_defaultdict(skills_dict)
+            else:
+                w_skills_dict = copy(skills_dict)
+                w_skills_dict[weapon_skill] = w_skills_dict.get(weapon_skill, 0) + 1
+                w_skills_dict = clipped_skills_defaultdict(w_skills_dict)
+            assert skill_states_are_fully_defined(w_skills_dict, skill_states_dict)
+
+            # The maximum sharpness argument isn't actually used, so we don't have to worry about it differing.
+            from_skills = calculate_skills_contribution(w_skills_dict, skill_states_dict, None, weapon_is_raw)
+
+            # The same calculations as _calculate_efr(), in the same order so we get exactly the same values.
+            added_raw = from_skills.added_attack_power + POWERCHARM_ATTACK_POWER + POWERTALON_ATTACK_POWER
+            raw_crit_chance = np.minimum(self._affinity[indices] + from_skills.added_raw_affinity, 100) / 100
+            raw_blunder_chance = -raw_crit_chance
+            raw_crit_modifier = np.where(
+                    raw_crit_chance < 0,
+                    (RAW_BLUNDER_MULTIPLIER * raw_blunder_chance) + (1 - raw_blunder_chance),
+                    (from_skills.raw_critical_multiplier * raw_crit_chance) + (1 - raw_crit_chance),
+                )
+            true_raw = np.round(self._true_raw[indices] * from_skills.weapon_base_attack_power_multiplier, 0) + added_raw
+            raw_sharpness_modifier = self._sharpness_modifiers[indices, from_skills.handicraft_level]
+
+            ret[indices] = true_raw * raw_sharpness_modifier * raw_crit_modifier
+        return ret
+
+    # Returns a list of (weapon_combo, efr) for every weapon combination with an EFR above minimum_efr, in the same
+    # order as weapon_combos.
+    #
+    # If minimum_ceiling_efr is provided, we also skip every weapon combination with a ceiling EFR below it.
+    def above(self, skills_dict, skill_states_dict, minimum_efr, minimum_ceiling_efr=None):
+        efrs = self.efrs(skills_dict, skill_states_dict)
+        mask = efrs > minimum_efr
+        if minimum_ceiling_efr is not None:
+            assert self._ceiling_efrs is not None
+            mask &= (self._ceiling_efrs >= minimum_ceiling_efr)
+        return [(self._weapon_combos[i], efrs[i].item()) for i in np.flatnonzero(mask)]
+
+
+# This only checks that NumPy can be imported, without actually importing it.
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return
+
+
+# Skills that only go past their limit (up to their extended limit) with another skill. Anything past the limit
+# doesn't change EFR without it (see calculate_skills_contribution()).
+_SECRET_SKILLS = {
+    Skill.AGITATOR: Skill.AGITATOR_SECRET,
+}
+
+
+# The grid of skill levels that EFRLookupTable is indexed by, for fixed skills and skill states.
+#
+# Only the skills in skills_affecting_efr matter, so the grid has one axis per skill in skills that also affects EFR.
+# Each axis only covers the levels that can actually be looked up. We know skills_dict arguments meet minimum_levels,
+# so lower levels are never looked up. Past a skill's limit, levels only make a difference if the skill's secret skill
+# could be there too, either from skills or from one of the weapons in weapon_combos. (Looking up higher levels just
+# gives the EFR at the maximum level.)
+#
+# Plenty of grid points still give exactly the same skill contributions (e.g. Non-elemental Boost does nothing for
+# elemental weapons, and different skills can add up to the same affinity), so tables only store one row of EFRs for
+# each distinct set of skill contributions. The same grid should be shared between all tables for the same skills so
+# we only have to work out each grid point's skill contributions once.
+#
+# weapon_combos must include every weapon combination that a table will be built for. skills_dict arguments must not
+# have any skill that affects EFR that isn't in skills. (Other skills are ignored.)
+class EFRLookupGrid:
+
+    __slots__ = [
+            "skill_states_dict",
+            "_axes",
+            "_num_grid_points",
+            "_contributions",
+            "_rows",
+        ]
+
+    def __init__(self, weapon_combos, skills, skill_states_dict, minimum_levels={}):
+        assert isinstance(weapon_combos, list)
+        assert isinstance(skill_states_dict, dict)
+        assert isinstance(minimum_levels, dict)
+
+        self.skill_states_dict = skill_states_dict
+
+        weapon_skills = set(calculate_final_weapon_values(*combo[:3]).skill for combo in weapon_combos)
+
+        # Axes are ordered by skill name, with the last axis changing the fastest.
+        self._axes = [] # [(skill, minimum_level, maximum_level, stride)]
+        stride = 1
+        for skill in sorted((x for x in skills if (x in skills_affecting_efr)), key=lambda x : x.name, reverse=True):
+            maximum_level = skill.value.extended_limit
+            secret_skill = _SECRET_SKILLS.get(skill, None)
+            if (secret_skill is not None) and (secret_skill not in skills) and (secret_skill not in weapon_skills):
+                maximum_level = skill.value.limit
+            minimum_level = min(minimum_levels.get(skill, 0), maximum_level)
+            self._axes.insert(0, (skill, minimum_level, maximum_level, stride))
+            stride *= maximum_level - minimum_level + 1
+        self._num_grid_points = stride
+
+        self._contributions = {} # {(weapon_skill, weapon_is_raw): [SkillsContribution for each grid point]}
+        self._rows = {} # {frozenset of (weapon_skill, weapon_is_raw): (rows, row_grid_points)}
+        return
+
+    # Returns the number of EFR values a table for weapon_combos would hold.
+    def get_table_size(self, weapon_combos):
+        (_, row_grid_points) = self.get_rows(_get_weapon_subgroups(weapon_combos)[1])
+        return len(row_grid_points) * len(weapon_combos)
+
+    # Returns the index of the grid point that skills_dict falls on.
+    def index_of(self, skills_dict):
+        assert all((lvl == 0) or (s not in skills_affecting_efr) or any((s is x[0]) for x in self._axes) \
+                   for (s, lvl) in skills_dict.items())
+        assert all(skills_dict.get(skill, 0) >= minimum_level for (skill, minimum_level, _, _) in self._axes)
+        return sum((min(skills_dict.get(skill, 0), maximum_level) - minimum_level) * stride \
+                   for (skill, minimum_level, maximum_level, stride) in self._axes)
+
+    # Returns the SkillsContribution at a grid point, for weapons with weapon_skill and weapon_is_raw.
+    def get_contribution(self, grid_point, weapon_skill, weapon_is_raw):
+        h = (weapon_skill, weapon_is_raw)
+        contributions = self._contributions.get(h, None)
+        if contributions is None:
+            contributions = []
+            for levels in product(*(range(lo, hi + 1) for (_, lo, hi, _) in self._axes)):
+                skills_dict = {skill: level for ((skill, _, _, _), level) in zip(self._axes, levels)}
+                if weapon_skill is not None:
+                    skills_dict[weapon_skill] = skills_dict.get(weapon_skill, 0) + 1
+                skills_dict = clipped_skills_defaultdict(skills_dict)
+                assert skill_states_are_fully_defined(skills_dict, self.skill_states_dict)
+                # The maximum sharpness argument isn't actually used, so we don't have to worry about it differing.
+                contributions.append(calculate_skills_contribution(skills_dict, self.skill_states_dict, None, \
+                                                                   weapon_is_raw))
+            self._contributions[h] = contributions
+        return contributions[grid_point]
+
+    # Returns a tuple of (rows, row_grid_points) for a table with weapons of these weapon subgroups (an iterable of
+    # (weapon_skill, weapon_is_raw)). rows is an array that gives the row for each grid point, and row_grid_points is a
+    # list of one grid point that gives each row.
+    def get_rows(self, weapon_subgroups):
+        weapon_subgroups = frozenset(weapon_subgroups)
+        ret = self._rows.get(weapon_subgroups, None)
+        if ret is None:
+            rows = array("I", [0]) * self._num_grid_points
+            row_grid_points = []
+            row_indices = {} # {(SkillsContribution for each weapon subgroup): row}
+            for grid_point in range(self._num_grid_points):
+                h = tuple(self.get_contribution(grid_point, *x) for x in weapon_subgroups)
+                row = row_indices.get(h, None)
+                if row is None:
+                    row = len(row_grid_points)
+                    row_grid_points.append(grid_point)
+                    row_indices[h] = row
+                rows[grid_point] = row
+            ret = (rows, row_grid_points)
+            self._rows[weapon_subgroups] = ret
+        return ret
+
+
+# A dense table of the EFR of every weapon combination in a list, at every point of an EFRLookupGrid. Looking up an
+# EFR is then just an index calculation and a couple of array reads.
+#
+# We store the table as a flat array of doubles, with one row of all weapon combinations' EFRs for each distinct set of
+# skill contributions (see EFRLookupGrid). The values are exactly what lookup_from_skills() gives.
+#
+# Use EFRLookupGrid.get_table_size() to check how big a table would be before building it, since the grid grows
+# exponentially with the number of skills.
+#
+# weapon_combos and ceiling_efrs are the same as for BatchedLookupFromSkills.
+class EFRLookupTable:
+
+    __slots__ = [
+            "_weapon_combos",
+            "_grid",
+            "_rows",
+            "_table",
+            "_ceiling_efrs",
+        ]
+
+    def __init__(self, weapon_combos, grid, ceiling_efrs=None):
+        assert isinstance(weapon_combos, list)
+        assert isinstance(grid, EFRLookupGrid)
+        assert (ceiling_efrs is None) or (len(ceiling_efrs) == len(weapon_combos))
+
+        self._weapon_combos = weapon_combos
+        self._grid = grid
+        self._ceiling_efrs = ceiling_efrs
+
+        (weapon_values, subgroups) = _get_weapon_subgroups(weapon_combos)
+        (self._rows, row_grid_points) = grid.get_rows(subgroups)
+
+        self._table = array("d", [0.0]) * (len(row_grid_points) * len(weapon_combos))
+        item_attack_power = POWERCHARM_ATTACK_POWER + POWERTALON_ATTACK_POWER
+
+        table = self._table
+        for (row, grid_point) in enumerate(row_grid_points):
+            base = row * len(weapon_combos)
+            for ((weapon_skill, weapon_is_raw), indices) in subgroups.items():
+                from_skills = grid.get_contribution(grid_point, weapon_skill, weapon_is_raw)
+                added_raw = from_skills.added_attack_power + item_attack_power
+                added_affinity = from_skills.added_raw_affinity
+                weapon_raw_multiplier = from_skills.weapon_base_attack_power_multiplier
+                raw_crit_multiplier = from_skills.raw_critical_multiplier
+                handicraft_level = from_skills.handicraft_level
+
+                # The same calculations as _calculate_efr(), in the same order so we get exactly the same values.
+                # (Calling it for every table entry would take much longer.)
+                for i in indices:
+                    (weapon_final_values, raw_sharpness_modifiers) = weapon_values[i]
+                    raw_crit_chance = min(weapon_final_values.affinity + added_affinity, 100) / 100
+                    if raw_crit_chance < 0:
+                        raw_blunder_chance = -raw_crit_chance
+                        raw_crit_modifier = (RAW_BLUNDER_MULTIPLIER * raw_blunder_chance) + (1 - raw_blunder_chance)
+                    else:
+                        raw_crit_modifier = (raw_crit_multiplier * raw_crit_chance) + (1 - raw_crit_chance)
+                    true_raw = round(weapon_final_values.true_raw * weapon_raw_multiplier, 0) + added_raw
+                    table[base + i] = true_raw * raw_sharpness_modifiers[handicraft_level] * raw_crit_modifier
+        return
+
+    def _index_of(self, skills_dict):
+        return self._rows[self._grid.index_of(skills_dict)] * len(self._weapon_combos)
+
+    # Returns the EFR of the weapon combination at weapon_combo_index.
+    def efr(self, skills_dict, weapon_combo_index):
+        return self._table[self._index_of(skills_dict) + weapon_combo_index]
+
+    # The same as BatchedLookupFromSkills.above(). skill_states_dict must be the same as the one the grid was
+    # built with.
+    def above(self, skills_dict, skill_states_dict, minimum_efr, minimum_ceiling_efr=None):
+        assert skill_states_dict == self._grid.skill_states_dict
+        base = self._index_of(skills_dict)
+        efrs = self._table[base:(base + len(self._weapon_combos))]
+        if minimum_ceiling_efr is None:
+            return [(x, efr) for (x, efr) in zip(self._weapon_combos, efrs) if (efr > minimum_efr)]
+        assert self._ceiling_efrs is not None
+        return [(x, efr) for (x, efr, ceiling_efr) in zip(self._weapon_combos, efrs, self._ceiling_efrs) \
+                if (efr > minimum_efr) and (ceiling_efr >= minimum_ceiling_efr)]
+
+
+# Returns a tuple of (weapon_values, subgroups). weapon_values is a list of (weapon_final_values, raw sharpness
+# modifiers by handicraft level) for each weapon combination, and subgroups is {(weapon_skill, is_raw): [index]}.
+def _get_weapon_subgroups(weapon_combos):
+    weapon_values = []
+    subgroups = {}
+    for (i, combo) in enumerate(weapon_combos):
+        (weapon, weapon_augments_tracker, weapon_upgrades_tracker) = combo[:3]
+        weapon_final_values = calculate_final_weapon_values(weapon, weapon_augments_tracker, weapon_upgrades_tracker)
+        weapon_values.append((weapon_final_values, _raw_sharpness_modifiers_by_handicraft_level(weapon_final_values)))
+
+        h = (weapon_final_values.skill, weapon.is_raw) # lookup_from_skills() uses the weapon's is_raw.
+        if h not in subgroups:
+            subgroups[h] = []
+        subgroups[h].append(i)
+    return (weapon_values, subgroups)
+
+
 # Alternative version that produces a tree of missing states.
 # TODO: Make this just produce a simple list. It's so unnecessarily complicated.
 def lookup_from_skills_multiple_states(weapon, skills_dict, skill_states_dict, weapon_augments_tracker, weapon_upgrades_tracker):
@@ -297,7 +642,8 @@ class Build:
 
         return
 
-    def calculate_performance(self, skill_states_dict):
+    # If skill_subset is provided, we ignore all skills outside of it. (This is how a search scores builds.)
+    def calculate_performance(self, skill_states_dict, skill_subset=None):
         armour_contribution = calculate_armour_contribution(self._get_armour_dict())
         weapon_augment_contribution = self._weapon_augments_tracker.calculate_contribution()
         weapon_upgrades_contribution = self._weapon_upgrades_tracker.calculate_contribution()
@@ -358,6 +704,9 @@ class Build:
 
         skills_dict.update(skills_from_set_bonuses)
 
+        if skill_subset is not None:
+            skills_dict = {k: v for (k, v) in skills_dict.items() if (k in skill_subset)}
+
         # TODO: I want to refactor out this monstrosity.
         if skill_states_are_fully_defined(skills_dict, skill_states_dict):
             result = lookup_from_skills(self._weapon, skills_dict, skill_states_dict, \
@@ -433,6 +782,17 @@ class Build:
 
         return "\n".join(buf)
 
+    def get_weapon_class(self):
+        return self._weapon.type
+
+    def get_health_regen_augment_level(self):
+        return dict(self._weapon_augments_tracker.get_config()).get(IBWeaponAugmentType.HEALTH_REGEN, 0)
+
+    # Returns {ArmourSlot: Tier} for every armour piece in the build.
+    def get_armour_tiers(self):
+        return {slot: piece.armour_set.discriminator.value.tier for (slot, piece) in self._get_armour_dict().items()
+                if (piece is not None)}
+
     def _get_armour_dict(self):
         return {
                 ArmourSlot.HEAD:  self._head,
@@ -449,7 +809,8 @@ class Build:
         weapon_id = self._weapon.id
         weapon_augments_serialized = self._weapon_augments_tracker.get_serialized_config()
         weapon_upgrades_serialized = self._weapon_upgrades_tracker.get_serialized_config()
-        decos = {k.name: v for (k, v) in Counter(self._decos).items()}
+        # Decorations are sorted by name, so the same build always serializes to the same string.
+        decos = {k.name: v for (k, v) in sorted(Counter(self._decos).items(), key=lambda x : x[0].name)}
 
         data = {
                 "armour": armour_keys,
@@ -7,7 +7,7 @@ Author:   contact@simshadows.com
 This file provides the MHWI build optimizer script's armour database data.
 """
 
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from enum import Enum, auto
 from itertools import product
 
@@ -211,6 +211,41 @@ armour_db = _obtain_armour_db()
 ArmourEasyIterateInfo = namedtuple("ArmourEasyIterateInfo", ["set_name", "discrim", "variant"])
 easyiterate_armour = _obtain_easyiterate_armour_db(armour_db)
 
+# Secondary indexes on an easyiterate_armour-style database, so queries can find pieces without scanning every one.
+#
+# Each index is {ArmourSlot: {key: [position]}}, where positions index into that slot's list of pieces, and are in
+# increasing order. Keys are:
+#   - by_tier:           Tier
+#   - by_skill:          Skill (for every skill the piece has)
+#   - by_set_bonus:      SetBonus (pieces without a set bonus are left out)
+#   - by_slot_signature: the piece's decoration slots, sorted from biggest to smallest (see get_slot_signature())
+ArmourIndexes = namedtuple("ArmourIndexes", ["by_tier", "by_skill", "by_set_bonus", "by_slot_signature"])
+
+def get_slot_signature(decoration_slots):
+    return tuple(sorted(decoration_slots, reverse=True))
+
+def build_armour_indexes(original_easyiterate_armour_db):
+    indexes = ArmourIndexes(by_tier={}, by_skill={}, by_set_bonus={}, by_slot_signature={})
+    for (gear_slot, piece_list) in original_easyiterate_armour_db.items():
+        by_tier = defaultdict(list)
+        by_skill = defaultdict(list)
+        by_set_bonus = defaultdict(list)
+        by_slot_signature = defaultdict(list)
+        for (i, piece) in enumerate(piece_list):
+            by_tier[piece.armour_set.discriminator.value.tier].append(i)
+            for skill in piece.skills:
+                by_skill[skill].append(i)
+            if piece.armour_set.set_bonus is not None:
+                by_set_bonus[piece.armour_set.set_bonus].append(i)
+            by_slot_signature[get_slot_signature(piece.decoration_slots)].append(i)
+        indexes.by_tier[gear_slot] = dict(by_tier)
+        indexes.by_skill[gear_slot] = dict(by_skill)
+        indexes.by_set_bonus[gear_slot] = dict(by_set_bonus)
+        indexes.by_slot_signature[gear_slot] = dict(by_slot_signature)
+    return indexes
+
+easyiterate_armour_indexes = build_armour_indexes(easyiterate_armour)
+
 # This will prune out pieces that can be recreated better or more flexibly by another piece.
 # Importantly, the data structure is the same as easyiterate_armour.
 # This will make this practically interchangable with easyiterate_armour if all you care about are skills.
@@ -7,13 +7,14 @@ Author:   contact@simshadows.com
 This file provides the MHWI build optimizer script's decorations database data.
 """
 
+from array import array
 from collections import namedtuple
 from enum import Enum
 from itertools import product
 
 from .utils import json_read
 
-from .database_skills import Skill
+from .database_skills import Skill, intern_enum_ids
 
 
 DECORATIONS_DATA_FILENAME = "data/database_decorations.json"
@@ -176,5 +177,11 @@ def _get_index_for_skill_to_size():
 # This provides all decorations
 Decoration = _obtain_decorations_enum()
 
+intern_enum_ids(Decoration)
+
+# These are indexed by Decoration ID. Skill contributions are tuples of (Skill, level).
+decoration_slot_sizes = array("B", (x.value.slot_size for x in Decoration))
+decoration_skills     = [tuple(x.value.skills_dict.items()) for x in Decoration]
+
 # This provides a useful index for finding a skill's associated single-skill decoration's size.
 skill_to_simple_deco_size = _get_index_for_skill_to_size()
@@ -7,6 +7,7 @@ Author:   contact@simshadows.com
 This file provides the MHWI build optimizer script's skills database data.
 """
 
+from array import array
 from collections import namedtuple
 from enum import Enum
 
@@ -188,4 +189,23 @@ def _obtain_skills_enum():
     return (skills_intermediate_enum, set_bonuses_intermediate_enum)
 
 
+# Gives every member of enum_class a dense integer ID (its position in the enum) as its id attribute.
+#
+# Hot code can use these IDs to index into attribute tables like skill_extended_limits, which is much cheaper than
+# reading attributes through the member's value. (Enum's value attribute goes through a Python-level descriptor.)
+def intern_enum_ids(enum_class):
+    for (i, member) in enumerate(enum_class):
+        member.id = i
+    return
+
+
 Skill, SetBonus = _obtain_skills_enum()
+
+intern_enum_ids(Skill)
+intern_enum_ids(SetBonus)
+
+# This is indexed by Skill ID.
+skill_extended_limits = array("B", (x.value.extended_limit for x in Skill))
+
+# This is indexed by SetBonus ID, and contains tuples of (number_of_pieces, Skill), in increasing number of pieces.
+set_bonus_stages = [tuple(sorted(x.value.stages.items(), key=lambda y : y[0])) for x in SetBonus]
@@ -8,6 +8,7 @@ This file provides the MHWI build optimizer script's weapon database data.
 """
 
 from collections import namedtuple
+from collections.abc import Mapping
 from enum import Enum, auto
 
 from .utils import json_read
@@ -108,17 +109,72 @@ BowInfo            = namedtuple("BowInfo",            _g_fields )
 HeavyBowgunInfo    = namedtuple("HeavyBowgunInfo",    _g_fields )  
 LightBowgunInfo    = namedtuple("LightBowgunInfo",    _g_fields )  
 
-
-def _obtain_weapon_db():
-    json_data = json_read(WEAPONS_DATA_FILENAME)
-
+_WEAPON_INFO_TYPES = {
+    WeaponClass.GREATSWORD      : GreatswordInfo,
+    WeaponClass.LONGSWORD       : LongswordInfo,
+    WeaponClass.SWORD_AND_SHIELD: SwordAndShieldInfo,
+    WeaponClass.DUAL_BLADES     : DualBladesInfo,
+    WeaponClass.HAMMER          : HammerInfo,
+    WeaponClass.HUNTING_HORN    : HuntingHornInfo,
+    WeaponClass.LANCE           : LanceInfo,
+    WeaponClass.GUNLANCE        : GunlanceInfo,
+    WeaponClass.SWITCHAXE       : SwitchaxeInfo,
+    WeaponClass.CHARGE_BLADE    : ChargeBladeInfo,
+    WeaponClass.INSECT_GLAIVE   : InsectGlaiveInfo,
+    WeaponClass.BOW             : BowInfo,
+    WeaponClass.HEAVY_BOWGUN    : HeavyBowgunInfo,
+    WeaponClass.LIGHT_BOWGUN    : LightBowgunInfo,
+}
+
+
+# The weapon database file is read once, but weapons are only parsed and validated one weapon class at a time, when
+# something first asks for that weapon class. (A search only ever needs one weapon class.)
+#
+# This otherwise works like a regular {weapon_id: weapon_info} dict. Looking up a weapon by its ID only loads that
+# weapon's class, and iterating over the whole database loads all of them.
+class WeaponDatabase(Mapping):
+
+    __slots__ = [
+            "_weapon_classes", # {weapon_id: WeaponClass}
+            "_weapons_data",   # {WeaponClass: {weapon_id: json_data}} (Only for weapon classes not loaded yet.)
+            "_weapons",        # {WeaponClass: {weapon_id: weapon_info}}
+        ]
+
+    def __init__(self):
+        self._weapon_classes, self._weapons_data = _obtain_weapon_class_index(json_read(WEAPONS_DATA_FILENAME))
+        self._weapons = {}
+        return
+
+    # Returns {weapon_id: weapon_info} for all weapons of weapon_class.
+    def get_weapons_of_class(self, weapon_class):
+        assert isinstance(weapon_class, WeaponClass)
+        weapons = self._weapons.get(weapon_class, None)
+        if weapons is None:
+            weapons = _obtain_weapons_of_class(weapon_class, self._weapons_data.pop(weapon_class, {}))
+            self._weapons[weapon_class] = weapons
+        return weapons
+
+    def __getitem__(self, weapon_id):
+        return self.get_weapons_of_class(self._weapon_classes[weapon_id])[weapon_id]
+
+    def __iter__(self):
+        return iter(self._weapon_classes)
+
+    def __len__(self):
+        return len(self._weapon_classes)
+
+
+# Checks everything in the weapon database file's data that has to be checked across all weapon classes (weapon IDs and
+# names must be unique), and splits the data up by weapon class for _obtain_weapons_of_class().
+def _obtain_weapon_class_index(json_data):
     def validation_error(info, weapon=None):
         if weapon is None:
             raise ValueError(f"{WEAPONS_DATA_FILENAME}: {info}")
         else:
             raise ValueError(f"{WEAPONS_DATA_FILENAME} {weapon}: {info}")
 
-    weapons_intermediate = {}
+    weapon_classes_intermediate = {}
+    weapons_data_intermediate = {}
     weapon_names = set()
 
     for (weapon_id, dat) in json_data.items():
@@ -127,10 +183,36 @@ def _obtain_weapon_db():
             validation_error("Weapon IDs must be strings. Instead, we have: " + str(weapon_id))
         elif len(weapon_id) == 0:
             validation_error("Weapon IDs must be strings of non-zero length.")
-        elif weapon_id in weapons_intermediate:
+        elif weapon_id in weapon_classes_intermediate:
             validation_error(f"Weapon IDs must be unique.", weapon=weapon_id)
         # TODO: Also put a condition that weapon IDs must be capitalized with underscores.
 
+        if (not isinstance(dat["name"], str)) or (len(dat["name"]) == 0):
+            validation_error("Weapon names must be non-empty strings.", weapon=weapon_id)
+        elif dat["name"] in weapon_names:
+            validation_error("Weapon names must be unique.", weapon=weapon_id)
+
+        weapon_class = WeaponClass[str(dat["class"])]
+        weapon_classes_intermediate[weapon_id] = weapon_class
+        weapons_data_intermediate.setdefault(weapon_class, {})[weapon_id] = dat
+        weapon_names.add(dat["name"])
+
+    return weapon_classes_intermediate, weapons_data_intermediate
+
+
+# weapons_data is the {weapon_id: json_data} split for weapon_class from _obtain_weapon_class_index().
+def _obtain_weapons_of_class(weapon_class, weapons_data):
+
+    def validation_error(info, weapon=None):
+        if weapon is None:
+            raise ValueError(f"{WEAPONS_DATA_FILENAME}: {info}")
+        else:
+            raise ValueError(f"{WEAPONS_DATA_FILENAME} {weapon}: {info}")
+
+    weapons_intermediate = {}
+
+    for (weapon_id, dat) in weapons_data.items():
+
         blademaster_classes = {
             WeaponClass.GREATSWORD,
             WeaponClass.LONGSWORD,
@@ -164,11 +246,7 @@ def _obtain_weapon_db():
             "upgrade_scheme"     : WeaponUpgradeScheme[str(dat.get("upgrade_scheme", "NONE"))],
         }
 
-        if (not isinstance(kwargs["name"], str)) or (len(kwargs["name"]) == 0):
-            validation_error("Weapon names must be non-empty strings.", weapon=weapon_id)
-        elif kwargs["name"] in weapon_names:
-            validation_error("Weapon names must be unique.", weapon=weapon_id)
-        elif (not isinstance(kwargs["rarity"], int)) or (kwargs["rarity"] <= 0):
+        if (not isinstance(kwargs["rarity"], int)) or (kwargs["rarity"] <= 0):
             validation_error("Weapon rarity levels must be ints above zero.", weapon=weapon_id)
         elif (not isinstance(kwargs["attack"], int)) or (kwargs["attack"] <= 0):
             validation_error("Weapon attack power must be an int above zero.", weapon=weapon_id)
@@ -191,43 +269,14 @@ def _obtain_weapon_db():
             elif not isinstance(kwargs["constant_sharpness"], bool):
                 validation_error("Weapons must have a boolean constant_sharpness field..", weapon=weapon_id)
 
-        tup = None
-        if kwargs["type"] is WeaponClass.GREATSWORD:
-            tup = GreatswordInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.LONGSWORD:
-            tup = LongswordInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.SWORD_AND_SHIELD:
-            tup = SwordAndShieldInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.DUAL_BLADES:
-            tup = DualBladesInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.HAMMER:
-            tup = HammerInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.HUNTING_HORN:
-            tup = HuntingHornInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.LANCE:
-            tup = LanceInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.GUNLANCE:
-            tup = GunlanceInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.SWITCHAXE:
-            tup = SwitchaxeInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.CHARGE_BLADE:
-            tup = ChargeBladeInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.INSECT_GLAIVE:
-            tup = InsectGlaiveInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.BOW:
-            tup = BowInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.HEAVY_BOWGUN:
-            tup = HeavyBowgunInfo(**kwargs)
-        elif kwargs["type"] is WeaponClass.LIGHT_BOWGUN:
-            tup = LightBowgunInfo(**kwargs)
-        else:
+        if kwargs["type"] not in _WEAPON_INFO_TYPES:
             raise RuntimeError("Unexpected weapon type.")
+        tup = _WEAPON_INFO_TYPES[kwargs["type"]](**kwargs)
 
-        weapon_names.add(tup.name)
         #weapons_intermediate[weapon_id] = tup # TODO: Consider using the weapon ID instead.
         weapons_intermediate[weapon_id] = tup
 
     return weapons_intermediate
 
 
-weapon_db = _obtain_weapon_db()
+weapon_db = WeaponDatabase()
@@ -74,10 +74,13 @@ def log_appstats_reduction(name, pre, post, display_again=False):
         _appstats_display_again.append(s)
     return
 
-def log_appstats_generic(msg):
+def log_appstats_generic(msg, display_again=False):
     global _appstats_logger
     assert isinstance(msg, str)
+    assert isinstance(display_again, bool)
     _appstats_logger.info(msg)
+    if display_again:
+        _appstats_display_again.append(msg)
     return
 
 def log_appstats_bufferbreak():
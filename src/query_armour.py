@@ -27,7 +27,9 @@ from .query_skills import calculate_set_bonus_skills
 
 from .database_armour import (ArmourSlot,
                              ArmourPieceInfo,
-                             easyiterate_armour)
+                             easyiterate_armour,
+                             easyiterate_armour_indexes,
+                             build_armour_indexes)
 
 
 logger = logging.getLogger(__name__)
@@ -154,12 +156,16 @@ def prune_easyiterate_armour_db(selected_armour_tier, original_easyiterate_armou
 
     logger.info("Pruning armour pieces.")
 
+    if original_easyiterate_armour_db is easyiterate_armour:
+        indexes = easyiterate_armour_indexes
+    else:
+        indexes = build_armour_indexes(original_easyiterate_armour_db)
+
     intermediate = {}
     for (gear_slot, piece_list) in original_easyiterate_armour_db.items():
 
-        # First, we need to filter by tier.
-        if selected_armour_tier is not None:
-            piece_list = [x for x in piece_list if (x.armour_set.discriminator.value.tier is selected_armour_tier)]
+        candidates = _get_pruning_candidates(gear_slot, piece_list, indexes, selected_armour_tier, skill_subset)
+        piece_list = [piece_list[i] for i in candidates]
 
         def left_supercedes_right(piece1, piece2):
             piece1_set_bonus = piece1.armour_set.set_bonus
@@ -187,6 +193,54 @@ def prune_easyiterate_armour_db(selected_armour_tier, original_easyiterate_armou
     return intermediate
 
 
+# Returns the positions of the pieces in piece_list that prune_easyiterate_armour_db() needs to compare, in increasing
+# order. These are all pieces of the selected tier, except that out of any group of pieces with the same set bonus,
+# the same slot signature, and the same levels of every skill in skill_subset, we only keep the last one.
+#
+# This doesn't change the result. _armour_piece_supercedes() only looks at those three things, so every piece in a group
+# compares exactly the same way against everything else, and pieces within a group are all tied with each other.
+# prune_by_superceding() breaks ties by keeping the later piece, so only the last piece of each group can survive,
+# and it survives if and only if it would have survived against the whole list.
+#
+# The exception is pieces with size-4 slots. _skills_and_slots_supercedes() overestimates the other piece's size-4
+# slots, so two such pieces never tie with each other, and both can survive. We keep all of them.
+def _get_pruning_candidates(gear_slot, piece_list, indexes, selected_armour_tier, skill_subset):
+    if selected_armour_tier is None:
+        positions = range(len(piece_list))
+    else:
+        positions = indexes.by_tier[gear_slot].get(selected_armour_tier, [])
+
+    keys = {i: [None, None, []] for i in positions} # {position: [set_bonus, slot_signature, [(skill, level)]]}
+
+    for (set_bonus, set_bonus_positions) in indexes.by_set_bonus[gear_slot].items():
+        for i in set_bonus_positions:
+            if i in keys:
+                keys[i][0] = set_bonus
+    for (slot_signature, slot_signature_positions) in indexes.by_slot_signature[gear_slot].items():
+        for i in slot_signature_positions:
+            if i in keys:
+                keys[i][1] = slot_signature
+
+    skills_index = indexes.by_skill[gear_slot]
+    if skill_subset is None:
+        relevant_skills = set(skills_index)
+    else:
+        relevant_skills = set(skills_index) & skill_subset
+    for skill in sorted(relevant_skills, key=lambda x : x.name):
+        for i in skills_index[skill]:
+            if i in keys:
+                keys[i][2].append((skill, piece_list[i].skills[skill]))
+
+    last_of_each_group = {}
+    for i in positions:
+        (set_bonus, slot_signature, skill_levels) = keys[i]
+        if 4 in slot_signature:
+            last_of_each_group[i] = i
+        else:
+            last_of_each_group[(set_bonus, slot_signature, tuple(skill_levels))] = i
+    return sorted(last_of_each_group.values())
+
+
 _pruned_armour_combos_cache = [] # [(skill_subset, minimum_set_bonus_combos, pruned_armour_combos)]
 
 
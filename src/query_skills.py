@@ -15,7 +15,9 @@ from enum import Enum, unique
 from .utils import json_read, prune_by_superceding, get_humanreadable_from_enum_counter
 
 from .database_skills import (Skill,
-                             SetBonus)
+                             SetBonus,
+                             skill_extended_limits,
+                             set_bonus_stages)
 
 
 HANDICRAFT_MAX_LEVEL = Skill.HANDICRAFT.value.extended_limit
@@ -49,6 +51,23 @@ DRAGONVEIN_AWAKENING_AFFINITY = 20
 TRUE_DRAGONVEIN_AWAKENING_AFFINITY = 40
 
 
+# Every skill that calculate_skills_contribution() reads, i.e. every skill that can affect EFR.
+skills_affecting_efr = {
+        Skill.AGITATOR,
+        Skill.AGITATOR_SECRET,
+        Skill.ATTACK_BOOST,
+        Skill.CRITICAL_BOOST,
+        Skill.CRITICAL_EYE,
+        Skill.DRAGONVEIN_AWAKENING,
+        Skill.TRUE_DRAGONVEIN_AWAKENING,
+        Skill.HANDICRAFT,
+        Skill.NON_ELEMENTAL_BOOST,
+        Skill.PEAK_PERFORMANCE,
+        Skill.RESENTMENT,
+        Skill.WEAKNESS_EXPLOIT,
+    }
+
+
 skills_with_implemented_features = {
         Skill.AGITATOR,
         Skill.ATTACK_BOOST,
@@ -66,7 +85,7 @@ skills_with_implemented_features = {
 # This will clip everything down to the "extended limit" (i.e. assuming all "skill secret" set bonuses are active).
 def clipped_skills_defaultdict(skills_dict):
     assert all(level >= 0 for (_, level) in skills_dict.items()) # We shouldn't be seeing negative skill levels.
-    return defaultdict(lambda : 0, {skill: min(level, skill.value.extended_limit) for (skill, level) in skills_dict.items()})
+    return defaultdict(lambda : 0, {skill: min(level, skill_extended_limits[skill.id]) for (skill, level) in skills_dict.items()})
 
 
 # From a set of skills attainable from set bonuses, this function calculates all possible
@@ -200,9 +219,10 @@ def calculate_set_bonus_skills(set_bonus_pieces_dict, weapon_set_bonus_contribut
         if set_bonus is weapon_set_bonus_contribution:
             num_pieces += 1
 
-        for (stage, skill) in set_bonus.value.stages.items():
-            if num_pieces >= stage:
-                ret[skill] = 1
+        for (stage, skill) in set_bonus_stages[set_bonus.id]:
+            if num_pieces < stage:
+                break
+            ret[skill] = 1
 
     return ret
 
@@ -318,3 +338,116 @@ def convert_set_bonuses_dict_to_tuple(d):
     assert all(isinstance(k, SetBonus) and isinstance(v, int) and (v > 0) for (k, v) in d.items())
     return tuple(sorted(d.items(), key=lambda e : e[0].name))
 
+
+
+# A compact representation of skill levels for a fixed subset of skills, meant for the search's hot loops.
+#
+# Each skill in the subset gets its own fixed-width bit field within a single int, ordered by skill name. Each field
+# is wide enough to hold the sum of two clipped levels, plus one extra "guard" bit at the top that is always zero
+# in a packed value. With this, adding two packed values together, clipping to the extended limits, and checking
+# minimum levels all only take a handful of integer operations, and the packed value can be hashed directly.
+#
+# Skills outside of the subset are dropped when packing.
+class SkillsPacker:
+
+    __slots__ = [
+            "skills",
+            "_offsets",
+            "_offsets_by_id", # Indexed by Skill ID. None for skills outside of the subset.
+            "_field_width",
+            "_field_mask",
+            "_guard_mask",
+            "_limits",
+            "_clip_addend",
+        ]
+
+    def __init__(self, skill_subset):
+        assert all(isinstance(x, Skill) for x in skill_subset)
+
+        self.skills = tuple(sorted(skill_subset, key=lambda x : x.name))
+
+        max_limit = max((x.value.extended_limit for x in self.skills), default=1)
+        value_width = (2 * max_limit).bit_length()
+        self._field_width = value_width + 1 # Includes the guard bit
+        self._field_mask = (1 << value_width) - 1
+
+        self._offsets = {}
+        self._offsets_by_id = [None] * len(skill_extended_limits)
+        self._guard_mask = 0
+        self._limits = 0
+        self._clip_addend = 0
+        for (i, skill) in enumerate(self.skills):
+            offset = i * self._field_width
+            self._offsets[skill] = offset
+            self._offsets_by_id[skill.id] = offset
+            self._guard_mask |= 1 << (offset + value_width)
+            self._limits |= skill.value.extended_limit << offset
+            # Adding this to a field will carry into the guard bit if and only if it's above the limit.
+            self._clip_addend |= (self._field_mask - skill.value.extended_limit) << offset
+        return
+
+    # Takes a dict like {Skill.AGITATOR: 10, ...}, drops skills not in the subset, and clips to the extended limits.
+    def pack(self, skills_dict):
+        assert all(level >= 0 for (_, level) in skills_dict.items()) # We shouldn't be seeing negative skill levels.
+        ret = 0
+        for (skill, level) in skills_dict.items():
+            skill_id = skill.id
+            offset = self._offsets_by_id[skill_id]
+            if offset is not None:
+                ret |= min(level, skill_extended_limits[skill_id]) << offset
+        return ret
+
+    # Returns a defaultdict with default value of zero, containing only the skills with levels above zero.
+    def unpack(self, packed):
+        ret = defaultdict(lambda : 0)
+        for (skill, offset) in self._offsets.items():
+            level = (packed >> offset) & self._field_mask
+            if level > 0:
+                ret[skill] = level
+        return ret
+
+    def level(self, packed, skill):
+        offset = self._offsets_by_id[skill.id]
+        return 0 if (offset is None) else ((packed >> offset) & self._field_mask)
+
+    def total_level(self, packed):
+        return sum((packed >> offset) & self._field_mask for offset in self._offsets.values())
+
+    # Adds two packed values together, clipping the result to the extended limits.
+    def add(self, packed1, packed2):
+        x = packed1 + packed2
+        over = (x + self._clip_addend) & self._guard_mask
+        if over == 0:
+            return x
+        over_fields = over - (over >> (self._field_width - 1)) # Sets all value bits of each field that's over.
+        return (x & ~over_fields) | (self._limits & over_fields)
+
+    # Returns the higher level of each skill out of packed1 and packed2.
+    def max(self, packed1, packed2):
+        ge = ((packed1 | self._guard_mask) - packed2) & self._guard_mask # Guard bits of fields where packed1 >= packed2
+        ge_fields = ge - (ge >> (self._field_width - 1)) # Sets all value bits of those fields.
+        return (packed1 & ge_fields) | (packed2 & ~ge_fields)
+
+    # Returns the lower level of each skill out of packed1 and packed2.
+    def min(self, packed1, packed2):
+        ge = ((packed1 | self._guard_mask) - packed2) & self._guard_mask # Guard bits of fields where packed1 >= packed2
+        ge_fields = ge - (ge >> (self._field_width - 1)) # Sets all value bits of those fields.
+        return (packed2 & ge_fields) | (packed1 & ~ge_fields)
+
+    # Returns how many more levels of each skill packed can take before reaching the extended limits.
+    # (Adding anything to packed gives the same result as adding the min() of it and the headroom.)
+    def headroom(self, packed):
+        return self._limits - packed # Fields never go above the limits, so nothing borrows from the next field.
+
+    # Returns True if every skill in packed has at least the level in packed_minimums.
+    # (This also tells us if packed is at least as good as packed_minimums.)
+    def meets_minimums(self, packed, packed_minimums):
+        return (((packed | self._guard_mask) - packed_minimums) & self._guard_mask) == self._guard_mask
+
+    # Returns a tuple of all levels in packed, in field order (i.e. the same order as self.skills).
+    def levels(self, packed):
+        return tuple((packed >> offset) & self._field_mask for offset in self._offsets.values())
+
+    # Returns the most bits a packed value can take up.
+    def bit_length(self):
+        return self._field_width * len(self.skills)
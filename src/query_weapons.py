@@ -896,14 +896,13 @@ def _weapon_combo_supercedes(w1, w2):
 
 
 # Returns a list of tuples (weapon, augments_tracker, upgrades_tracker)
-def get_pruned_weapon_combos(weapon_class, health_regen_minimum):
+#
+# If deadline (a search.SearchDeadline) is reached while we're pruning, we stop and return None.
+def get_pruned_weapon_combos(weapon_class, health_regen_minimum, deadline=None):
 
     weapon_combinations = []
 
-    for (_, weapon) in weapon_db.items():
-
-        if weapon.type is not weapon_class:
-            continue # We ignore weapons that don't match our desired weapon class.
+    for (_, weapon) in weapon_db.get_weapons_of_class(weapon_class).items():
 
         for augments_tracker in WeaponAugmentTracker.get_maximized_trackers(weapon, health_regen_minimum=health_regen_minimum):
             for upgrades_tracker in WeaponUpgradeTracker.get_maximized_trackers_pruned(weapon):
@@ -920,7 +919,10 @@ def get_pruned_weapon_combos(weapon_class, health_regen_minimum):
 
     progress = ExecutionProgress(f"PRUNING WEAPONS -", len(weapon_combinations), granularity=1000)
     weapon_combinations = prune_by_superceding(weapon_combinations, left_supercedes_right, \
-            execute_per_iteration=lambda : progress.update_and_log_progress(logger))
+            execute_per_iteration=lambda : progress.update_and_log_progress(logger), \
+            should_stop=None if (deadline is None) else deadline.reached)
+    if weapon_combinations is None:
+        return None
 
     if __debug__:
         fordump_after = weapon_combinations
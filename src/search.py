@@ -7,14 +7,28 @@ Author:   contact@simshadows.com
 A search algorithm that optimizes EFR!
 """
 
+import os
+import sys
+import mmap
 import time
+import json
+import pickle
+import hashlib
+import tempfile
+import signal
 import logging
+import heapq
+import multiprocessing as mp
 from copy import copy
+from array import array
 from math import ceil
-from itertools import product
-from collections import defaultdict, Counter
+from itertools import product, permutations
+from collections import namedtuple, defaultdict, Counter, OrderedDict
 
 from .builds       import (Build,
+                          BatchedLookupFromSkills,
+                          EFRLookupGrid,
+                          EFRLookupTable,
                           lookup_from_skills)
 from .enums        import Tier
 from .loggingutils import (ExecutionProgress,
@@ -28,14 +42,26 @@ from .utils        import (counter_is_subset,
                           get_humanreadable_from_enum_counter,
                           get_humanreadable_from_enum_list,
                           get_humanreadable_from_list_of_enum_counter,
-                          list_obeys_sort_order)
+                          list_obeys_sort_order,
+                          json_read,
+                          json_write,
+                          ENCODING)
 from .serialize    import (SearchParameters,
                           readjson_search_parameters)
 
-from .database_armour import (ArmourSlot,
+from .database_armour import (ArmourDiscriminator,
+                             ArmourVariant,
+                             ArmourSlot,
                              ArmourPieceInfo,
-                             easyiterate_armour)
-from .database_skills import Skill, SetBonus
+                             armour_db,
+                             easyiterate_armour,
+                             ARMOUR_DATA_FILENAME)
+from .database_charms import CharmInfo, charms_db, CHARMS_DATA_FILENAME
+from .database_decorations import (decoration_slot_sizes,
+                                  decoration_skills,
+                                  DECORATIONS_DATA_FILENAME)
+from .database_skills import Skill, SetBonus, skill_extended_limits, SKILLS_DATA_FILENAME
+from .database_weapons import WeaponClass, WEAPONS_DATA_FILENAME
 
 from .query_armour      import prune_easyiterate_armour_db
 from .query_charms      import (get_charms_subset,
@@ -47,30 +73,141 @@ from .query_skills      import (calculate_possible_set_bonus_combos,
                                relax_set_bonus_combos,
                                calculate_set_bonus_skills,
                                clipped_skills_defaultdict,
-                               convert_skills_dict_to_tuple,
-                               convert_set_bonuses_dict_to_tuple)
+                               convert_set_bonuses_dict_to_tuple,
+                               SkillsPacker)
 from .query_weapons     import (calculate_final_weapon_values,
                                get_pruned_weapon_combos)
 
 
+# When searching with multiple worker processes, each worker gets more than one chunk of work so that workers
+# that finish early can pick up more work.
+_PARALLEL_CHUNKS_PER_WORKER = 16
+
+# The armour slots that Stage 3 adds (after charms). The order they get added in is picked by
+# _choose_stage3_slot_order(), which prefers this order if several orders look equally good.
+_STAGE3_SLOT_ORDER = (ArmourSlot.HEAD, ArmourSlot.CHEST, ArmourSlot.ARMS, ArmourSlot.WAIST, ArmourSlot.LEGS)
+
+# How many combinations we keep after each armour slot when probing for an EFR lower bound.
+_LOWER_BOUND_PROBE_BEAM_WIDTH = 32
+
+# How often we check for interrupts while waiting on worker processes.
+_INTERRUPT_POLL_SECONDS = 0.5
+
+# The most EFR values we're willing to hold in precomputed EFR lookup tables (8 bytes each) across all weapon groups.
+_EFR_LOOKUP_TABLES_MAX_SIZE = 1 << 24
+
+# Roughly how many bytes a seen-set needs to remember one beaten combination. This is only used to turn the Stage 3
+# cache budget into a number of combinations (see SeenSetBySSB).
+_SEEN_SET_BYTES_PER_BEATEN = 200
+
+# Bump this whenever SearchCheckpointer changes what it saves.
+_CHECKPOINT_FORMAT_VERSION = 3
+
+# Bump this whenever SearchResultCache changes what it saves, or the search might find different builds for the same
+# search parameters and databases (e.g. after fixing a bug).
+_RESULT_CACHE_FORMAT_VERSION = 2
+
+# Search parameters that only change how a search runs, and not what it finds (see SearchResultCache). We only ever
+# cache searches that weren't stopped early, so the time budget doesn't matter either.
+_RESULT_CACHE_IGNORED_PARAMETERS = {
+        "num_worker_processes",
+        "time_budget_seconds",
+        "vectorized_weapon_evaluation",
+        "precomputed_efr_tables",
+        "meet_in_the_middle",
+        "stage3_cache_budget_mb",
+        "checkpoint_filename",
+        "checkpoint_interval_seconds",
+        "warm_start_build_filename", # We use the file's contents instead.
+        "result_cache_directory",
+    }
+
+# Every database file that a search depends on.
+_DATABASE_FILENAMES = [
+        ARMOUR_DATA_FILENAME,
+        CHARMS_DATA_FILENAME,
+        DECORATIONS_DATA_FILENAME,
+        SKILLS_DATA_FILENAME,
+        WEAPONS_DATA_FILENAME,
+    ]
+
+_RETAINED_COMBINATION_ERROR_MESSAGE = "We have retained at least one combination from a previous armour-combining " \
+                                      "stage. This code is not yet equipped to handle this case since we're " \
+                                      "assuming that all previous combinations can be improved on. " \
+                                      "This error might occur if we've maxed out on skills before combining all " \
+                                      "armour pieces, or in other weird cases. (We'll deal with this error when we " \
+                                      "find these cases!)"
+
+
 logger = logging.getLogger(__name__)
 
 
 def run_search(search_parameters_jsonstr):
     search_parameters = readjson_search_parameters(search_parameters_jsonstr)
+    if search_parameters.checkpoint_filename is None:
+        checkpointer = None
+    else:
+        checkpointer = SearchCheckpointer(search_parameters.checkpoint_filename, search_parameters_jsonstr, \
+                                            search_parameters.checkpoint_interval_seconds)
+    _run_search(search_parameters, checkpointer)
+    return
+
+
+# Continues a search from a checkpoint file saved by run_search(). We keep saving checkpoints to the same file.
+def resume_search(checkpoint_filename):
+    checkpointer = SearchCheckpointer.load(checkpoint_filename)
+    search_parameters = readjson_search_parameters(checkpointer.search_parameters_jsonstr)
+    _run_search(search_parameters, checkpointer)
+    return
+
+
+def _run_search(search_parameters, checkpointer):
+    assert isinstance(search_parameters, SearchParameters)
 
     # STATISTICS STUFF
     start_time = time.time()
 
-    build = _find_highest_efr_build(search_parameters)
+    result_cache = None
+    builds = None
+    if search_parameters.result_cache_directory is not None:
+        result_cache = SearchResultCache(search_parameters.result_cache_directory, search_parameters)
+        builds = result_cache.load()
+        if builds is not None:
+            log_appstats_generic(f"No search was run. These builds come from the search results file " \
+                                 f"{result_cache.filename}.", display_again=True)
+
+    if builds is None:
+        deadline = SearchDeadline(search_parameters.time_budget_seconds)
+        previous_sigint_handler = signal.signal(signal.SIGINT, deadline.handle_sigint)
+        try:
+            builds = _find_highest_efr_builds(search_parameters, deadline, checkpointer)
+        finally:
+            signal.signal(signal.SIGINT, previous_sigint_handler)
+
+        # If we've reached the deadline, we might not have finished, so the builds might not be the best ones.
+        if (result_cache is not None) and (not deadline.reached()):
+            result_cache.save(builds)
 
     display_appstats_again()
 
-    logger.info("")
-    logger.info("FINAL BUILD")
-    logger.info("")
-    logger.info(build.get_humanreadable(search_parameters.skill_states))
-    logger.info("")
+    if len(builds) == 0:
+        logger.info("")
+        logger.info("NO BUILDS FOUND")
+        logger.info("")
+    elif search_parameters.top_k == 1:
+        logger.info("")
+        logger.info("FINAL BUILD")
+        logger.info("")
+        logger.info(builds[0].get_humanreadable(search_parameters.skill_states))
+        logger.info("")
+    else:
+        logger.info("")
+        logger.info(f"FINAL BUILDS ({len(builds)} found)")
+        for (i, build) in enumerate(builds):
+            logger.info("")
+            logger.info(f"RANK {i + 1}:")
+            logger.info(build.get_humanreadable(search_parameters.skill_states))
+        logger.info("")
 
     # STATISTICS STUFF
     end_time = time.time()
@@ -84,20 +221,233 @@ def run_search(search_parameters_jsonstr):
     return
 
 
+# Lets a search stop early and still return the best builds it found so far. The search stops once
+# time_budget_seconds have passed (unless it's None), or once handle_sigint() is called (i.e. the user pressed Ctrl+C).
+#
+# Copies of this object that get sent to worker processes only know about the time budget, so the main process has
+# to stop the workers itself if the search gets interrupted.
+class SearchDeadline:
+
+    __slots__ = [
+            "end_time",
+            "interrupted",
+        ]
+
+    def __init__(self, time_budget_seconds=None):
+        assert (time_budget_seconds is None) or (time_budget_seconds > 0)
+        self.end_time = None if (time_budget_seconds is None) else (time.time() + time_budget_seconds)
+        self.interrupted = False
+        return
+
+    def reached(self):
+        return self.interrupted or ((self.end_time is not None) and (time.time() >= self.end_time))
+
+    # To be used as a SIGINT handler. The first Ctrl+C stops the search cleanly, and a second one stops it immediately.
+    def handle_sigint(self, signum, frame):
+        if self.interrupted:
+            raise KeyboardInterrupt
+        self.interrupted = True
+        logger.info("Interrupted. Stopping the search early. (Press Ctrl+C again to stop immediately.)")
+        return
+
+
+# Periodically saves how far a search got so that it can be picked up again with resume_search().
+#
+# A checkpoint holds the search parameters, the order Stage 3 adds armour slots in, the collection from the last armour
+# slot that Stage 3 finished adding, and how many combinations of that collection Stage 4 finished with (after sorting it) along with the best builds
+# it found in them. Everything else gets recalculated from the search parameters when resuming.
+#
+# Since Stage 3 collections can be large, we only pickle them once and reuse the bytes for every checkpoint after.
+class SearchCheckpointer:
+
+    __slots__ = [
+            "filename",
+            "search_parameters_jsonstr",
+            "interval_seconds",
+            "last_save_time",
+            "stage3_slot_order",
+            "stage3_slots_done",
+            "stage3_pickled_collection",
+            "stage4_num_explored",
+            "stage4_top_builds",
+        ]
+
+    def __init__(self, filename, search_parameters_jsonstr, interval_seconds):
+        assert isinstance(filename, str)
+        assert isinstance(search_parameters_jsonstr, str)
+        assert interval_seconds > 0
+        self.filename = filename
+        self.search_parameters_jsonstr = search_parameters_jsonstr
+        self.interval_seconds = interval_seconds
+        self.last_save_time = time.time()
+        self.stage3_slot_order = None
+        self.stage3_slots_done = 0
+        self.stage3_pickled_collection = None
+        self.stage4_num_explored = 0
+        self.stage4_top_builds = [] # [(efr, serialized_build)]
+        return
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, mode="rb") as f:
+            data = pickle.load(f)
+        if data.get("format_version") != _CHECKPOINT_FORMAT_VERSION:
+            raise ValueError(f"{filename} is not a checkpoint file that this version of the program can read.")
+        search_parameters = readjson_search_parameters(data["search_parameters"])
+        obj = cls(filename, data["search_parameters"], search_parameters.checkpoint_interval_seconds)
+        obj.stage3_slot_order = tuple(ArmourSlot[x] for x in data["stage3_slot_order"]) \
+                                    if (data["stage3_slot_order"] is not None) else None
+        obj.stage3_slots_done = data["stage3_slots_done"]
+        obj.stage3_pickled_collection = data["stage3_collection"]
+        obj.stage4_num_explored = data["stage4_num_explored"]
+        obj.stage4_top_builds = data["stage4_top_builds"]
+        return obj
+
+    def get_stage3_collection(self):
+        assert self.stage3_pickled_collection is not None
+        return pickle.loads(self.stage3_pickled_collection)
+
+    def get_stage4_top_builds(self):
+        return [(efr, Build.deserialize(x)) for (efr, x) in self.stage4_top_builds]
+
+    # We don't save Stage 4 progress on every call since it would slow the search down.
+    def stage4_save_is_due(self):
+        return time.time() >= self.last_save_time + self.interval_seconds
+
+    def save_stage3(self, slot_order, slots_done, c):
+        self.stage3_slot_order = slot_order
+        self.stage3_slots_done = slots_done
+        self.stage3_pickled_collection = pickle.dumps(c, protocol=pickle.HIGHEST_PROTOCOL)
+        self._save()
+        return
+
+    # top_builds is in the same format as returned by _combine_weapons().
+    def save_stage4(self, num_explored, top_builds):
+        assert self.stage3_slots_done == len(_STAGE3_SLOT_ORDER)
+        self.stage4_num_explored = num_explored
+        self.stage4_top_builds = [(efr, build.serialize()) for (efr, build) in top_builds]
+        self._save()
+        return
+
+    def _save(self):
+        data = {
+                "format_version"     : _CHECKPOINT_FORMAT_VERSION,
+                "search_parameters"  : self.search_parameters_jsonstr,
+                "stage3_slot_order"  : None if (self.stage3_slot_order is None) \
+                                                else [x.name for x in self.stage3_slot_order],
+                "stage3_slots_done"  : self.stage3_slots_done,
+                "stage3_collection"  : self.stage3_pickled_collection,
+                "stage4_num_explored": self.stage4_num_explored,
+                "stage4_top_builds"  : self.stage4_top_builds,
+            }
+        # We write to a separate file first so that we never end up with half of a checkpoint if we get killed.
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, mode="wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self.filename)
+        self.last_save_time = time.time()
+        logger.info(f"Saved checkpoint to {self.filename}.")
+        return
+
+
+# Saves the builds found by searches, so that running the same search again can skip straight to the results.
+#
+# Each search gets its own file in directory, named after a hash of:
+#   - the search parameters (other than the ones in _RESULT_CACHE_IGNORED_PARAMETERS),
+#   - the contents of the warm start build file (if there is one), and
+#   - the contents of every database file.
+# This means that changing a database file (or the warm start build) just means we'll never look at the old results
+# again. (We don't bother deleting them.)
+#
+# A file we can't read (e.g. a file cut short when the disk filled up) counts as not having any builds for the search.
+class SearchResultCache:
+
+    __slots__ = [
+            "filename",
+        ]
+
+    def __init__(self, directory, search_parameters):
+        assert isinstance(directory, str)
+        assert isinstance(search_parameters, SearchParameters)
+        self.filename = os.path.join(directory, _get_search_result_cache_key(search_parameters) + ".json")
+        return
+
+    # Returns a list of builds, or None if we don't have any for this search.
+    def load(self):
+        try:
+            data = json_read(self.filename)
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            logger.warning(f"Ignoring the unreadable search results file {self.filename}.")
+            return None
+        if (not isinstance(data, dict)) or (data.get("format_version") != _RESULT_CACHE_FORMAT_VERSION):
+            return None
+        return [Build.deserialize(x) for x in data["builds"]]
+
+    def save(self, builds):
+        data = {
+                "format_version": _RESULT_CACHE_FORMAT_VERSION,
+                "builds"        : [x.serialize() for x in builds],
+            }
+        # We write to a separate file first so that we never end up with half of a result if we get killed.
+        tmp_filename = self.filename + ".tmp"
+        json_write(tmp_filename, data=data)
+        os.replace(tmp_filename, self.filename)
+        logger.info(f"Saved search results to {self.filename}.")
+        return
+
+
+def _get_search_result_cache_key(search_parameters):
+    parameters = {k: _to_hashable_json_value(v) for (k, v) in search_parameters._asdict().items()
+                  if (k not in _RESULT_CACHE_IGNORED_PARAMETERS)}
+
+    h = hashlib.sha256()
+    h.update(str(_RESULT_CACHE_FORMAT_VERSION).encode(ENCODING))
+    h.update(json.dumps(parameters, sort_keys=True).encode(ENCODING))
+    filenames = list(_DATABASE_FILENAMES)
+    if search_parameters.warm_start_build_filename is not None:
+        filenames.append(search_parameters.warm_start_build_filename)
+    for filename in filenames:
+        with open(filename, mode="rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+# Converts search parameter values into something json.dumps() always gives the same output for.
+def _to_hashable_json_value(value):
+    if isinstance(value, (Skill, SetBonus, Tier, WeaponClass)):
+        return value.name
+    elif isinstance(value, dict):
+        return sorted((_to_hashable_json_value(k), _to_hashable_json_value(v)) for (k, v) in value.items())
+    elif isinstance(value, (set, frozenset)):
+        return sorted(_to_hashable_json_value(x) for x in value)
+    assert (value is None) or isinstance(value, (bool, int, float, str))
+    return value
+
+
 ###############################################################################
 
 
+# Returns a list of (group_identification, weapon_combos). Weapon combinations are sorted by ceiling EFR (highest
+# first) within each group, and groups are sorted by their highest ceiling EFR (see _reprune_weapon_combos()).
+#
+# If deadline (a SearchDeadline) is reached before we finish, we return None.
 def _get_grouped_and_pruned_weapon_combos(weapon_class, health_regen_minimum, skill_subset, set_bonuses_subset, \
-                                                                required_set_bonus_skills, skill_states):
+                                                                required_set_bonus_skills, skill_states, deadline=None):
 
     # TODO: This doesn't actually exclude free element yet...
     all_skills_max_except_free_elem = {skill: skill.value.extended_limit for skill in (skill_subset | required_set_bonus_skills)}
 
-    combos = get_pruned_weapon_combos(weapon_class, health_regen_minimum)
+    combos = get_pruned_weapon_combos(weapon_class, health_regen_minimum, deadline=deadline)
+    if combos is None:
+        return None
 
     weapon_groups = defaultdict(lambda : [])
     
     for (weapon, augments_tracker, upgrades_tracker) in combos:
+        if (deadline is not None) and deadline.reached():
+            return None
         combination_values = calculate_final_weapon_values(weapon, augments_tracker, upgrades_tracker)
 
         results = lookup_from_skills(weapon, all_skills_max_except_free_elem, skill_states, augments_tracker, upgrades_tracker)
@@ -123,35 +473,87 @@ def _get_grouped_and_pruned_weapon_combos(weapon_class, health_regen_minimum, sk
     
     for (group_identification, combo_list) in weapon_groups.items():
 
-        ## We sort because we want the weapons with the highest potential at the front, for pruning purposes!
-        #combo_list.sort(key=lambda x : x[4], reverse=True)
-        #assert combo_list[0][4] >= combo_list[-1][4]
+        # We sort because we want the weapons with the highest potential at the front, for pruning purposes!
+        combo_list.sort(key=lambda x : x[4], reverse=True)
+        assert combo_list[0][4] >= combo_list[-1][4]
 
         ret.append((group_identification, combo_list))
 
-    ## Sorting again for better pruning!
-    #ret.sort(key=lambda x : max(y[4] for y in x[1]), reverse=True)
+    # Sorting again for better pruning!
+    ret.sort(key=lambda x : x[1][0][4], reverse=True)
 
     return ret
 
 
-def _reprune_weapon_combos(weapon_combo_groups, *, minimum_efr_noninclusive):
+# Exactly one of the two keyword arguments must be provided.
+# We normally only keep weapons that can strictly beat the minimum, but the parallel engine also needs to prune by
+# EFR values found elsewhere in the search while still keeping ties (see _combine_weapons()).
+#
+# weapon_combo_groups must be sorted the same way _get_grouped_and_pruned_weapon_combos() sorts them, so each group
+# gets cut off with a binary search, and we can stop at the first group that loses all of its weapons. The returned
+# list is sorted the same way.
+def _reprune_weapon_combos(weapon_combo_groups, *, minimum_efr_noninclusive=None, minimum_efr_inclusive=None):
     assert isinstance(weapon_combo_groups, list)
-    assert isinstance(minimum_efr_noninclusive, float)
+    assert (minimum_efr_noninclusive is None) != (minimum_efr_inclusive is None)
+    assert isinstance(minimum_efr_noninclusive, float) or (minimum_efr_noninclusive is None)
+    assert isinstance(minimum_efr_inclusive, float) or (minimum_efr_inclusive is None)
+
+    if minimum_efr_noninclusive is not None:
+        keep = lambda ceiling_efr : ceiling_efr > minimum_efr_noninclusive
+    else:
+        keep = lambda ceiling_efr : ceiling_efr >= minimum_efr_inclusive
 
     new_list = []
 
     for (group_identification, combo_list) in weapon_combo_groups:
-        combo_list = [x for x in combo_list if (x[4] > minimum_efr_noninclusive)]
-
-        if len(combo_list) == 0:
-            continue
+        if not keep(combo_list[0][4]):
+            break # Every group after this one also has nothing left.
+
+        # We look for the first weapon combination we don't keep.
+        (lo, hi) = (1, len(combo_list))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keep(combo_list[mid][4]):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(combo_list):
+            combo_list = combo_list[:lo]
 
         new_list.append((group_identification, combo_list))
 
     return new_list
 
 
+# Sets up something for each weapon group that Stage 4 can use to look up EFRs for a whole group at once. We use
+# precomputed EFR lookup tables if use_tables is True (and they'd fit in _EFR_LOOKUP_TABLES_MAX_SIZE), otherwise a
+# BatchedLookupFromSkills if use_vectorized is True. If neither, we return None.
+#
+# These are built from the unrepruned weapon list, so they remain valid for any repruned version of it.
+#
+# skills is every skill that Stage 4 might have in its skills dicts (i.e. skills from the skill subset and from
+# set bonuses in the set bonus subset). Stage 4 only looks up EFRs for skills dicts that meet minimum_levels.
+def _get_group_lookups(weapon_combo_groups, skills, minimum_levels, skill_states, use_tables, use_vectorized):
+    if use_tables:
+        start_time = time.time()
+        grid = EFRLookupGrid([x for (_, combo_list) in weapon_combo_groups for x in combo_list], skills, skill_states, \
+                             minimum_levels)
+        size = sum(grid.get_table_size(combo_list) for (_, combo_list) in weapon_combo_groups)
+        if size <= _EFR_LOOKUP_TABLES_MAX_SIZE:
+            ret = {group_identification: EFRLookupTable(combo_list, grid, [x[4] for x in combo_list])
+                   for (group_identification, combo_list) in weapon_combo_groups}
+            log_appstats("EFR lookup table entries", size)
+            log_appstats_timetaken("Precomputing EFR lookup tables", start_time, display_again=True)
+            return ret
+        logger.warning(f"EFR lookup tables would need {size} entries, which is more than the limit of " \
+                       f"{_EFR_LOOKUP_TABLES_MAX_SIZE}. We'll look up EFRs without them.")
+
+    if use_vectorized:
+        return {group_identification: BatchedLookupFromSkills(combo_list, [x[4] for x in combo_list])
+                for (group_identification, combo_list) in weapon_combo_groups}
+    return None
+
+
 def _extend_weapon_combos_tuples(weapon_combos, skills_for_ceiling_efr, skill_states_dict):
     assert isinstance(weapon_combos, list)
     assert isinstance(skills_for_ceiling_efr, dict)
@@ -246,16 +648,16 @@ def _generate_deco_additions(deco_slots, regular_skills, decos):
     decos_sublist = decos[deco_slots[0] - 1]
     for deco in decos_sublist:
 
-        deco_skills = deco.value.skills_dict
-        deco_size = deco.value.slot_size
+        deco_skills = decoration_skills[deco.id]
+        deco_size = decoration_slot_sizes[deco.id]
 
         new_incomplete = copy(incomplete_deco_combos)
 
         for (curr_decos, curr_slots, curr_skills) in incomplete_deco_combos:
 
             max_to_add = ceil(max(
-                    (skill.value.extended_limit - curr_skills.get(skill, 0)) / level
-                    for (skill, level) in deco_skills.items()
+                    (skill_extended_limits[skill.id] - curr_skills.get(skill, 0)) / level
+                    for (skill, level) in deco_skills
                 ))
 
             if max_to_add > 0:
@@ -271,7 +673,7 @@ def _generate_deco_additions(deco_slots, regular_skills, decos):
 
                     curr_decos.append(deco)
                     curr_slots.pop(0)
-                    for (skill, level) in deco_skills.items():
+                    for (skill, level) in deco_skills:
                         curr_skills[skill] += level
 
                     t = (curr_decos, curr_slots, curr_skills)
@@ -286,6 +688,62 @@ def _generate_deco_additions(deco_slots, regular_skills, decos):
     return [(x[0], x[2]) for x in complete_deco_combos + incomplete_deco_combos]
 
 
+# Memoizes _generate_deco_additions() for a fixed decos list, so we don't keep generating the same decoration
+# additions for every armour piece and every Stage 3 combination.
+#
+# Which decorations get added only depends on the deco slots, and the levels of the skills that the decorations
+# that fit in those slots give (since we stop adding a decoration once all of its skills are maxed out). These are
+# used as the key, with levels clipped to the extended limits since going past the limit doesn't change anything.
+#
+# Results are tuples of decoration tuples, and are shared between callers, so they must not be modified. Once we
+# have max_size results, we evict the least recently used one.
+class DecoAdditionsCache:
+
+    __slots__ = [
+            "_decos",
+            "_relevant_skills",
+            "_relevant_limits",
+            "_max_size",
+            "_cache",
+        ]
+
+    def __init__(self, decos, max_size=4096):
+        assert isinstance(decos, list) and (len(decos) == 4)
+        assert max_size > 0
+        self._decos = decos
+        # The decos we try for some slots are the ones in the sublist for the biggest slot.
+        self._relevant_skills = [
+                tuple(sorted({skill for x in sublist for (skill, _) in decoration_skills[x.id]}, key=lambda x : x.name))
+                for sublist in decos
+            ]
+        self._relevant_limits = [tuple(skill_extended_limits[x.id] for x in y) for y in self._relevant_skills]
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        return
+
+    # skills can be any dict-like of {Skill: level}. Skills that can't be gained from decorations are ignored.
+    def get(self, deco_slots, skills):
+        if len(deco_slots) == 0:
+            return ((),)
+        deco_slots = tuple(sorted(deco_slots, reverse=True))
+
+        relevant_skills = self._relevant_skills[deco_slots[0] - 1]
+        relevant_limits = self._relevant_limits[deco_slots[0] - 1]
+        levels = tuple(min(skills.get(skill, 0), limit) for (skill, limit) in zip(relevant_skills, relevant_limits))
+        h = (deco_slots, levels)
+
+        ret = self._cache.get(h, None)
+        if ret is None:
+            regular_skills = defaultdict(lambda : 0, ((k, v) for (k, v) in zip(relevant_skills, levels) if (v > 0)))
+            ret = tuple(tuple(x) for (x, _) in _generate_deco_additions(deco_slots, regular_skills, self._decos))
+            self._cache[h] = ret
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(h)
+        return ret
+
+
 def _distance_to_nearest_target_set_bonus_combo(set_bonus_combo, target_set_bonus_combos):
     assert all((v >= 0) for (_, v) in set_bonus_combo.items())
     return min(
@@ -298,73 +756,744 @@ def _distance_to_nearest_target_set_bonus_combo(set_bonus_combo, target_set_bonu
 
 
 # "Seen-set, by skills and set bonuses"
+#
+# Only keeps combinations that aren't beaten by anything else that's been added. A combination is beaten by another
+# if the other has at least as many levels of every skill and at least as many pieces of every set bonus. The first
+# combination added wins if two are equal.
+#
+# Previously, this was done by storing the power set of every combination (i.e. everything it beats), which makes
+# each check a single lookup, but its size blows up exponentially with the number of skills. We now only store the
+# frontier of combinations that haven't been beaten, indexed by set bonuses (see _DominanceIndex), and remember
+# which combinations we've already found to be beaten so we don't have to check them again.
+#
+# Remembering beaten combinations only saves time, since anything that beat them is still (or has been replaced by
+# something that's even better). If max_beaten is provided, we forget them all whenever we've remembered that many.
+#
+# Skills are packed by skills_packer (see SkillsPacker).
 class SeenSetBySSB:
 
     __slots__ = [
-            "_seen_set",
-            "_combo_map"
+            "_skills_packer",
+            "_indices",
+            "_related_indices",
+            "_beaten",
+            "_max_beaten",
+            "_combo_map",
         ]
 
-    def __init__(self):
-        self._seen_set = set()
+    def __init__(self, skills_packer, *, max_beaten=None):
+        assert isinstance(skills_packer, SkillsPacker)
+        assert (max_beaten is None) or (isinstance(max_beaten, int) and (max_beaten > 0))
+        self._skills_packer = skills_packer
+        self._indices = {} # {set_bonuses_tuple: _DominanceIndex}
+        self._related_indices = {} # {set_bonuses_tuple: (indices_with_at_least, indices_with_at_most)}
+        self._beaten = set()
+        self._max_beaten = max_beaten
         self._combo_map = {}
         return
 
-    def add(self, skills_counter, set_bonuses_counter, object_to_store):
-        h = (convert_skills_dict_to_tuple(skills_counter), convert_set_bonuses_dict_to_tuple(set_bonuses_counter))
-        if h in self._seen_set:
+    # If keep_if is provided, it's only called for combinations that haven't already been seen. We throw away the
+    # combination if it returns False.
+    def add(self, packed_skills, set_bonuses_counter, object_to_store, *, keep_if=None):
+        sbc_h = convert_set_bonuses_dict_to_tuple(set_bonuses_counter)
+        h = (packed_skills, sbc_h)
+        if (h in self._combo_map) or (h in self._beaten):
+            return
+
+        (indices_with_at_least, indices_with_at_most) = self._get_related_indices(sbc_h)
+
+        levels = self._skills_packer.levels(packed_skills)
+        nonzero_levels = [(i, level) for (i, level) in enumerate(levels) if level > 0]
+        for index in indices_with_at_least:
+            if index.has_at_least(nonzero_levels):
+                self._add_beaten(h)
+                return
+        if (keep_if is not None) and (not keep_if(packed_skills)):
             return
 
         # And we add it!
-        self._add_power_set(skills_counter, set_bonuses_counter, h[0], h[1])
+        for index in indices_with_at_most:
+            for old_h in index.remove_at_most(levels):
+                del self._combo_map[old_h]
+                self._add_beaten(old_h)
+        self._indices[sbc_h].add(levels, h)
         self._combo_map[h] = object_to_store
         return
 
     def items_as_list(self):
         return [v for (k, v) in self._combo_map.items()]
 
-    def _add_power_set(self, skill_counter, set_bonuses_counter, sc_h, sbc_h):
-        h = (sc_h, sbc_h)
-        if h in self._seen_set:
-            if h in self._combo_map:
-                del self._combo_map[h]
-            return
-        self._seen_set.add(h)
+    # Returns a list of (packed_skills, set_bonuses_tuple, object) for everything we're storing, in the same order as
+    # items_as_list().
+    def items_with_keys_as_list(self):
+        return [(packed_skills, sbc_h, v) for ((packed_skills, sbc_h), v) in self._combo_map.items()]
+
+    def _add_beaten(self, h):
+        if (self._max_beaten is not None) and (len(self._beaten) >= self._max_beaten):
+            self._beaten.clear()
+        self._beaten.add(h)
+        return
+
+    def _get_related_indices(self, sbc_h):
+        ret = self._related_indices.get(sbc_h, None)
+        if ret is None:
+            if sbc_h not in self._indices:
+                max_level = max((x.value.extended_limit for x in self._skills_packer.skills), default=0)
+                self._indices[sbc_h] = _DominanceIndex(len(self._skills_packer.skills), max_level)
+                self._related_indices = {} # All cached relations are now out of date.
+            ret = (
+                    [v for (k, v) in self._indices.items() if _set_bonuses_tuple_at_least(k, sbc_h)],
+                    [v for (k, v) in self._indices.items() if _set_bonuses_tuple_at_least(sbc_h, k)],
+                )
+            self._related_indices[sbc_h] = ret
+        return ret
+
+
+def _set_bonuses_tuple_at_least(sbc_h, sbc_h_minimums):
+    sbc_d = dict(sbc_h)
+    return all(sbc_d.get(set_bonus, 0) >= pieces for (set_bonus, pieces) in sbc_h_minimums)
+
+
+# Stores tuples of skill levels (with an associated key), and quickly finds all stored tuples that are at least as
+# good as (or at most as good as) some other tuple.
+#
+# Stored tuples are split into blocks, each giving every tuple a bit position. For each block, skill, and level, we
+# keep an int with the bits of every tuple that has at least that level of that skill. This way, finding tuples that
+# beat some other tuple is just a bitwise AND of one int per nonzero skill.
+class _DominanceIndex:
+
+    _BLOCK_SIZE = 8192
+
+    __slots__ = [
+            "_num_fields",
+            "_max_level",
+            "_blocks",
+        ]
 
-        new_skills = copy(skill_counter)
-        for (skill, level) in skill_counter.items():
-            if level > 1:
-                new_skills[skill] = level - 1
+    def __init__(self, num_fields, max_level):
+        self._num_fields = num_fields
+        self._max_level = max_level
+        self._blocks = []
+        return
+
+    # nonzero_levels is a list of (field_index, level) for all nonzero levels of the tuple being checked.
+    def has_at_least(self, nonzero_levels):
+        for block in self._blocks:
+            bits = block.occupied
+            at_least = block.at_least
+            for (i, level) in nonzero_levels:
+                bits &= at_least[i][level]
+                if not bits:
+                    break
             else:
-                del new_skills[skill]
-            self._add_power_set(new_skills, set_bonuses_counter, convert_skills_dict_to_tuple(new_skills), sbc_h)
-            new_skills[skill] = level
-
-        new_set_bonuses = copy(set_bonuses_counter)
-        for (set_bonus, pieces) in set_bonuses_counter.items():
-            if pieces > 1:
-                new_set_bonuses[set_bonus] = pieces - 1
+                if bits:
+                    return True
+        return False
+
+    # Removes all stored tuples where every level is at most the corresponding level in levels.
+    # Returns a list of keys of all removed tuples.
+    def remove_at_most(self, levels):
+        ret = []
+        for block in self._blocks:
+            bits = block.occupied
+            at_least = block.at_least
+            for (field_at_least, level) in zip(at_least, levels):
+                bits &= ~field_at_least[level + 1]
+                if not bits:
+                    break
+            while bits:
+                lowest_bit = bits & -bits
+                bits ^= lowest_bit
+                ret.append(block.remove(lowest_bit.bit_length() - 1))
+        return ret
+
+    def add(self, levels, key):
+        assert len(levels) == self._num_fields
+        assert all((0 <= x <= self._max_level) for x in levels)
+        for block in self._blocks:
+            if not block.is_full():
+                break
+        else:
+            block = _DominanceIndexBlock(self._num_fields, self._max_level, self._BLOCK_SIZE)
+            self._blocks.append(block)
+        block.add(levels, key)
+        return
+
+
+class _DominanceIndexBlock:
+
+    __slots__ = [
+            "occupied",
+            "at_least", # at_least[field_index][level] --> bits of all tuples with at least that level
+                        # (Level 0 is never used, and the extra level at the end is always zero.)
+            "_capacity",
+            "_levels",
+            "_keys",
+            "_free_positions",
+        ]
+
+    def __init__(self, num_fields, max_level, capacity):
+        self.occupied = 0
+        self.at_least = [[0] * (max_level + 2) for _ in range(num_fields)]
+        self._capacity = capacity
+        self._levels = []
+        self._keys = []
+        self._free_positions = []
+        return
+
+    def is_full(self):
+        return (len(self._free_positions) == 0) and (len(self._keys) == self._capacity)
+
+    def add(self, levels, key):
+        if len(self._free_positions) > 0:
+            position = self._free_positions.pop()
+            self._levels[position] = levels
+            self._keys[position] = key
+        else:
+            position = len(self._keys)
+            self._levels.append(levels)
+            self._keys.append(key)
+        bit = 1 << position
+        self.occupied |= bit
+        for (field_at_least, level) in zip(self.at_least, levels):
+            for i in range(1, level + 1):
+                field_at_least[i] |= bit
+        return
+
+    # Returns the key of the removed tuple.
+    def remove(self, position):
+        mask = ~(1 << position)
+        self.occupied &= mask
+        for (field_at_least, level) in zip(self.at_least, self._levels[position]):
+            for i in range(1, level + 1):
+                field_at_least[i] &= mask
+        key = self._keys[position]
+        self._levels[position] = None
+        self._keys[position] = None
+        self._free_positions.append(position)
+        return key
+
+
+# A column-oriented collection of Stage 3 combinations. Reading a row gives back the same combination tuple as the
+# list-of-tuples collections, i.e. (pieces, deco_counter, packed_skills, set_bonuses), where set_bonuses is a
+# defaultdict.
+#
+# A list of combination tuples costs several hundred bytes per combination, mostly in each combination's own pieces
+# list, deco Counter, and set bonuses defaultdict. We instead keep:
+#   - a column of packed skills (an array of 64-bit ints if they fit),
+#   - a column of indices into a table of distinct set bonus counts, and
+#   - enough to work out each combination's pieces and decos (see below).
+# Subsets of a collection (see subset()) share the same tables.
+#
+# A collection made from scratch keeps one column per position in the pieces list, holding indices into a table of
+# distinct pieces, and a column of indices into a table of distinct deco counts. A collection made by adding an armour
+# slot to another collection (see from_additions()) instead only keeps which row of the parent collection each
+# combination came from, and which piece combination was added to it. We only follow these back to the pieces and
+# decos (see get_pieces() and get_deco_counter()) once we actually need them, which for most combinations is never.
+#
+# Every combination in a collection must have the same number of pieces (num_pieces).
+#
+# generation is only used to tell which collection a seen-set's objects refer to (see _add_armour_slot()). A collection
+# made by adding an armour slot to another collection has the next generation after it.
+#
+# Columns are usually arrays, but may also be lists (for packed skills that don't fit in 64 bits), or memoryviews of
+# a temporary file once they've been moved out of memory (see spill_to_disk()).
+class CombinationColumns:
+
+    __slots__ = [
+            "num_pieces",
+            "generation",
+            "_parent",
+            "_parent_index_column",
+            "_piece_combos",
+            "_piece_combo_index_column",
+            "_pieces",
+            "_piece_columns",
+            "_decos",
+            "_deco_column",
+            "_packed_skills_column",
+            "_set_bonuses",
+            "_set_bonuses_column",
+        ]
+
+    def __init__(self, skills_packer, num_pieces, combinations=(), *, generation=0):
+        assert isinstance(skills_packer, SkillsPacker)
+        assert isinstance(num_pieces, int) and (num_pieces >= 0)
+        self._init_from_scratch(num_pieces, array("Q") if (skills_packer.bit_length() <= 64) else [], generation)
+        for (pieces, deco_counter, packed_skills, set_bonuses) in combinations:
+            self._append(pieces, deco_counter, packed_skills, convert_set_bonuses_dict_to_tuple(set_bonuses))
+        return
+
+    def _init_from_scratch(self, num_pieces, empty_packed_skills_column, generation):
+        self.num_pieces = num_pieces
+        self.generation = generation
+        self._parent = None
+        self._parent_index_column = None
+        self._piece_combos = None
+        self._piece_combo_index_column = None
+        self._pieces = _InternTable(key=id)
+        self._piece_columns = [array("I") for _ in range(num_pieces)]
+        self._decos = _InternTable() # Deco counts are stored as tuples of Counter items, in the Counter's order.
+        self._deco_column = array("I")
+        self._packed_skills_column = empty_packed_skills_column
+        self._set_bonuses = _InternTable() # Set bonus counts are stored as set bonus tuples.
+        self._set_bonuses_column = array("I")
+        return
+
+    def _append(self, pieces, deco_counter, packed_skills, set_bonuses_tuple):
+        assert len(pieces) == self.num_pieces
+        for (column, piece) in zip(self._piece_columns, pieces):
+            column.append(self._pieces.get_index(piece))
+        self._deco_column.append(self._decos.get_index(tuple(deco_counter.items())))
+        self._packed_skills_column.append(packed_skills)
+        self._set_bonuses_column.append(self._set_bonuses.get_index(set_bonuses_tuple))
+        return
+
+    # Makes the collection we get from adding an armour slot to parent. additions is a list of
+    # (parent_index, piece_combo_index, packed_skills, set_bonuses_tuple) for each new combination, where
+    # piece_combo_index is an index into piece_combos (see _generate_slot_combinations()).
+    #
+    # The new collection holds onto parent and piece_combos.
+    @classmethod
+    def from_additions(cls, parent, piece_combos, additions):
+        assert isinstance(parent, CombinationColumns)
+        obj = cls.__new__(cls)
+        obj.num_pieces = parent.num_pieces + 1
+        obj.generation = parent.generation + 1
+        obj._parent = parent
+        obj._parent_index_column = array("I", (i for (i, _, _, _) in additions))
+        obj._piece_combos = piece_combos
+        obj._piece_combo_index_column = array("I", (j for (_, j, _, _) in additions))
+        obj._pieces = None
+        obj._piece_columns = None
+        obj._decos = None
+        obj._deco_column = None
+        obj._packed_skills_column = _empty_column_like(parent._packed_skills_column)
+        obj._packed_skills_column.extend(packed_skills for (_, _, packed_skills, _) in additions)
+        obj._set_bonuses = parent._set_bonuses
+        obj._set_bonuses_column = array("I", (obj._set_bonuses.get_index(sbc_h) for (_, _, _, sbc_h) in additions))
+        return obj
+
+    # Returns a new collection of just the rows at indices, in that order.
+    #
+    # If skills_only is True, the new collection can't tell what pieces and decos its combinations have. This is
+    # all that _add_armour_slot_worker() needs, and is much quicker to send to it.
+    def subset(self, indices, *, skills_only=False):
+        def subset_column(column):
+            ret = _empty_column_like(column)
+            ret.extend(column[i] for i in indices)
+            return ret
+        obj = CombinationColumns.__new__(CombinationColumns)
+        for k in self.__slots__:
+            setattr(obj, k, getattr(self, k))
+        if skills_only:
+            obj._parent = None
+            obj._parent_index_column = None
+            obj._piece_combos = None
+            obj._piece_combo_index_column = None
+            obj._pieces = None
+            obj._piece_columns = None
+            obj._decos = None
+            obj._deco_column = None
+        elif self._parent is None:
+            obj._piece_columns = [subset_column(x) for x in self._piece_columns]
+            obj._deco_column = subset_column(self._deco_column)
+        else:
+            obj._parent_index_column = subset_column(self._parent_index_column)
+            obj._piece_combo_index_column = subset_column(self._piece_combo_index_column)
+        obj._packed_skills_column = subset_column(self._packed_skills_column)
+        obj._set_bonuses_column = subset_column(self._set_bonuses_column)
+        return obj
+
+    # Returns roughly how many bytes of memory the columns of this collection, and of every collection it refers
+    # back to, take up. (The tables of distinct values are usually small enough to ignore.)
+    def get_memory_size(self):
+        ret = 0
+        for column in self._get_all_columns():
+            if isinstance(column, array):
+                ret += column.itemsize * len(column)
+            elif isinstance(column, list):
+                ret += sys.getsizeof(column) + sum(sys.getsizeof(x) for x in column)
+        return ret
+
+    # Moves columns out of memory and into a temporary file, which we then memory-map so the columns can still be
+    # read the same way. Since the file is gone once nothing refers to it anymore, we don't have to clean it up.
+    #
+    # We move the columns that are only needed to work out pieces and decos, as well as every column of every
+    # collection this one refers back to, since we never need their skills again. This collection's skills and set
+    # bonuses are read far too often to be worth moving. (Lists can't be moved, so they stay in memory.)
+    #
+    # Returns how many bytes we moved.
+    def spill_to_disk(self):
+        hot_columns = {id(self._packed_skills_column), id(self._set_bonuses_column)}
+        columns = [] # [(collection, slot_name, index_within_slot_or_None, column)]
+        collection = self
+        while collection is not None:
+            for (slot_name, index, column) in collection._get_columns_with_locations():
+                if isinstance(column, array) and ((collection is not self) or (id(column) not in hot_columns)):
+                    columns.append((collection, slot_name, index, column))
+            collection = collection._parent
+
+        offsets = []
+        with tempfile.TemporaryFile() as f:
+            size = 0
+            for (_, _, _, column) in columns:
+                data = column.tobytes()
+                f.write(data)
+                f.write(bytes(-len(data) % 8)) # Keeps every column aligned to 8 bytes.
+                offsets.append((size, len(data)))
+                size += len(data) + (-len(data) % 8)
+            if size == 0:
+                return 0
+            f.flush()
+            mapped_file = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped_file)
+        for ((collection, slot_name, index, column), (offset, length)) in zip(columns, offsets):
+            new_column = view[offset:(offset + length)].cast(column.typecode)
+            if index is None:
+                setattr(collection, slot_name, new_column)
             else:
-                del new_set_bonuses[set_bonus]
-            self._add_power_set(skill_counter, new_set_bonuses, sc_h, convert_set_bonuses_dict_to_tuple(new_set_bonuses))
-            new_set_bonuses[set_bonus] = pieces
+                getattr(collection, slot_name)[index] = new_column
+        return sum(length for (_, length) in offsets)
+
+    def _get_all_columns(self):
+        collection = self
+        while collection is not None:
+            for (_, _, column) in collection._get_columns_with_locations():
+                yield column
+            collection = collection._parent
+        return
+
+    # Generates (slot_name, index_within_slot_or_None, column) for each of this collection's own columns.
+    def _get_columns_with_locations(self):
+        for slot_name in ["_parent_index_column", "_piece_combo_index_column", "_deco_column", \
+                            "_packed_skills_column", "_set_bonuses_column"]:
+            column = getattr(self, slot_name)
+            if column is not None:
+                yield (slot_name, None, column)
+        for (i, column) in enumerate(self._piece_columns or []):
+            yield ("_piece_columns", i, column)
+        return
+
+    def get_pieces(self, index):
+        if self._parent is None:
+            return [self._pieces[column[index]] for column in self._piece_columns]
+        ret = self._parent.get_pieces(self._parent_index_column[index])
+        ret.append(self._piece_combos[self._piece_combo_index_column[index]][0])
+        return ret
+
+    # Returns a new Counter every time, so the caller is free to change it.
+    def get_deco_counter(self, index):
+        if self._parent is None:
+            return Counter(dict(self._decos[self._deco_column[index]]))
+        ret = self._parent.get_deco_counter(self._parent_index_column[index])
+        ret.update(self._piece_combos[self._piece_combo_index_column[index]][1])
+        return ret
+
+    def get_packed_skills(self, index):
+        return self._packed_skills_column[index]
+
+    def get_set_bonuses_tuple(self, index):
+        return self._set_bonuses[self._set_bonuses_column[index]]
+
+    def __len__(self):
+        return len(self._set_bonuses_column)
+
+    # Indexing with a slice returns a new collection (see subset()).
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.subset(range(len(self))[key])
+        return (
+                self.get_pieces(key),
+                self.get_deco_counter(key),
+                self._packed_skills_column[key],
+                defaultdict(lambda : 0, self._set_bonuses[self._set_bonuses_column[key]]),
+            )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+        return
+
+    # Pickling a collection that refers back to a parent would also pickle its parent (and so on), so we make a copy
+    # that stores everything itself first. Pieces can't be pickled as-is (see _piece_to_key()), so we also send them as
+    # keys instead.
+    def __getstate__(self):
+        obj = self
+        if self._parent is not None:
+            obj = CombinationColumns.__new__(CombinationColumns)
+            obj._init_from_scratch(self.num_pieces, _empty_column_like(self._packed_skills_column), self.generation)
+            for i in range(len(self)):
+                obj._append(self.get_pieces(i), self.get_deco_counter(i), self._packed_skills_column[i], \
+                                self.get_set_bonuses_tuple(i))
+        state = {k: getattr(obj, k) for k in obj.__slots__}
+        if obj._pieces is not None:
+            state["_pieces"] = [_piece_to_key(x) for x in obj._pieces.values]
+        # Memoryviews (see spill_to_disk()) can't be pickled, so we send them as arrays.
+        for (slot_name, index, column) in obj._get_columns_with_locations():
+            if isinstance(column, memoryview):
+                if index is None:
+                    state[slot_name] = array(column.format, column)
+                else:
+                    if state[slot_name] is obj._piece_columns:
+                        state[slot_name] = list(obj._piece_columns) # So we don't change obj's list.
+                    state[slot_name][index] = array(column.format, column)
+        return state
+
+    def __setstate__(self, state):
+        for (k, v) in state.items():
+            setattr(self, k, v)
+        if self._pieces is not None:
+            self._pieces = _InternTable([_piece_from_key(x) for x in state["_pieces"]], key=id)
+        return
+
+
+# Returns an empty column of the same type as column (see CombinationColumns).
+def _empty_column_like(column):
+    if isinstance(column, list):
+        return []
+    return array(column.format if isinstance(column, memoryview) else column.typecode)
+
+
+# A list of distinct values, where each value's index never changes.
+#
+# Values are told apart by key(value), which defaults to the value itself. (Armour pieces aren't hashable, so we tell
+# them apart by identity instead.)
+class _InternTable:
+
+    __slots__ = [
+            "values",
+            "_key",
+            "_indices",
+        ]
+
+    def __init__(self, values=(), *, key=None):
+        self.values = list(values)
+        self._key = key
+        self._indices = {self._get_key(x): i for (i, x) in enumerate(self.values)}
+        return
+
+    def get_index(self, value):
+        h = self._get_key(value)
+        ret = self._indices.get(h, None)
+        if ret is None:
+            ret = len(self.values)
+            self.values.append(value)
+            self._indices[h] = ret
+        return ret
 
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def _get_key(self, value):
+        return value if (self._key is None) else self._key(value)
+
+    # The dict is just the list inverted, so we don't bother pickling it.
+    def __getstate__(self):
+        return (self.values, self._key)
+
+    def __setstate__(self, state):
+        (self.values, self._key) = state
+        self._indices = {self._get_key(x): i for (i, x) in enumerate(self.values)}
         return
 
 
-def _generate_slot_combinations(slot_pieces, possible_decos, skill_subset, set_bonus_subset, *, progress_msg_slot):
+# Calculates optimistic EFR values for combinations, so we can throw away combinations that can't possibly reach
+# some EFR value.
+#
+# We assume that the combination gets, independently for each skill, the most levels it could possibly get from
+# whatever else gets added to it (including the weapon decorations), every set bonus skill we're searching for,
+# and the best weapon.
+#
+# Skills are packed by skills_packer (see SkillsPacker).
+class EFRCeiling:
+
+    __slots__ = [
+            "_skills_packer",
+            "_weapon_groups",
+            "_set_bonus_skills",
+            "_skill_states",
+            "_memo",
+        ]
+
+    def __init__(self, grouped_weapon_combos, skills_packer, set_bonus_subset, skill_states, decos):
+        assert isinstance(skills_packer, SkillsPacker)
+        self._skills_packer = skills_packer
+
+        self._weapon_groups = []
+        for ((_, sorted_deco_slots), weapon_combos) in grouped_weapon_combos:
+            deco_max_skills = _max_skill_levels_from_deco_slots(sorted_deco_slots, decos)
+            # Weapons with the highest ceiling EFRs go first so we can stop early.
+            weapon_combos = sorted(weapon_combos, key=lambda x : x[4], reverse=True)
+            self._weapon_groups.append((skills_packer.pack(deco_max_skills), weapon_combos))
+
+        all_set_bonus_pieces = {x: max(x.value.stages) for x in set_bonus_subset}
+        self._set_bonus_skills = {k: v for (k, v) in calculate_set_bonus_skills(all_set_bonus_pieces, None).items()
+                                  if ((k.value.states is None) or (k in skill_states))}
+
+        self._skill_states = skill_states
+        self._memo = {}
+        return
+
+    # Returns True if a combination with packed_skills could possibly reach minimum_efr, given that it could still get
+    # up to packed_extra_skills on top of whatever the weapon and set bonuses give it.
+    # If inclusive is False, the combination must be able to strictly beat minimum_efr.
+    def reaches(self, packed_skills, packed_extra_skills, minimum_efr, *, inclusive):
+        packed_skills = self._skills_packer.add(packed_skills, packed_extra_skills)
+
+        h = (packed_skills, minimum_efr, inclusive)
+        ret = self._memo.get(h, None)
+        if ret is None:
+            ret = self._reaches(packed_skills, minimum_efr, inclusive)
+            self._memo[h] = ret
+        return ret
+
+    # Returns the highest EFR that a combination with packed_skills could possibly reach (see reaches()).
+    def highest_efr(self, packed_skills, packed_extra_skills):
+        packed_skills = self._skills_packer.add(packed_skills, packed_extra_skills)
+
+        h = (packed_skills, None, None)
+        ret = self._memo.get(h, None)
+        if ret is None:
+            ret = self._highest_efr(packed_skills)
+            self._memo[h] = ret
+        return ret
+
+    def _highest_efr(self, packed_skills):
+        ret = 0
+        for (packed_deco_max_skills, weapon_combos) in self._weapon_groups:
+            group_skills = self._skills_packer.unpack(self._skills_packer.add(packed_skills, packed_deco_max_skills))
+            group_skills.update(self._set_bonus_skills)
+
+            for (weapon, augments_tracker, upgrades_tracker, combo_values, ceiling_efr) in weapon_combos:
+                if ceiling_efr <= ret:
+                    break
+
+                if combo_values.skill is None:
+                    w_skills = group_skills
+                else:
+                    w_skills = copy(group_skills)
+                    w_skills[combo_values.skill] += 1
+
+                efr = lookup_from_skills(weapon, w_skills, self._skill_states, augments_tracker, upgrades_tracker).efr
+                ret = max(ret, efr)
+        return ret
+
+    def _reaches(self, packed_skills, minimum_efr, inclusive):
+        for (packed_deco_max_skills, weapon_combos) in self._weapon_groups:
+            group_skills = self._skills_packer.unpack(self._skills_packer.add(packed_skills, packed_deco_max_skills))
+            group_skills.update(self._set_bonus_skills)
+
+            for (weapon, augments_tracker, upgrades_tracker, combo_values, ceiling_efr) in weapon_combos:
+                if (ceiling_efr < minimum_efr) or ((ceiling_efr == minimum_efr) and (not inclusive)):
+                    break
+
+                if combo_values.skill is None:
+                    w_skills = group_skills
+                else:
+                    w_skills = copy(group_skills)
+                    w_skills[combo_values.skill] += 1
+
+                efr = lookup_from_skills(weapon, w_skills, self._skill_states, augments_tracker, upgrades_tracker).efr
+                if (efr > minimum_efr) or (inclusive and (efr == minimum_efr)):
+                    return True
+        return False
+
+
+# Picks the order to add armour slots in during Stage 3, going for the smallest peak collection size, then the least
+# work (i.e. the fewest combinations tried). Returns a tuple of (slot_order, estimated_peak_collection_size).
+#
+# We estimate the size of a collection as the smaller of the number of combinations that go into it, and the number
+# of different skill and set bonus levels those combinations could possibly have (since the seen-set keeps at most
+# one combination for each). The real sizes are usually much smaller since the seen-set also throws away
+# combinations that are beaten by others, but the estimates are still good enough to compare orders by.
+def _choose_stage3_slot_order(charm_collection, piece_combos, skills_packer, set_bonus_subset):
+    assert isinstance(charm_collection, CombinationColumns)
+    assert isinstance(piece_combos, dict)
+
+    charm_max_skills = defaultdict(lambda : 0)
+    for (_, _, packed_skills, _) in charm_collection:
+        for (skill, level) in skills_packer.unpack(packed_skills).items():
+            charm_max_skills[skill] = max(charm_max_skills[skill], level)
+
+    slot_max_skills = {x: _max_skill_levels_from_piece_combos([piece_combos[x]], skills_packer) for x in _STAGE3_SLOT_ORDER}
+    slot_set_bonuses = {x: {y[3] for y in piece_combos[x] if (y[3] in set_bonus_subset)} for x in _STAGE3_SLOT_ORDER}
+
+    memo = {} # {frozenset_of_slots: estimated_size}
+
+    def estimate_size(slots):
+        ret = memo.get(slots, None)
+        if ret is None:
+            num_combinations = len(charm_collection)
+            for slot in slots:
+                num_combinations *= len(piece_combos[slot])
+
+            num_states = 1
+            for skill in skills_packer.skills:
+                max_level = charm_max_skills[skill] + sum(slot_max_skills[x][skill] for x in slots)
+                num_states *= min(max_level, skill.value.extended_limit) + 1
+            for set_bonus in set_bonus_subset:
+                num_states *= sum((set_bonus in slot_set_bonuses[x]) for x in slots) + 1
+
+            ret = min(num_combinations, num_states)
+            memo[slots] = ret
+        return ret
+
+    best = None
+    for slot_order in permutations(_STAGE3_SLOT_ORDER):
+        peak = 0
+        work = 0
+        for i in range(len(slot_order)):
+            work += estimate_size(frozenset(slot_order[:i])) * len(piece_combos[slot_order[i]])
+            peak = max(peak, estimate_size(frozenset(slot_order[:(i + 1)])))
+        # permutations() starts with _STAGE3_SLOT_ORDER, so it wins ties.
+        if (best is None) or ((peak, work) < best[0]):
+            best = ((peak, work), slot_order)
+
+    return (best[1], best[0][0])
+
+
+# Returns the most levels of each skill that we could get from one of each of the piece combination lists.
+def _max_skill_levels_from_piece_combos(piece_combos_lists, skills_packer):
+    ret = defaultdict(lambda : 0)
+    for piece_combos in piece_combos_lists:
+        slot_max = defaultdict(lambda : 0)
+        for (_, _, pc_packed_skills, _) in piece_combos:
+            for (skill, level) in skills_packer.unpack(pc_packed_skills).items():
+                slot_max[skill] = max(slot_max[skill], level)
+        for (skill, level) in slot_max.items():
+            ret[skill] += level
+    return ret
+
+
+# Returns the most levels of each skill that we could get from decorations in these slots.
+def _max_skill_levels_from_deco_slots(deco_slots, decos):
+    ret = defaultdict(lambda : 0)
+    for slot_size in deco_slots:
+        slot_max = defaultdict(lambda : 0)
+        for deco in decos[slot_size - 1]:
+            for (skill, level) in decoration_skills[deco.id]:
+                slot_max[skill] = max(slot_max[skill], level)
+        for (skill, level) in slot_max.items():
+            ret[skill] += level
+    return ret
+
+
+# Returns a list of piece combinations, which are tuples of (piece, decos, packed_skills, set_bonus).
+# decos is a tuple of decorations, and may be shared with other piece combinations.
+#
+# packed_decos is a list of packed skills indexed by Decoration ID, and includes every decoration deco_additions_cache
+# can add.
+def _generate_slot_combinations(slot_pieces, deco_additions_cache, packed_decos, skills_packer, set_bonus_subset, \
+                                                                                            *, progress_msg_slot):
     assert isinstance(slot_pieces, list)
-    assert isinstance(possible_decos, list)
-    assert isinstance(skill_subset, set)
+    assert isinstance(deco_additions_cache, DecoAdditionsCache)
+    assert isinstance(packed_decos, list)
+    assert isinstance(skills_packer, SkillsPacker)
     assert isinstance(set_bonus_subset, set)
 
-    # An important feature of these lists it that they are sorted by decoration size!
-    assert list_obeys_sort_order(possible_decos[0], key=lambda x : x.value.slot_size, reverse=True)
-    assert list_obeys_sort_order(possible_decos[1], key=lambda x : x.value.slot_size, reverse=True)
-    assert list_obeys_sort_order(possible_decos[2], key=lambda x : x.value.slot_size, reverse=True)
-    assert list_obeys_sort_order(possible_decos[3], key=lambda x : x.value.slot_size, reverse=True)
-
-    seen_set = SeenSetBySSB()
+    seen_set = SeenSetBySSB(skills_packer)
 
     # STATISTICS
     stats_pre = 0
@@ -372,21 +1501,22 @@ def _generate_slot_combinations(slot_pieces, possible_decos, skill_subset, set_b
     for piece in slot_pieces:
         assert isinstance(piece, ArmourPieceInfo)
 
-        skills = defaultdict(lambda : 0, piece.skills)
+        packed_skills = skills_packer.pack(piece.skills)
         set_bonus = piece.armour_set.set_bonus
         assert None not in set_bonus_subset
         set_bonuses = {set_bonus: 1} if (set_bonus in set_bonus_subset) else {}
 
-        deco_it = list(_generate_deco_additions(piece.decoration_slots, skills, possible_decos))
+        deco_it = deco_additions_cache.get(piece.decoration_slots, piece.skills)
         stats_pre += len(deco_it) # STATISTICS
-        for (deco_additions, new_skills) in deco_it:
-            new_skills = clipped_skills_defaultdict(new_skills)
+        for deco_additions in deco_it:
+            new_packed_skills = packed_skills
+            for deco in deco_additions:
+                new_packed_skills = skills_packer.add(new_packed_skills, packed_decos[deco.id])
 
             # Now, we have to decide if it's worth keeping.
-            new_skills = defaultdict(lambda : 0, ((k, v) for (k, v) in new_skills.items() if (k in skill_subset)))
 
-            t = (piece, deco_additions, new_skills, set_bonus)
-            seen_set.add(new_skills, set_bonuses, t)
+            t = (piece, deco_additions, new_packed_skills, set_bonus)
+            seen_set.add(new_packed_skills, set_bonuses, t)
 
     piece_combos = seen_set.items_as_list()
 
@@ -397,81 +1527,406 @@ def _generate_slot_combinations(slot_pieces, possible_decos, skill_subset, set_b
     return piece_combos
 
 
-def _add_armour_slot(curr_collection, piece_combos, skill_subset, minimum_set_bonus_combos, \
-                                minimum_set_bonus_distance, *, seen_set, progress_msg_slot):
-    assert isinstance(curr_collection, list)
+# If num_worker_processes is above one, we shard curr_collection into contiguous chunks and have a pool of worker
+# processes combine each chunk into its own local seen-set. The surviving combinations of each chunk are then added
+# to seen_set in chunk order.
+#
+# This gives us exactly the same result as adding everything to seen_set in one process. seen_set keeps exactly the
+# combinations that aren't superceded by anything else, and if several combinations have the same skills and set
+# bonuses, it keeps whichever one came first. A combination that survives in seen_set will also have survived in
+# its chunk's local seen-set, and re-adding chunks in order preserves which one came first.
+#
+# If efr_lower_bound is provided, we also throw away combinations that can't possibly reach it, even with the
+# most that the remaining armour slots could contribute (remaining_max_skills).
+#
+# If deadline (a SearchDeadline) is reached before we finish, we return None.
+#
+# Combinations are tuples of (pieces, deco_counter, packed_skills, set_bonuses), with skills packed by skills_packer.
+def _add_armour_slot(curr_collection, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                minimum_set_bonus_distance, *, seen_set, progress_msg_slot, num_worker_processes=1, \
+                                efr_ceiling=None, remaining_max_skills=None, efr_lower_bound=None, deadline=None):
+    assert isinstance(curr_collection, CombinationColumns)
     assert isinstance(piece_combos, list)
-    assert isinstance(skill_subset, set)
+    assert isinstance(skills_packer, SkillsPacker)
     assert isinstance(minimum_set_bonus_combos, list)
     assert isinstance(seen_set, SeenSetBySSB)
+    assert isinstance(num_worker_processes, int) and (num_worker_processes >= 1)
 
-    set_bonus_subset = set() # A little bit redundant?
-    for set_bonus_combo in minimum_set_bonus_combos:
-        set_bonus_subset.update(set(set_bonus_combo))
+    if efr_lower_bound is None:
+        ceiling_filter = None
+    else:
+        assert isinstance(efr_ceiling, EFRCeiling)
+        assert isinstance(remaining_max_skills, int)
+        ceiling_filter = (efr_ceiling, remaining_max_skills, efr_lower_bound)
 
     # STATISTICS
     stage2_pre = len(curr_collection) * len(piece_combos)
     progress = ExecutionProgress(f"COMBINING {progress_msg_slot} PIECES -", stage2_pre, granularity=50000)
 
-    for (pieces, deco_counter, regular_skills, set_bonuses) in curr_collection:
+    if num_worker_processes > 1:
+        _add_armour_slot_parallel(curr_collection, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                    minimum_set_bonus_distance, ceiling_filter, seen_set, progress, num_worker_processes, \
+                                    deadline)
+    else:
+        keep_if = _ceiling_filter_to_predicate(ceiling_filter)
+        it = _iterate_armour_slot_additions(curr_collection, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                                minimum_set_bonus_distance, progress, deadline=deadline)
+        for (i, j, new_packed_skills, new_set_bonuses) in it:
+            seen_set.add(new_packed_skills, new_set_bonuses, (curr_collection.generation, i, j), keep_if=keep_if)
+
+    if (deadline is not None) and deadline.reached():
+        return None
+
+    # The seen-set only holds (generation, index, piece_combo_index) for each combination, so we make the new
+    # collection from those. Anything from an earlier generation is a combination that we retained from a previous
+    # armour-combining stage (or from a checkpoint).
+    additions = []
+    for (packed_skills, sbc_h, (generation, i, j)) in seen_set.items_with_keys_as_list():
+        if generation != curr_collection.generation:
+            raise RuntimeError(_RETAINED_COMBINATION_ERROR_MESSAGE)
+        additions.append((i, j, packed_skills, sbc_h))
+    ret = CombinationColumns.from_additions(curr_collection, piece_combos, additions)
 
-        assert isinstance(pieces, list)
-        assert isinstance(deco_counter, Counter)
-        assert isinstance(regular_skills, defaultdict)
-        assert isinstance(set_bonuses, defaultdict)
+    # Statistics stuff
+    stage2_post = len(ret)
+
+    log_appstats_reduction(f"{progress_msg_slot} full combining reduction", stage2_pre, stage2_post, display_again=True)
+
+    #log_appstats_reduction("Set bonus filtering reduction", total_pre_deco_combos, final_pre_deco_combos)
+    #log_appstats_reduction("Skill and set bonus filtering reduction", post_deco_combos_seen, len(ret))
+
+    return ret
+
+
+# ceiling_filter is either None, or a tuple of (efr_ceiling, remaining_max_skills, efr_lower_bound).
+# Returns a function to use as a seen-set's keep_if argument.
+#
+# We keep combinations that can only tie with the lower bound since they might still be the first build to reach our
+# final EFR. Any combination we throw away will also have all of its subsets thrown away, so it doesn't matter that
+# they never get added to the seen-set.
+def _ceiling_filter_to_predicate(ceiling_filter):
+    if ceiling_filter is None:
+        return None
+    (efr_ceiling, remaining_max_skills, efr_lower_bound) = ceiling_filter
+    return lambda packed_skills : efr_ceiling.reaches(packed_skills, remaining_max_skills, efr_lower_bound, inclusive=True)
+
+
+# Generates every combination of curr_collection (a CombinationColumns) and piece_combos that is still within the
+# set bonus distance. Yields tuples of (index, piece_combo_index, packed_skills, set_bonuses), where index is the
+# combination's index in curr_collection. CombinationColumns.from_additions() makes the actual combinations.
+#
+# We don't make the combinations here since most of them get thrown away.
+#
+# If deadline (a SearchDeadline) is reached, we stop generating early.
+def _iterate_armour_slot_additions(curr_collection, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                        minimum_set_bonus_distance, progress, *, deadline=None):
+    assert isinstance(curr_collection, CombinationColumns)
+
+    set_bonus_subset = set() # A little bit redundant?
+    for set_bonus_combo in minimum_set_bonus_combos:
+        set_bonus_subset.update(set(set_bonus_combo))
+
+    for i in range(len(curr_collection)):
+        if (deadline is not None) and deadline.reached():
+            return
+
+        packed_skills = curr_collection.get_packed_skills(i)
+        set_bonuses = defaultdict(lambda : 0, curr_collection.get_set_bonuses_tuple(i))
 
-        assert all((k in skill_subset) for (k, v) in regular_skills.items()) # Only skills in the subset are considered
         assert all((k in set_bonus_subset) for (k, v) in set_bonuses.items()) # Only set bonuses in the subset are considered
 
-        for (pc_piece, pc_decos, pc_skills, pc_set_bonus) in piece_combos:
+        for (j, (pc_piece, pc_decos, pc_packed_skills, pc_set_bonus)) in enumerate(piece_combos):
             assert isinstance(pc_piece, ArmourPieceInfo)
-            assert isinstance(pc_decos, list)
-            assert isinstance(pc_skills, dict)
+            assert isinstance(pc_decos, tuple)
+            assert isinstance(pc_packed_skills, int)
             assert (pc_set_bonus is None) or isinstance(pc_set_bonus, SetBonus)
 
-            new_pieces = pieces + [pc_piece]
-            new_deco_counter = copy(deco_counter)
-            new_regular_skills = copy(regular_skills)
             new_set_bonuses = copy(set_bonuses)
 
-            new_deco_counter.update(pc_decos)
-
-            for (skill, level) in pc_skills.items():
-                if skill in skill_subset:
-                    new_regular_skills[skill] += level
-
             if (pc_set_bonus is not None) and (pc_set_bonus in set_bonus_subset):
                 new_set_bonuses[pc_set_bonus] += 1
 
             set_bonus_distance = _distance_to_nearest_target_set_bonus_combo(new_set_bonuses, minimum_set_bonus_combos)
             if set_bonus_distance > minimum_set_bonus_distance:
-                progress.update_and_log_progress(logger) # Statistics Stuff
+                if progress is not None:
+                    progress.update_and_log_progress(logger) # Statistics Stuff
                 continue
 
             # Now, we have to decide if it's worth keeping.
-            new_regular_skills = defaultdict(lambda : 0, ((k, v) for (k, v) in new_regular_skills.items() if (k in skill_subset)))
-            new_regular_skills = clipped_skills_defaultdict(new_regular_skills)
+            new_packed_skills = skills_packer.add(packed_skills, pc_packed_skills)
 
-            t = (new_pieces, new_deco_counter, new_regular_skills, new_set_bonuses)
-            seen_set.add(new_regular_skills, new_set_bonuses, t)
+            yield (i, j, new_packed_skills, new_set_bonuses)
 
-            progress.update_and_log_progress(logger) # Statistics Stuff
+            if progress is not None:
+                progress.update_and_log_progress(logger) # Statistics Stuff
+    return
 
-    ret = seen_set.items_as_list()
 
-    # Statistics stuff
-    stage2_post = len(ret)
+# Iterates through results_iter (from Pool.imap_unordered()), except we stop early if deadline gets interrupted.
+#
+# Worker processes ignore SIGINT, and only check for the time budget themselves.
+def _until_interrupted(results_iter, deadline):
+    while (deadline is None) or (not deadline.interrupted):
+        try:
+            yield results_iter.next(timeout=_INTERRUPT_POLL_SECONDS)
+        except StopIteration:
+            return
+        except mp.TimeoutError:
+            pass
+    return
 
-    log_appstats_reduction(f"{progress_msg_slot} full combining reduction", stage2_pre, stage2_post, display_again=True)
 
-    #log_appstats_reduction("Set bonus filtering reduction", total_pre_deco_combos, final_pre_deco_combos)
-    #log_appstats_reduction("Skill and set bonus filtering reduction", post_deco_combos_seen, len(ret))
+# Set up by _init_armour_slot_worker() in each worker process.
+_armour_slot_worker_state = None
+
+
+def _add_armour_slot_parallel(curr_collection, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                    minimum_set_bonus_distance, ceiling_filter, seen_set, progress, num_workers, deadline):
+    chunk_size = max(1, ceil(len(curr_collection) / (num_workers * _PARALLEL_CHUNKS_PER_WORKER)))
+    chunks_iter = ((i, curr_collection.subset(range(j, min(j + chunk_size, len(curr_collection))), skills_only=True))
+                   for (i, j) in enumerate(range(0, len(curr_collection), chunk_size)))
+
+    picklable_piece_combos = [_piece_combination_to_picklable(x) for x in piece_combos]
+    initargs = (picklable_piece_combos, skills_packer, minimum_set_bonus_combos, minimum_set_bonus_distance, \
+                    ceiling_filter, deadline)
+
+    # Chunks can finish out of order, so we hold onto them until all earlier chunks have been merged.
+    pending = {}
+    next_chunk_index = 0
+
+    with mp.Pool(num_workers, initializer=_init_armour_slot_worker, initargs=initargs) as p:
+        results_iter = p.imap_unordered(_add_armour_slot_worker, chunks_iter)
+        for (chunk_index, picklable_chunk_results) in _until_interrupted(results_iter, deadline):
+            chunk_length = min(chunk_size, len(curr_collection) - (chunk_index * chunk_size))
+            progress.update_and_log_progress(logger, skip=(chunk_length * len(piece_combos))) # Statistics Stuff
+
+            pending[chunk_index] = picklable_chunk_results
+            while next_chunk_index in pending:
+                chunk_start = next_chunk_index * chunk_size
+                for (i, j, new_packed_skills, sbc_h) in pending.pop(next_chunk_index):
+                    seen_set.add(new_packed_skills, dict(sbc_h), (curr_collection.generation, chunk_start + i, j))
+                next_chunk_index += 1
+
+    assert (len(pending) == 0) or ((deadline is not None) and deadline.reached())
+    return
+
+
+def _init_armour_slot_worker(picklable_piece_combos, skills_packer, minimum_set_bonus_combos, minimum_set_bonus_distance, \
+                                ceiling_filter, deadline):
+    global _armour_slot_worker_state
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The main process decides what to do about interrupts.
+    piece_combos = [_piece_combination_from_picklable(x) for x in picklable_piece_combos]
+    _armour_slot_worker_state = (piece_combos, skills_packer, minimum_set_bonus_combos, minimum_set_bonus_distance, \
+                                    ceiling_filter, deadline)
+    return
+
+
+# Returns a tuple of (chunk_index, [(index_within_chunk, piece_combo_index, packed_skills, set_bonuses_tuple)]).
+def _add_armour_slot_worker(args):
+    (chunk_index, chunk) = args
+    (piece_combos, skills_packer, minimum_set_bonus_combos, minimum_set_bonus_distance, ceiling_filter, deadline) = \
+            _armour_slot_worker_state
+
+    keep_if = _ceiling_filter_to_predicate(ceiling_filter)
+    local_seen_set = SeenSetBySSB(skills_packer)
+    it = _iterate_armour_slot_additions(chunk, piece_combos, skills_packer, minimum_set_bonus_combos, \
+                                            minimum_set_bonus_distance, None, deadline=deadline)
+    for (i, j, new_packed_skills, new_set_bonuses) in it:
+        local_seen_set.add(new_packed_skills, new_set_bonuses, (i, j), keep_if=keep_if)
+
+    return (chunk_index, [(i, j, packed_skills, sbc_h) for (packed_skills, sbc_h, (i, j)) \
+                                                            in local_seen_set.items_with_keys_as_list()])
+
+
+# The meet-in-the-middle version of Stage 3. Rather than adding armour slots one at a time, we build two halves
+# separately (charms with the first two slots of slot_order, and the last three slots on their own), each with its own
+# seen-set, and then join them together into a new seen-set.
+#
+# The halves are combined with _add_armour_slot(), so they get the same pruning (and worker processes) as usual, except
+# that we don't apply the EFR ceiling filter to the second half until the join.
+#
+# max_beaten is used for every seen-set we make (see SeenSetBySSB).
+#
+# Returns the final collection, or None if deadline (a SearchDeadline) is reached before we finish.
+def _combine_armour_meet_in_the_middle(charm_collection, piece_combos, slot_order, skills_packer, \
+                                            minimum_set_bonus_combos, remaining_max_skills, slot_names, *, \
+                                            num_worker_processes, efr_ceiling, efr_lower_bound, deadline, \
+                                            max_beaten=None):
+    assert isinstance(charm_collection, CombinationColumns)
+    assert isinstance(piece_combos, dict)
+    assert len(slot_order) == 5
+
+    # The same set bonus distances as the usual Stage 3, going by how many armour slots a combination has.
+    # (Combinations in either half can still get set bonus pieces from every armour slot they don't have yet.)
+    def max_set_bonus_distance(num_slots_done):
+        return len(slot_order) + 1 - num_slots_done
+
+    halves = []
+    for (start_collection, half_slot_order) in [
+                (charm_collection, slot_order[:2]),
+                (CombinationColumns(skills_packer, 0, [([], Counter(), 0, {})]), slot_order[2:]),
+            ]:
+        c = start_collection
+        seen_set = SeenSetBySSB(skills_packer, max_beaten=max_beaten)
+        for (i, slot) in enumerate(half_slot_order):
+            kwargs = {
+                    "seen_set"            : seen_set,
+                    "progress_msg_slot"   : slot_names[slot][0],
+                    "num_worker_processes": num_worker_processes,
+                    "deadline"            : deadline,
+                }
+            if len(halves) == 0:
+                kwargs.update({"efr_ceiling": efr_ceiling, "remaining_max_skills": remaining_max_skills[slot], \
+                                "efr_lower_bound": efr_lower_bound})
+            c = _add_armour_slot(c, piece_combos[slot], skills_packer, minimum_set_bonus_combos, \
+                                    max_set_bonus_distance(i + 1), **kwargs)
+            if c is None:
+                return None
+        halves.append(c)
+
+    log_appstats_generic(f"Meet-in-the-middle half sizes: {len(halves[0])} and {len(halves[1])}")
+
+    keep_if = None
+    if efr_lower_bound is not None:
+        keep_if = _ceiling_filter_to_predicate((efr_ceiling, 0, efr_lower_bound))
+    return _join_armour_halves(halves[0], halves[1], skills_packer, minimum_set_bonus_combos, \
+                                    max_set_bonus_distance(len(slot_order)), keep_if=keep_if, deadline=deadline, \
+                                    max_beaten=max_beaten)
+
+
+# Joins every combination in first_half with every combination in second_half, keeping only the combinations that
+# aren't beaten by others (see SeenSetBySSB). Returns the joined collection (a CombinationColumns), or None if
+# deadline is reached.
+#
+# We index second_half by set bonuses, so we can skip whole groups that are too far from the set bonuses we need.
+# Within a group, we then only try combinations that aren't beaten by another combination in the same group once
+# skills are clipped to the headroom left by the first half combination (since clipping makes them equivalent).
+# This reduced list only depends on the group and the headroom, so we share it between first half combinations.
+def _join_armour_halves(first_half, second_half, skills_packer, minimum_set_bonus_combos, minimum_set_bonus_distance, \
+                                                                    *, keep_if=None, deadline=None, max_beaten=None):
+    assert isinstance(first_half, CombinationColumns)
+    assert isinstance(second_half, CombinationColumns)
+
+    second_half_groups = {} # {set_bonuses_tuple: (set_bonuses, [combination])}
+    for t in second_half:
+        sbc_h = convert_set_bonuses_dict_to_tuple(t[3])
+        if sbc_h not in second_half_groups:
+            second_half_groups[sbc_h] = (t[3], [])
+        second_half_groups[sbc_h][1].append(t)
+
+    reduced_groups = {} # {(set_bonuses_tuple, packed_headroom): [combination]}
+
+    def get_reduced_group(sbc_h, packed_headroom):
+        h = (sbc_h, packed_headroom)
+        ret = reduced_groups.get(h, None)
+        if ret is None:
+            group_seen_set = SeenSetBySSB(skills_packer)
+            for t in second_half_groups[sbc_h][1]:
+                group_seen_set.add(skills_packer.min(t[2], packed_headroom), {}, t)
+            ret = group_seen_set.items_as_list()
+            reduced_groups[h] = ret
+        return ret
+
+    seen_set = SeenSetBySSB(skills_packer, max_beaten=max_beaten)
+
+    # STATISTICS
+    stats_pre = len(first_half) * len(second_half)
+    stats_tried = 0
+    progress = ExecutionProgress(f"JOINING ARMOUR HALVES -", len(first_half), granularity=200)
+
+    for (pieces, deco_counter, packed_skills, set_bonuses) in first_half:
+        if (deadline is not None) and deadline.reached():
+            return None
+
+        packed_headroom = skills_packer.headroom(packed_skills)
+
+        for (sbc_h, (group_set_bonuses, _)) in second_half_groups.items():
+            new_set_bonuses = copy(set_bonuses)
+            for (set_bonus, num_pieces) in group_set_bonuses.items():
+                new_set_bonuses[set_bonus] += num_pieces
+
+            set_bonus_distance = _distance_to_nearest_target_set_bonus_combo(new_set_bonuses, minimum_set_bonus_combos)
+            if set_bonus_distance > minimum_set_bonus_distance:
+                continue
+
+            for (g_pieces, g_deco_counter, g_packed_skills, _) in get_reduced_group(sbc_h, packed_headroom):
+                new_packed_skills = skills_packer.add(packed_skills, g_packed_skills)
+                t = (pieces + g_pieces, deco_counter + g_deco_counter, new_packed_skills, copy(new_set_bonuses))
+                seen_set.add(new_packed_skills, new_set_bonuses, t, keep_if=keep_if)
+                stats_tried += 1 # STATISTICS
+
+        progress.update_and_log_progress(logger) # STATISTICS
+
+    ret = CombinationColumns(skills_packer, first_half.num_pieces + second_half.num_pieces, seen_set.items_as_list(), \
+                                generation=(first_half.generation + second_half.generation))
+
+    # STATISTICS
+    log_appstats_reduction("Armour halves join, indexing reduction", stats_pre, stats_tried, display_again=True)
+    log_appstats_reduction("Armour halves join, full combining reduction", stats_pre, len(ret), display_again=True)
 
     return ret
 
 
-def _find_highest_efr_build(s):
+# Quickly finds real builds by only keeping the most promising few combinations after adding each armour slot.
+# Returns a tuple of (efr_lower_bound, top_builds). efr_lower_bound is the EFR of the worst of the top ctx.top_k
+# builds, or None if we didn't find that many builds. top_builds is the same as for _combine_weapons().
+#
+# initial_top_builds is passed on to _combine_weapons(), so any builds we already know about are included in the results.
+#
+# If deadline (a SearchDeadline) is reached, we stop early and return whatever builds we've found so far.
+def _probe_efr_lower_bound(charm_collection, piece_combos, slot_order, minimum_set_bonus_combos, grouped_weapon_combos, \
+                                                                    ctx, initial_top_builds=(), deadline=None):
+    assert isinstance(piece_combos, dict)
+
+    skills_packer = ctx.skills_packer
+
+    c = charm_collection
+    for (slot, minimum_set_bonus_distance) in zip(slot_order, (5, 4, 3, 2, 1)):
+        if (deadline is not None) and deadline.reached():
+            top_builds = list(initial_top_builds)
+            return (None if (len(top_builds) < ctx.top_k) else top_builds[-1][0], top_builds)
+
+        # A full seen-set is too slow here, so we only throw away exact duplicates.
+        seen = {}
+        it = _iterate_armour_slot_additions(c, piece_combos[slot], skills_packer, minimum_set_bonus_combos, \
+                                                minimum_set_bonus_distance, None, deadline=deadline)
+        for (i, j, new_packed_skills, new_set_bonuses) in it:
+            h = (new_packed_skills, convert_set_bonuses_dict_to_tuple(new_set_bonuses))
+            if h not in seen:
+                seen[h] = (i, j, new_packed_skills, new_set_bonuses)
+        additions = list(seen.values())
+
+        # We prefer combinations closer to the set bonuses and skill levels we need, then the ones with the most skills.
+        additions.sort(key=lambda x : (_distance_to_nearest_target_set_bonus_combo(x[3], minimum_set_bonus_combos), \
+                                       sum(max(v - skills_packer.level(x[2], k), 0) for (k, v) in ctx.skills_with_minimum_levels.items()), \
+                                       -skills_packer.total_level(x[2])))
+        additions = [(i, j, packed_skills, convert_set_bonuses_dict_to_tuple(set_bonuses)) \
+                     for (i, j, packed_skills, set_bonuses) in additions[:_LOWER_BOUND_PROBE_BEAM_WIDTH]]
+        c = CombinationColumns.from_additions(c, piece_combos[slot], additions)
+
+    logger.info("Probing for an EFR lower bound.")
+    (top_builds, _, _) = _combine_weapons(c, grouped_weapon_combos, ctx, initial_top_builds=initial_top_builds, \
+                                            deadline=deadline)
+    efr_lower_bound = None if (len(top_builds) < ctx.top_k) else top_builds[-1][0]
+    return (efr_lower_bound, top_builds)
+
+
+# Returns a list of up to s.top_k builds, from highest to lowest EFR.
+#
+# If deadline (a SearchDeadline) is reached before we finish, we return the best builds we've found so far, and log
+# how far we got.
+# Returns the set of skills that Stage 4 scores builds on. Stage 4 only ever sees skills from the skill subset, and
+# every skill from every stage of the set bonuses that can give us the selected set bonus skills.
+def _get_stage4_skills(s):
     assert isinstance(s, SearchParameters)
+    set_bonus_subset = {x for set_bonus_combo in calculate_possible_set_bonus_combos(s.selected_set_bonus_skills) \
+                                for x in set_bonus_combo}
+    return set(s.selected_skills) | {skill for x in set_bonus_subset for skill in x.value.stages.values()}
+
+
+def _find_highest_efr_builds(s, deadline=None, checkpointer=None):
+    assert isinstance(s, SearchParameters)
+    assert (checkpointer is None) or isinstance(checkpointer, SearchCheckpointer)
 
     ####################################
     # STAGE 1: Read search parameters. #
@@ -494,6 +1949,12 @@ def _find_highest_efr_build(s):
 
     skill_states = s.skill_states
 
+    # If we already know of a good build, we start with it so we have an EFR value to prune against right away.
+    warm_start_top_builds = []
+    if s.warm_start_build_filename is not None:
+        warm_start_top_builds.append(_load_warm_start_build(s.warm_start_build_filename, s))
+        log_appstats("Warm start build EFR", warm_start_top_builds[0][0])
+
     #########################################
     # STAGE 2.1: Generate some collections. #
     #########################################
@@ -517,7 +1978,12 @@ def _find_highest_efr_build(s):
     start_time = time.time()
     grouped_weapon_combos = _get_grouped_and_pruned_weapon_combos(desired_weapon_class, min_health_regen_augment_level, \
                                                                     skill_subset, set_bonus_subset, required_set_bonus_skills, \
-                                                                    skill_states)
+                                                                    skill_states, deadline=deadline)
+    if grouped_weapon_combos is None:
+        # We ran out of time, so the best we have is the warm start build (if we have one).
+        log_appstats_generic(f"Stopped while pruning weapons.", display_again=True)
+        _log_early_stop_before_combining(deadline, warm_start_top_builds)
+        return [build for (_, build) in warm_start_top_builds]
     num_weapon_combos = sum(len(x) for (_, x) in grouped_weapon_combos)
     log_appstats_bufferbreak()
     log_appstats_timetaken("Pruning weapons", start_time, display_again=True)
@@ -528,178 +1994,759 @@ def _find_highest_efr_build(s):
     ##############################################
 
     def check_combination_size(expected_size):
-        if not all((len(pieces) == expected_size) for (pieces, _, _, _) in c):
-            raise RuntimeError("We have retained at least one combination from a previous armour-combining stage. " \
-                               "This code is not yet equipped to handle this case since we're " \
-                               "assuming that all previous combinations can be improved on. " \
-                               "This error might occur if we've maxed out on skills before combining all armour pieces, " \
-                               "or in other weird cases. (We'll deal with this error when we find these cases!)")
+        if c.num_pieces != expected_size:
+            raise RuntimeError(_RETAINED_COMBINATION_ERROR_MESSAGE)
         return
 
+    ##################################################################
+    # STAGE 2.3: We set up everything needed to combine weapons, and #
+    #            to calculate EFR ceilings.                          #
+    ##################################################################
+
+    # From here on, we only deal with skills within the skill subset, so we pack them for speed.
+    skills_packer = SkillsPacker(skill_subset)
+
+    stage4_skills = _get_stage4_skills(s)
+
+    packed_decos = [None] * len(decoration_skills)
+    for deco in decos_maxsize4:
+        packed_decos[deco.id] = skills_packer.pack(deco.value.skills_dict)
+
+    ctx = _WeaponCombiningContext(
+            skills_packer              = skills_packer,
+            set_bonus_subset           = set_bonus_subset,
+            required_set_bonus_skills  = required_set_bonus_skills,
+            skills_with_minimum_levels = skills_with_minimum_levels,
+            packed_minimum_skills      = skills_packer.pack(skills_with_minimum_levels),
+            skill_states               = skill_states,
+            deco_additions             = DecoAdditionsCache(decos),
+            packed_decos               = packed_decos,
+            num_weapon_combos          = num_weapon_combos,
+            top_k                      = s.top_k,
+            efr_ceiling                = EFRCeiling(grouped_weapon_combos, skills_packer, set_bonus_subset, skill_states, decos),
+            group_lookups              = _get_group_lookups(grouped_weapon_combos, stage4_skills, \
+                                                            skills_with_minimum_levels, skill_states, \
+                                                            s.precomputed_efr_tables, s.vectorized_weapon_evaluation),
+        )
+
     ###########################################################################
     # STAGE 3: We combine armour, charms, and decorations, pruning in stages. #
     ###########################################################################
 
-    c = []
-    c_seen_set = SeenSetBySSB()
+    # If Stage 3 has a cache budget, half of it goes to seen-sets remembering beaten combinations (see SeenSetBySSB),
+    # and the other half to finished collections, after which we start moving them to disk (see
+    # CombinationColumns.spill_to_disk()).
+    #
+    # This isn't a cap on Stage 3's peak memory. The combinations a seen-set keeps (and their dominance index) have to
+    # stay in memory while an armour slot is being added, since every new combination gets checked against them, so
+    # those aren't counted.
+    if s.stage3_cache_budget_mb is None:
+        max_beaten = None
+        collection_memory_budget = None
+    else:
+        max_beaten = max(1, int((s.stage3_cache_budget_mb * (1 << 20)) / 2 / _SEEN_SET_BYTES_PER_BEATEN))
+        collection_memory_budget = (s.stage3_cache_budget_mb * (1 << 20)) / 2
+
+    def spill_if_over_budget(collection):
+        if (collection_memory_budget is not None) and (collection.get_memory_size() > collection_memory_budget):
+            log_appstats("Stage 3 bytes moved to disk", collection.spill_to_disk())
+        return
+
+    c_seen_set = SeenSetBySSB(skills_packer, max_beaten=max_beaten)
 
-    # We first generate a list of just charms.
-    for charm in charms:
-        skills = defaultdict(lambda : 0)
-        set_bonuses = defaultdict(lambda : 0)
-        skills.update((k, v) for (k, v) in calculate_skills_dict_from_charm(charm, charm.max_level).items() if (k in skill_subset))
-        c.append(([charm], Counter(), skills, set_bonuses))
+    # We first generate a collection of just charms.
+    c = CombinationColumns(skills_packer, 1, (([charm], Counter(), \
+                                                    skills_packer.pack(calculate_skills_dict_from_charm(charm, charm.max_level)), \
+                                                    {}) for charm in charms))
     check_combination_size(1)
 
     log_appstats("Charms", len(c))
     start_time = time.time()
     log_appstats_bufferbreak()
-    
-    kwargs = {"progress_msg_slot": "HEAD"}
-    piece_combos = _generate_slot_combinations(armour[ArmourSlot.HEAD], decos, skill_subset, set_bonus_subset, **kwargs)
-    c = _add_armour_slot(c, piece_combos, skill_subset, relaxed_minimum_set_bonus_combos, 5, seen_set=c_seen_set, **kwargs)
 
-    log_appstats_timetaken("Adding head pieces", start_time, display_again=True)
-    check_combination_size(2)
-    #c_seen_set = SeenSetBySSB() # Uncomment to force it to reset
+    # We generate piece combinations for every slot up front since the EFR ceilings need to know the most that
+    # the remaining slots could possibly contribute.
+    piece_combos = {}
+    for slot in ArmourSlot:
+        piece_combos[slot] = _generate_slot_combinations(armour[slot], ctx.deco_additions, ctx.packed_decos, \
+                                                            skills_packer, set_bonus_subset, progress_msg_slot=slot.name)
+
+    # How big our collections get depends a lot on the order we add armour slots in, so we pick an order now that we
+    # know how many piece combinations each slot has. If we're resuming, we have to stick with the same order.
+    if (checkpointer is not None) and (checkpointer.stage3_slots_done > 0):
+        slot_order = checkpointer.stage3_slot_order
+    else:
+        (slot_order, estimated_peak) = _choose_stage3_slot_order(c, piece_combos, skills_packer, set_bonus_subset)
+        log_appstats("Estimated peak Stage 3 collection size", estimated_peak)
+    log_appstats_generic("Stage 3 armour slot order: " + ", ".join(x.name for x in slot_order), display_again=True)
+
+    remaining_max_skills = {}
+    for (i, slot) in enumerate(slot_order):
+        remaining_slots_piece_combos = (piece_combos[x] for x in slot_order[i + 1:])
+        remaining_max_skills[slot] = skills_packer.pack(_max_skill_levels_from_piece_combos(remaining_slots_piece_combos, \
+                                                                                            skills_packer))
+
+    # We find a real build quickly so we have an EFR value to prune against.
+    (efr_lower_bound, probe_top_builds) = _probe_efr_lower_bound(c, piece_combos, slot_order, \
+                                                                    relaxed_minimum_set_bonus_combos, \
+                                                                    grouped_weapon_combos, ctx, warm_start_top_builds, \
+                                                                    deadline=deadline)
+
+    log_appstats_timetaken("Generating piece combinations and probing for an EFR lower bound", start_time, display_again=True)
+    log_appstats("EFR lower bound", efr_lower_bound)
     start_time = time.time()
     log_appstats_bufferbreak()
 
-    kwargs = {"progress_msg_slot": "CHEST"}
-    piece_combos = _generate_slot_combinations(armour[ArmourSlot.CHEST], decos, skill_subset, set_bonus_subset, **kwargs)
-    c = _add_armour_slot(c, piece_combos, skill_subset, relaxed_minimum_set_bonus_combos, 4, seen_set=c_seen_set, **kwargs)
+    # If we're resuming, we skip the armour slots we already added. The seen-set only ever holds the latest
+    # collection, so we get it back by adding the collection to it again.
+    slots_done = 0
+    if (checkpointer is not None) and (checkpointer.stage3_slots_done > 0):
+        slots_done = checkpointer.stage3_slots_done
+        c = checkpointer.get_stage3_collection()
+        for i in range(len(c)):
+            c_seen_set.add(c.get_packed_skills(i), dict(c.get_set_bonuses_tuple(i)), (None, i, None))
+        check_combination_size(slots_done + 1)
+        log_appstats_generic(f"Resumed from a checkpoint after adding {slots_done} armour slots " \
+                             f"({len(c)} combinations).", display_again=True)
+
+    stage_kwargs = {
+            "seen_set"            : c_seen_set,
+            "num_worker_processes": s.num_worker_processes,
+            "efr_ceiling"         : ctx.efr_ceiling,
+            "efr_lower_bound"     : efr_lower_bound,
+            "deadline"            : deadline,
+        }
+    slot_names = { # {slot: (progress message name, statistics name)}
+            ArmourSlot.HEAD : ("HEAD",  "head"),
+            ArmourSlot.CHEST: ("CHEST", "chest"),
+            ArmourSlot.ARMS : ("ARM",   "arm"),
+            ArmourSlot.WAIST: ("WAIST", "waist"),
+            ArmourSlot.LEGS : ("LEGS",  "leg"),
+        }
+
+    # The meet-in-the-middle engine adds all armour slots in one go, so we only checkpoint once it's finished.
+    if s.meet_in_the_middle and (slots_done == 0):
+        new_c = _combine_armour_meet_in_the_middle(c, piece_combos, slot_order, skills_packer, \
+                                                    relaxed_minimum_set_bonus_combos, remaining_max_skills, slot_names, \
+                                                    num_worker_processes=s.num_worker_processes, \
+                                                    efr_ceiling=ctx.efr_ceiling, efr_lower_bound=efr_lower_bound, \
+                                                    deadline=deadline, max_beaten=max_beaten)
+        if new_c is None:
+            log_appstats_generic(f"Stopped while combining armour pieces.", display_again=True)
+            max_skills_from_slot = _max_skill_levels_from_piece_combos((piece_combos[x] for x in slot_order), skills_packer)
+            _log_early_stop(deadline, probe_top_builds, c, skills_packer.pack(max_skills_from_slot), \
+                                grouped_weapon_combos, ctx)
+            return [build for (_, build) in probe_top_builds]
+        c = new_c
+
+        log_appstats_timetaken(f"Adding armour pieces (meet-in-the-middle)", start_time, display_again=True)
+        if len(c) == 0:
+            log_appstats_generic(f"No combinations left after adding armour pieces.", display_again=True)
+            return [build for (_, build) in probe_top_builds]
+        slots_done = len(slot_order)
+        check_combination_size(slots_done + 1)
+        spill_if_over_budget(c)
+        if checkpointer is not None:
+            checkpointer.save_stage3(slot_order, slots_done, c)
+        start_time = time.time()
+        log_appstats_bufferbreak()
+
+    for (i, slot) in enumerate(slot_order):
+        if i < slots_done:
+            continue
+        (progress_msg_slot, stats_name) = slot_names[slot]
+        minimum_set_bonus_distance = len(slot_order) - i
+
+        kwargs = {"progress_msg_slot": progress_msg_slot, "remaining_max_skills": remaining_max_skills[slot]}
+        new_c = _add_armour_slot(c, piece_combos[slot], skills_packer, relaxed_minimum_set_bonus_combos, \
+                                    minimum_set_bonus_distance, **stage_kwargs, **kwargs)
+
+        if new_c is None:
+            # We ran out of time, so the best we have are the builds from the probe.
+            log_appstats_generic(f"Stopped while adding {stats_name} pieces.", display_again=True)
+            max_skills_from_slot = _max_skill_levels_from_piece_combos((piece_combos[x] for x in slot_order[i:]), \
+                                                                        skills_packer)
+            _log_early_stop(deadline, probe_top_builds, c, skills_packer.pack(max_skills_from_slot), \
+                                grouped_weapon_combos, ctx)
+            return [build for (_, build) in probe_top_builds]
+        c = new_c
+
+        log_appstats_timetaken(f"Adding {stats_name} pieces", start_time, display_again=True)
+        if len(c) == 0:
+            # Nothing can beat the builds we already know about (e.g. from a warm start).
+            log_appstats_generic(f"No combinations left after adding {stats_name} pieces.", display_again=True)
+            return [build for (_, build) in probe_top_builds]
+        check_combination_size(i + 2)
+        spill_if_over_budget(c)
+        if checkpointer is not None:
+            checkpointer.save_stage3(slot_order, i + 1, c)
+        start_time = time.time()
+        log_appstats_bufferbreak()
+
+    assert all(
+            all(
+                (skill in skill_subset) and (level > 0) and (level <= skill.value.extended_limit)
+                for (skill, level) in skills_packer.unpack(c.get_packed_skills(i)).items()
+            )
+            for i in range(len(c))
+        )
 
-    log_appstats_timetaken("Adding chest pieces", start_time, display_again=True)
-    check_combination_size(3)
-    #c_seen_set = SeenSetBySSB() # Uncomment to force it to reset
+    # Every combination has to be able to reach the minimum skill levels with the decorations from at least one weapon
+    # group and the most set bonus skills it could get, so we throw away those that can't before sorting.
+    packed_minimum_bound = 0
+    for ((_, sorted_deco_slots), _) in grouped_weapon_combos:
+        deco_max_skills = _max_skill_levels_from_deco_slots(sorted_deco_slots, decos)
+        packed_minimum_bound = skills_packer.max(packed_minimum_bound, skills_packer.pack(deco_max_skills))
+    set_bonus_skills = {skill: 1 for x in set_bonus_subset for skill in x.value.stages.values()}
+    packed_minimum_bound = skills_packer.add(packed_minimum_bound, skills_packer.pack(set_bonus_skills))
+    num_pre_filter = len(c)
+    c = c.subset([i for i in range(len(c)) if skills_packer.meets_minimums( \
+                        skills_packer.add(c.get_packed_skills(i), packed_minimum_bound), ctx.packed_minimum_skills)])
+    log_appstats_reduction("Minimum skill filtering", num_pre_filter, len(c))
+    if len(c) == 0:
+        log_appstats_generic(f"No combinations can reach the minimum skill levels.", display_again=True)
+        return [build for (_, build) in probe_top_builds]
+
+    # We try the combinations with the highest ceiling EFRs first, so we find good builds early, and can stop as soon
+    # as no remaining combination can beat them. Ties go to the combinations with the most skills within the skill
+    # subset, since we assume that the best builds tend to be the ones that fit the most skills into them.
+    efr_bounds = [ctx.efr_ceiling.highest_efr(c.get_packed_skills(i), 0) for i in range(len(c))]
+    order = sorted(range(len(c)), key=lambda i : (efr_bounds[i], skills_packer.total_level(c.get_packed_skills(i))), \
+                    reverse=True)
+    c = c.subset(order)
+    efr_bounds = [efr_bounds[i] for i in order]
+    spill_if_over_budget(c)
+
+    log_appstats_timetaken("Calculating ceiling EFRs", start_time, display_again=True)
+    if len(c) > 0:
+        log_appstats("Highest ceiling EFR", efr_bounds[0])
     start_time = time.time()
     log_appstats_bufferbreak()
 
-    kwargs = {"progress_msg_slot": "ARM"}
-    piece_combos = _generate_slot_combinations(armour[ArmourSlot.ARMS], decos, skill_subset, set_bonus_subset, **kwargs)
-    c = _add_armour_slot(c, piece_combos, skill_subset, relaxed_minimum_set_bonus_combos, 3, seen_set=c_seen_set, **kwargs)
+    ######################################################################
+    # STAGE 4: We now try weapon combinations to find our optimal build! #
+    ######################################################################
 
-    log_appstats_timetaken("Adding arm pieces", start_time, display_again=True)
-    check_combination_size(4)
-    #c_seen_set = SeenSetBySSB() # Uncomment to force it to reset
-    start_time = time.time()
-    log_appstats_bufferbreak()
+    stage4_kwargs = {
+            "efr_bounds"        : efr_bounds,
+            "deadline"          : deadline,
+            "checkpointer"      : checkpointer,
+            "initial_top_builds": warm_start_top_builds,
+        }
+    if checkpointer is not None:
+        stage4_kwargs["start"] = checkpointer.stage4_num_explored
+        stage4_kwargs["initial_top_builds"] = _merge_top_builds(checkpointer.get_stage4_top_builds(), \
+                                                                    warm_start_top_builds, s.top_k)
+
+    if s.num_worker_processes > 1:
+        (top_builds, unexplored) = _combine_weapons_parallel(c, grouped_weapon_combos, ctx, s.num_worker_processes, \
+                                                                **stage4_kwargs)
+    else:
+        progress = ExecutionProgress(f"COMBINING WEAPONS -", len(c), granularity=200)
+        (top_builds, _, num_explored) = _combine_weapons(c, grouped_weapon_combos, ctx, progress=progress, \
+                                                            **stage4_kwargs)
+        unexplored = c[num_explored:]
 
-    kwargs = {"progress_msg_slot": "WAIST"}
-    piece_combos = _generate_slot_combinations(armour[ArmourSlot.WAIST], decos, skill_subset, set_bonus_subset, **kwargs)
-    c = _add_armour_slot(c, piece_combos, skill_subset, relaxed_minimum_set_bonus_combos, 2, seen_set=c_seen_set, **kwargs)
+    log_appstats_timetaken("Adding weapons", start_time, display_again=True)
 
-    log_appstats_timetaken("Adding waist pieces", start_time, display_again=True)
-    check_combination_size(5)
-    #c_seen_set = SeenSetBySSB() # Uncomment to force it to reset
-    start_time = time.time()
-    log_appstats_bufferbreak()
+    if len(unexplored) > 0:
+        num_explored = len(c) - len(unexplored)
+        log_appstats_generic(f"Stopped after trying weapons with {num_explored} out of {len(c)} armour combinations " \
+                             f"({round((num_explored / len(c)) * 100, 2)}%).", display_again=True)
 
-    kwargs = {"progress_msg_slot": "LEGS"}
-    piece_combos = _generate_slot_combinations(armour[ArmourSlot.LEGS], decos, skill_subset, set_bonus_subset, **kwargs)
-    c = _add_armour_slot(c, piece_combos, skill_subset, relaxed_minimum_set_bonus_combos, 1, seen_set=c_seen_set, **kwargs)
+        # We might not have found anything as good as the builds from the probe yet.
+        top_builds = _merge_top_builds(top_builds, probe_top_builds, ctx.top_k)
+        _log_early_stop(deadline, top_builds, unexplored, 0, grouped_weapon_combos, ctx)
 
-    log_appstats_timetaken("Adding leg pieces", start_time, display_again=True)
-    check_combination_size(6)
-    start_time = time.time()
-    log_appstats_bufferbreak()
+    return [build for (_, build) in top_builds]
 
-    # We sort by number of skills within the skill subset for better pruning!
-    # We assume here that the best builds tend to be the ones that fit the most skills into it.
-    assert all(
-            all(
-                (skill in skill_subset) and (level > 0) and (level <= skill.value.extended_limit)
-                for (skill, level) in x[2].items()
-            )
-            for x in c
-        )
-    c.sort(key=(lambda x : sum(level for (_, level) in x[2].items())), reverse=True)
 
-    ######################################################################
-    # STAGE 4: We now try weapon combinations to find our optimal build! #
-    ######################################################################
+# Both lists of builds are in the same format as the top_builds returned by _combine_weapons(). Builds from the
+# first list win EFR ties.
+def _merge_top_builds(top_builds_1, top_builds_2, top_k):
+    ret = []
+    seen = set()
+    for (efr, build) in sorted(top_builds_1 + top_builds_2, key=lambda x : x[0], reverse=True):
+        h = build.serialize()
+        if h not in seen:
+            seen.add(h)
+            ret.append((efr, build))
+    return ret[:top_k]
+
+
+# Reads a serialized build (see Build.serialize()) from a file, and returns a tuple of (efr, build) in the same format
+# as the top_builds returned by _combine_weapons().
+#
+# The build has to meet the search parameters, otherwise its EFR might be higher than anything the search is allowed
+# to return. We also score it only on the skills Stage 4 scores builds on (see _get_stage4_skills()), so it gets the
+# same EFR it would get if the search found it.
+def _load_warm_start_build(filename, s):
+    assert isinstance(filename, str)
+    assert isinstance(s, SearchParameters)
 
-    best_efr = 1
-    associated_affinity = None
-    associated_build = None
+    with open(filename, encoding=ENCODING, mode="r") as f:
+        build = Build.deserialize(f.read())
+
+    performance = build.calculate_performance(s.skill_states)
+    if isinstance(performance, list):
+        raise ValueError("The warm start build has skills with states that aren't set in skill_states.")
+    if build.get_weapon_class() is not s.selected_weapon_class:
+        raise ValueError("The warm start build doesn't use the selected weapon class.")
+    if any((performance.skills.get(k, 0) < v) for (k, v) in s.selected_skills.items()):
+        raise ValueError("The warm start build doesn't have the minimum levels of all selected skills.")
+    if any((performance.skills.get(x, 0) < 1) for x in s.selected_set_bonus_skills):
+        raise ValueError("The warm start build doesn't have all selected set bonus skills.")
+    if build.get_health_regen_augment_level() < s.min_health_regen_augment_level:
+        raise ValueError("The warm start build doesn't have the minimum Health Regen augment level.")
+    if (s.selected_armour_tier is not None) \
+                and any((x is not s.selected_armour_tier) for x in build.get_armour_tiers().values()):
+        raise ValueError("The warm start build has armour pieces that aren't of the selected armour tier.")
+
+    return (build.calculate_performance(s.skill_states, _get_stage4_skills(s)).efr, build)
+
+
+# Logs how much better of a build we might have missed by stopping the search early.
+#
+# remaining is a CombinationColumns of the combinations we didn't finish with, and packed_extra_skills is the most skills that any
+# of them could still get from armour pieces that haven't been added yet. top_builds is in the same format as
+# returned by _combine_weapons().
+def _log_early_stop(deadline, top_builds, remaining, packed_extra_skills, grouped_weapon_combos, ctx):
+    assert isinstance(deadline, SearchDeadline)
+    skills_packer = ctx.skills_packer
+
+    reason = "interrupted" if deadline.interrupted else "time budget reached"
+    log_appstats_generic(f"Search stopped early ({reason}).", display_again=True)
+
+    if len(top_builds) == ctx.top_k:
+        grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, minimum_efr_noninclusive=top_builds[-1][0])
+    num_weapon_combos = sum(len(x) for (_, x) in grouped_weapon_combos)
+    log_appstats_generic(f"Weapon combinations still in contention: {num_weapon_combos} out of " \
+                         f"{ctx.num_weapon_combos} (in {len(grouped_weapon_combos)} weapon groups)", display_again=True)
+
+    # Rather than finding the ceiling EFR of every remaining combination (which could take a while), we take the
+    # ceiling EFR of a combination with the most of each skill out of all of them.
+    packed_max_skills = 0
+    for i in range(len(remaining)):
+        packed_max_skills = skills_packer.max(packed_max_skills, remaining.get_packed_skills(i))
+    ceiling_efr = ctx.efr_ceiling.highest_efr(packed_max_skills, packed_extra_skills)
+    log_appstats_generic(f"Largest remaining ceiling EFR: {ceiling_efr}", display_again=True)
+
+    if len(top_builds) > 0:
+        log_appstats_generic(f"Best EFR found: {top_builds[0][0]} (up to {max(ceiling_efr - top_builds[0][0], 0)} " \
+                             f"EFR short of optimal)", display_again=True)
+    return
 
-    #stats_combos_explored = 0
-    progress = ExecutionProgress(f"COMBINING WEAPONS -", len(c), granularity=200)
 
-    for (c_pieces, c_deco_counter, c_regular_skills, c_set_bonuses) in c:
-        (c_charm, c_head, c_chest, c_arms, c_waist, c_legs) = c_pieces
+# Logs the best builds we found if we stopped the search before we could combine anything.
+def _log_early_stop_before_combining(deadline, top_builds):
+    assert isinstance(deadline, SearchDeadline)
+
+    reason = "interrupted" if deadline.interrupted else "time budget reached"
+    log_appstats_generic(f"Search stopped early ({reason}).", display_again=True)
+
+    if len(top_builds) > 0:
+        log_appstats_generic(f"Best EFR found: {top_builds[0][0]}", display_again=True)
+    else:
+        log_appstats_generic(f"No builds found yet.", display_again=True)
+    return
+
+
+###############################################################################
+
+
+# Everything needed to combine weapons with the Stage 3 combinations, other than the combinations themselves.
+_WeaponCombiningContext = namedtuple(
+    "_WeaponCombiningContext",
+    [
+        "skills_packer",
+        "set_bonus_subset",
+        "required_set_bonus_skills",
+        "skills_with_minimum_levels",
+        "packed_minimum_skills", # skills_with_minimum_levels, but packed
+        "skill_states",
+        "deco_additions", # DecoAdditionsCache
+        "packed_decos", # [packed_skills], indexed by Decoration ID
+        "num_weapon_combos", # Only used for statistics.
+        "top_k",
+        "efr_ceiling",
+        "group_lookups", # {weapon_group_identification: EFRLookupTable or BatchedLookupFromSkills}, or None to look
+                         # up one weapon combination at a time.
+    ],
+)
+
+
+# Tries all weapon combinations in grouped_weapon_combos with all the armour/charm combinations in c, keeping the
+# best ctx.top_k builds.
+#
+# Returns a tuple of (top_builds, grouped_weapon_combos, num_explored). top_builds is a list of up to ctx.top_k
+# (efr, build) tuples, from highest to lowest EFR. grouped_weapon_combos is the weapon list after all of the repruning
+# we did along the way. num_explored is how many combinations from the start of c we finished with, which is all of
+# them unless deadline (a SearchDeadline) was reached.
+#
+# A build only replaces one of the top builds if its EFR is strictly higher, so if several builds tie, we keep
+# whichever ones came first in c. Once we have ctx.top_k builds, we prune by the worst of them.
+#
+# If efr_bounds is provided, it's a list of the ceiling EFR of each combination in c (see EFRCeiling.highest_efr()),
+# which must be in descending order. This lets us stop as soon as we reach a combination that can't beat our top
+# builds, since none of the combinations after it can either. We still count them as explored.
+#
+# shared_best_efr is only used by worker processes of the parallel engine. It holds the best pruning EFR found by
+# any worker so far. That EFR may have come from a later part of the full collection, so we still keep weapons whose
+# ceiling EFR exactly equals it, and leave ties to the tie-breaker in _combine_weapons_parallel().
+def _combine_weapons(c, grouped_weapon_combos, ctx, *, progress=None, efr_bounds=None, shared_best_efr=None, \
+                                deadline=None, start=0, initial_top_builds=(), checkpointer=None):
+    assert isinstance(c, CombinationColumns)
+    assert (efr_bounds is None) or (len(efr_bounds) == len(c))
+    assert isinstance(grouped_weapon_combos, list)
+    assert isinstance(ctx, _WeaponCombiningContext)
+    assert isinstance(start, int) and (0 <= start <= len(c))
+    assert len(initial_top_builds) <= ctx.top_k
+
+    skills_packer = ctx.skills_packer
+    set_bonus_subset = ctx.set_bonus_subset
+    required_set_bonus_skills = ctx.required_set_bonus_skills
+    packed_minimum_skills = ctx.packed_minimum_skills
+    skill_states = ctx.skill_states
+    deco_additions = ctx.deco_additions
+    packed_decos = ctx.packed_decos
+
+    top_k = ctx.top_k
+
+    best_efr = 1
+    top_builds = [] # Min-heap of (efr, -discovery_order, build), so the worst and most recent build gets evicted first.
+    top_builds_serialized = set() # Build.serialize() of everything in top_builds, so we never keep a build twice.
+    builds_found = 0
+    threshold_efr = 1 # A new build must strictly beat this to go into top_builds.
+
+    external_best_efr = 0.0
+
+    # If we're picking up where an earlier search left off, we start with the top builds it found in c[:start].
+    # They were all found before anything we find now, so they win EFR ties.
+    for (efr, build) in initial_top_builds:
+        builds_found += 1
+        heapq.heappush(top_builds, (efr, -builds_found, build))
+        top_builds_serialized.add(build.serialize())
+        best_efr = max(best_efr, efr)
+    if len(top_builds) == top_k:
+        threshold_efr = top_builds[0][0]
+        grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, minimum_efr_noninclusive=threshold_efr)
+    if (progress is not None) and (start > 0):
+        progress.update_and_log_progress(logger, skip=start) # STATISTICS
+
+    num_explored = start
+
+    for c_index in range(start, len(c)):
+        if (deadline is not None) and deadline.reached():
+            break
+        if (checkpointer is not None) and checkpointer.stage4_save_is_due():
+            checkpointer.save_stage4(num_explored, _sorted_top_builds(top_builds))
+
+        # Stop once nothing left can beat what we've already found (or what other workers have found).
+        if efr_bounds is not None:
+            efr_bound = efr_bounds[num_explored]
+            if ((len(top_builds) == top_k) and (efr_bound <= threshold_efr)) \
+                    or ((shared_best_efr is not None) and (efr_bound < shared_best_efr.value)):
+                if progress is not None:
+                    progress.update_and_log_progress(logger, skip=(len(c) - num_explored)) # STATISTICS
+                logger.info(f"None of the remaining {len(c) - num_explored} combinations can beat the builds found so far.")
+                num_explored = len(c)
+                break
+
+        num_explored += 1
+
+        c_packed_skills = c.get_packed_skills(c_index)
+
+        # Skip combinations that can't possibly beat what we've already found.
+        if (efr_bounds is None) and (len(top_builds) == top_k) \
+                    and (not ctx.efr_ceiling.reaches(c_packed_skills, 0, threshold_efr, inclusive=False)):
+            if progress is not None:
+                progress.update_and_log_progress(logger) # STATISTICS
+            continue
+
+        # Prune away weapon combinations that can't even match what other workers have found.
+        if shared_best_efr is not None:
+            new_external_best_efr = shared_best_efr.value
+            if new_external_best_efr > external_best_efr:
+                external_best_efr = new_external_best_efr
+                grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, \
+                                                                minimum_efr_inclusive=external_best_efr)
 
         regenerate_weapon_list = False
 
-        for ((wg_set_bonus, wg_sorted_deco_slots), weapon_combos) in grouped_weapon_combos:
+        c_set_bonuses = dict(c.get_set_bonuses_tuple(c_index))
+        c_regular_skills = skills_packer.unpack(c_packed_skills)
 
+        for (wg_identification, weapon_combos) in grouped_weapon_combos:
+
+            # Groups are sorted by their highest ceiling EFR, so if we've found good enough builds with an earlier
+            # group, we can skip the rest without waiting for the weapon list to get repruned.
+            if weapon_combos[0][4] <= threshold_efr:
+                break
+
+            (wg_set_bonus, wg_sorted_deco_slots) = wg_identification
             if wg_set_bonus not in set_bonus_subset:
                 wg_set_bonus = None
             wg_set_bonus_skills = calculate_set_bonus_skills(c_set_bonuses, wg_set_bonus)
             if not all((wg_set_bonus_skills.get(x, 0) == 1) for x in required_set_bonus_skills):
                 continue # We prune combinations that don't fulfill the required set bonus skills here.
+            wg_packed_set_bonus_skills = skills_packer.pack(wg_set_bonus_skills)
 
-            deco_it = list(_generate_deco_additions(wg_sorted_deco_slots, c_regular_skills, decos))
-            #stats_combos_explored += len(deco_it) # STATISTICS
-            for (deco_additions, d_regular_skills) in deco_it:
+            for d_decos in deco_additions.get(wg_sorted_deco_slots, c_regular_skills):
 
-                # TODO: Do I need to filter and clip here?
-                d_all_skills = defaultdict(lambda : 0, ((k, v) for (k, v) in d_regular_skills.items() if (k in skill_subset)))
-                d_all_skills = clipped_skills_defaultdict(d_all_skills)
-                assert len(set(d_all_skills) & set(wg_set_bonus_skills)) == 0
-                d_all_skills.update(wg_set_bonus_skills)
+                d_packed_skills = c_packed_skills
+                for deco in d_decos:
+                    d_packed_skills = skills_packer.add(d_packed_skills, packed_decos[deco.id])
 
-                if not all((d_all_skills.get(k, 0) >= v) for (k, v) in skills_with_minimum_levels.items()):
+                if not skills_packer.meets_minimums(skills_packer.add(d_packed_skills, wg_packed_set_bonus_skills), \
+                                                        packed_minimum_skills):
                     continue # We prune combinations that don't fulfill the required skill minimums here.
 
-                d_deco_counter = copy(c_deco_counter)
-                d_deco_counter.update(deco_additions)
+                d_all_skills = skills_packer.unpack(d_packed_skills)
+                assert len(set(d_all_skills) & set(wg_set_bonus_skills)) == 0
+                d_all_skills.update(wg_set_bonus_skills)
 
-                for (weapon, w_augments_tracker, w_upgrades_tracker, w_combo_values, _) in weapon_combos:
+                if ctx.group_lookups is None:
+                    w_candidates = _lookup_weapon_combos(weapon_combos, d_all_skills, skill_states)
+                else:
+                    # We get the same candidates in the same order as _lookup_weapon_combos(), minus the ones that
+                    # can't beat the threshold anyway. (The weapon list itself may have been repruned since the group
+                    # lookup was set up, so we skip the same weapons again by their ceiling EFRs.)
+                    w_candidates = ctx.group_lookups[wg_identification].above(d_all_skills, skill_states, \
+                                                                              threshold_efr, external_best_efr)
 
-                    if w_combo_values.skill is None:
-                        w_all_skills = d_all_skills
-                    else:
-                        w_all_skills = copy(d_all_skills)
-                        w_all_skills[w_combo_values.skill] += 1
+                for ((weapon, w_augments_tracker, w_upgrades_tracker, _, w_ceiling_efr), w_efr) in w_candidates:
+
+                    # Candidates come in the same order as weapon_combos, i.e. by ceiling EFR.
+                    if w_ceiling_efr <= threshold_efr:
+                        break
 
-                    results = lookup_from_skills(weapon, w_all_skills, skill_states, w_augments_tracker, w_upgrades_tracker)
+                    if w_efr > threshold_efr:
+                        # We only work out the combination's pieces and decos now that we know we're keeping it.
+                        # (Armour pieces are in whatever order Stage 3 added them in.)
+                        c_pieces = c.get_pieces(c_index)
+                        armour_dict = {x.armour_slot: x for x in c_pieces[1:]}
+                        d_deco_counter = c.get_deco_counter(c_index)
+                        d_deco_counter.update(d_decos)
 
-                    if results.efr > best_efr:
-                        armour_dict = {
-                                ArmourSlot.HEAD:  c_head,
-                                ArmourSlot.CHEST: c_chest,
-                                ArmourSlot.ARMS:  c_arms,
-                                ArmourSlot.WAIST: c_waist,
-                                ArmourSlot.LEGS:  c_legs,
-                            }
+                        new_build = Build(weapon, armour_dict, c_pieces[0], w_augments_tracker, w_upgrades_tracker, \
+                                                d_deco_counter)
 
-                        best_efr = results.efr
-                        associated_affinity = results.affinity
-                        associated_build = Build(weapon, armour_dict, c_charm, w_augments_tracker, w_upgrades_tracker, \
-                                                        d_deco_counter)
+                        # Combinations that only differ in which slots their decorations went in can turn into the
+                        # same build once we add the weapon's decorations.
+                        new_build_serialized = new_build.serialize()
+                        if new_build_serialized in top_builds_serialized:
+                            continue
 
                         # I don't like that we have to do this tbh, that we're accepting that we're optimizing
                         # only on a skill subset rather than the actual EFR.
-                        assert results.efr <= associated_build.calculate_performance(skill_states).efr
+                        assert w_efr <= new_build.calculate_performance(skill_states).efr
+
+                        builds_found += 1
+                        top_builds_serialized.add(new_build_serialized)
+                        if len(top_builds) < top_k:
+                            heapq.heappush(top_builds, (w_efr, -builds_found, new_build))
+                        else:
+                            (_, _, evicted_build) = heapq.heapreplace(top_builds, (w_efr, -builds_found, new_build))
+                            top_builds_serialized.remove(evicted_build.serialize())
+
+                        if len(top_builds) == top_k:
+                            threshold_efr = top_builds[0][0]
+                            regenerate_weapon_list = True
+
+                        if w_efr > best_efr:
+                            best_efr = w_efr
+                            logger.info("")
+                            logger.info(new_build.get_humanreadable(skill_states))
+                            logger.info("")
+
+        if progress is not None:
+            progress.update_and_log_progress(logger) # STATISTICS
+
+        # Prune away weapon combinations whose ceiling EFRs can't beat the worst of our top builds.
+        if regenerate_weapon_list:
+            if shared_best_efr is not None:
+                with shared_best_efr.get_lock():
+                    if threshold_efr > shared_best_efr.value:
+                        shared_best_efr.value = threshold_efr
 
-                        regenerate_weapon_list = True
+            grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, minimum_efr_noninclusive=threshold_efr)
+            new_count = sum(len(x) for (_, x) in grouped_weapon_combos)
+            logger.info(f"New number of weapon configurations: {new_count} out of {ctx.num_weapon_combos}")
 
-                        logger.info("")
-                        logger.info(associated_build.get_humanreadable(skill_states))
-                        logger.info("")
+    top_builds = _sorted_top_builds(top_builds)
+    if checkpointer is not None:
+        checkpointer.save_stage4(num_explored, top_builds)
+    return (top_builds, grouped_weapon_combos, num_explored)
 
-        progress.update_and_log_progress(logger) # STATISTICS
 
-        # Prune away weapon combinations whose ceiling EFRs are less than our best EFR.
-        if regenerate_weapon_list:
-            #old_count = len(weapon_combos)
-            grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, minimum_efr_noninclusive=best_efr)
-            new_count = sum(len(x) for (_, x) in grouped_weapon_combos)
-            logger.info(f"New number of weapon configurations: {new_count} out of {num_weapon_combos}")
+# Generates (weapon_combo, efr) for each weapon combination in weapon_combos, one lookup at a time.
+def _lookup_weapon_combos(weapon_combos, skills_dict, skill_states):
+    for weapon_combo in weapon_combos:
+        (weapon, w_augments_tracker, w_upgrades_tracker, w_combo_values, _) = weapon_combo
 
-    log_appstats_timetaken("Adding weapons", start_time, display_again=True)
+        if w_combo_values.skill is None:
+            w_all_skills = skills_dict
+        else:
+            w_all_skills = copy(skills_dict)
+            w_all_skills[w_combo_values.skill] += 1
+
+        results = lookup_from_skills(weapon, w_all_skills, skill_states, w_augments_tracker, w_upgrades_tracker)
+        yield (weapon_combo, results.efr)
+    return
+
+
+# Converts the top_builds heap in _combine_weapons() to the format it returns, i.e. a list of (efr, build), best first.
+def _sorted_top_builds(top_builds_heap):
+    return [(efr, build) for (efr, _, build) in sorted(top_builds_heap, key=lambda x : (x[0], x[1]), reverse=True)]
+
+
+# Set up by _init_weapon_combining_worker() in each worker process.
+_weapon_combining_worker_state = None
+
+
+# The same as the serial engine, except we shard c into contiguous chunks and have a pool of worker processes
+# combine weapons with each chunk. Workers publish their pruning EFR values to each other through shared memory
+# so that everyone can keep pruning their own copy of the weapon list.
+#
+# Returns a tuple of (top_builds, unexplored). top_builds is the same as for _combine_weapons(), and unexplored is
+# a CombinationColumns of the combinations in c we didn't get to because deadline (a SearchDeadline) was reached.
+#
+# This returns exactly the same builds as _combine_weapons() would. The serial engine only replaces one of its top
+# builds when it finds something strictly better, so it returns the first builds in c that achieve the highest EFRs.
+# Since chunks are contiguous, we get the same builds by breaking EFR ties in favour of the earliest chunk.
+#
+# start, initial_top_builds, and checkpointer work the same way as for _combine_weapons(). Checkpoints only cover the
+# chunks that are finished along with every chunk before them.
+def _combine_weapons_parallel(c, grouped_weapon_combos, ctx, num_workers, *, efr_bounds=None, deadline=None, start=0, \
+                                initial_top_builds=(), checkpointer=None):
+    assert isinstance(c, CombinationColumns)
+    assert isinstance(num_workers, int) and (num_workers > 1)
+    assert isinstance(start, int) and (0 <= start <= len(c))
+    assert len(initial_top_builds) <= ctx.top_k
+
+    chunk_size = max(1, ceil((len(c) - start) / (num_workers * _PARALLEL_CHUNKS_PER_WORKER)))
+    chunk_starts = list(range(start, len(c), chunk_size))
+    chunk_lengths = [min(chunk_size, len(c) - j) for j in chunk_starts]
+    chunks_iter = ((i, c[j:(j + chunk_size)], \
+                        None if (efr_bounds is None) else efr_bounds[j:(j + chunk_size)])
+                   for (i, j) in enumerate(chunk_starts))
+
+    # Builds from an earlier search were found before anything we find now, so they win EFR ties.
+    candidates = [] # [(efr, chunk_index, rank_within_chunk, serialized_build)]
+    for (i, (efr, build)) in enumerate(initial_top_builds):
+        candidates.append((efr, -1, i, build.serialize()))
+
+    shared_best_efr = mp.Value("d", 0.0)
+    if len(initial_top_builds) == ctx.top_k:
+        shared_best_efr.value = initial_top_builds[-1][0]
+        grouped_weapon_combos = _reprune_weapon_combos(grouped_weapon_combos, \
+                                                        minimum_efr_noninclusive=initial_top_builds[-1][0])
+    initargs = (grouped_weapon_combos, ctx, shared_best_efr, deadline)
+
+    num_explored_by_chunk = {}
+    num_finished_chunks = 0 # Only counts chunks that have no unfinished chunks before them.
+
+    # Different chunks can find the same build, in which case the earliest chunk's copy wins like any other tie.
+    def get_top_builds(max_chunk_index):
+        ret = []
+        seen = set()
+        for x in sorted((x for x in candidates if x[1] < max_chunk_index), key=lambda x : (-x[0], x[1], x[2])):
+            if x[3] not in seen:
+                seen.add(x[3])
+                ret.append((x[0], Build.deserialize(x[3])))
+        return ret[:ctx.top_k]
+
+    def get_num_explored():
+        if num_finished_chunks == len(chunk_starts):
+            return len(c)
+        return chunk_starts[num_finished_chunks]
+
+    progress = ExecutionProgress(f"COMBINING WEAPONS -", len(c), granularity=200)
+    if start > 0:
+        progress.update_and_log_progress(logger, skip=start) # STATISTICS
+    with mp.Pool(num_workers, initializer=_init_weapon_combining_worker, initargs=initargs) as p:
+        results_iter = p.imap_unordered(_combine_weapons_worker, chunks_iter)
+        for (chunk_index, serialized_top_builds, num_explored) in _until_interrupted(results_iter, deadline):
+            progress.update_and_log_progress(logger, skip=chunk_lengths[chunk_index]) # STATISTICS
+
+            num_explored_by_chunk[chunk_index] = num_explored
+            for (i, (efr, serialized_build)) in enumerate(serialized_top_builds):
+                candidates.append((efr, chunk_index, i, serialized_build))
+
+            while (num_finished_chunks < len(chunk_starts)) \
+                    and (num_explored_by_chunk.get(num_finished_chunks, 0) == chunk_lengths[num_finished_chunks]):
+                num_finished_chunks += 1
+            if (checkpointer is not None) and checkpointer.stage4_save_is_due():
+                checkpointer.save_stage4(get_num_explored(), get_top_builds(num_finished_chunks))
+
+    log_appstats("Weapon combining worker processes", num_workers)
+    log_appstats("Weapon combining chunks", len(chunk_starts))
+
+    if checkpointer is not None:
+        checkpointer.save_stage4(get_num_explored(), get_top_builds(num_finished_chunks))
+
+    unexplored_indices = []
+    for (i, j) in enumerate(chunk_starts):
+        unexplored_indices.extend(range(j + num_explored_by_chunk.get(i, 0), j + chunk_lengths[i]))
+    unexplored = c.subset(unexplored_indices)
+
+    return (get_top_builds(len(chunk_starts)), unexplored)
+
+
+def _init_weapon_combining_worker(grouped_weapon_combos, ctx, shared_best_efr, deadline):
+    global _weapon_combining_worker_state
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The main process decides what to do about interrupts.
+    _weapon_combining_worker_state = [grouped_weapon_combos, ctx, shared_best_efr, deadline]
+    return
+
+
+def _combine_weapons_worker(args):
+    (chunk_index, chunk, efr_bounds) = args
+    (grouped_weapon_combos, ctx, shared_best_efr, deadline) = _weapon_combining_worker_state
+
+    (top_builds, grouped_weapon_combos, num_explored) = _combine_weapons(chunk, grouped_weapon_combos, ctx, \
+                                                                efr_bounds=efr_bounds, shared_best_efr=shared_best_efr, \
+                                                                deadline=deadline)
+
+    # We hold onto our repruned weapon list for the next chunk. Workers receive chunks in order, so any later chunk
+    # would lose an EFR tie against this one anyway.
+    _weapon_combining_worker_state[0] = grouped_weapon_combos
+
+    return (chunk_index, [(efr, build.serialize()) for (efr, build) in top_builds], num_explored)
+
+
+# Pieces in combinations (i.e. charms and armour pieces) can't be pickled as-is since armour pieces refer back to
+# their entire armour set. We instead send them as database keys.
+def _piece_to_key(piece):
+    return piece.id if isinstance(piece, CharmInfo) else _armour_piece_to_key(piece)
+
+
+def _piece_from_key(key):
+    return charms_db[key] if isinstance(key, str) else _armour_piece_from_key(key)
+
+
+# Piece combinations are the tuples of (piece, decos, packed_skills, set_bonus) generated by
+# _generate_slot_combinations().
+def _piece_combination_to_picklable(piece_combination):
+    (piece, decos, packed_skills, set_bonus) = piece_combination
+    return (_armour_piece_to_key(piece), decos, packed_skills, set_bonus)
+
+
+def _piece_combination_from_picklable(picklable_piece_combination):
+    (piece_key, decos, packed_skills, set_bonus) = picklable_piece_combination
+    return (_armour_piece_from_key(piece_key), decos, packed_skills, set_bonus)
+
+
+def _armour_piece_to_key(piece):
+    assert isinstance(piece, ArmourPieceInfo)
+    armour_set = piece.armour_set
+    # ArmourVariant members can't be pickled (their values are namedtuples that can't be looked up by name), so we
+    # just send enum names.
+    return (armour_set.set_name, armour_set.discriminator.name, piece.armour_set_variant.name, piece.armour_slot.name)
 
-    return associated_build
 
+def _armour_piece_from_key(key):
+    (set_name, discriminator_name, variant_name, slot_name) = key
+    armour_set = armour_db[(set_name, ArmourDiscriminator[discriminator_name])]
+    return armour_set.variants[ArmourVariant[variant_name]][ArmourSlot[slot_name]]
 
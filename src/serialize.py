@@ -21,6 +21,8 @@ from .utils import all_unique, json_dumps_formatted
 from .database_weapons     import WeaponClass
 from .database_skills      import Skill
 
+from .builds import NUMPY_AVAILABLE
+
 
 def writejson_search_parameters(**kwargs):
 
@@ -35,6 +37,20 @@ def writejson_search_parameters(**kwargs):
 
     skill_states              = kwargs["skill_states"]
 
+    # KWARGS: Search Engine Options
+
+    num_worker_processes      = kwargs.get("num_worker_processes", 1)
+    top_k                     = kwargs.get("top_k", 1)
+    time_budget_seconds       = kwargs.get("time_budget_seconds", None)
+    meet_in_the_middle        = kwargs.get("meet_in_the_middle", False)
+    vectorized_weapon_evaluation = kwargs.get("vectorized_weapon_evaluation", False)
+    precomputed_efr_tables    = kwargs.get("precomputed_efr_tables", False)
+    stage3_cache_budget_mb    = kwargs.get("stage3_cache_budget_mb", None)
+    checkpoint_filename       = kwargs.get("checkpoint_filename", None)
+    checkpoint_interval_seconds = kwargs.get("checkpoint_interval_seconds", 300)
+    warm_start_build_filename = kwargs.get("warm_start_build_filename", None)
+    result_cache_directory    = kwargs.get("result_cache_directory", None)
+
     assert isinstance(selected_armour_tier, Tier) or (selected_armour_tier is None)
     assert isinstance(selected_weapon_class, WeaponClass)
     assert all(isinstance(k, Skill) and isinstance(v, int) and (v >= 0) for (k, v) in selected_skills.items())
@@ -44,6 +60,17 @@ def writejson_search_parameters(**kwargs):
 
     assert all(isinstance(k, Skill) and isinstance(v, int) and (v >= 0) for (k, v) in skill_states.items())
 
+    assert isinstance(num_worker_processes, int) and (num_worker_processes >= 1)
+    assert isinstance(top_k, int) and (top_k >= 1)
+    assert (time_budget_seconds is None) or (isinstance(time_budget_seconds, (int, float)) and (time_budget_seconds > 0))
+    assert isinstance(meet_in_the_middle, bool)
+    assert isinstance(vectorized_weapon_evaluation, bool)
+    assert isinstance(precomputed_efr_tables, bool)
+    assert (stage3_cache_budget_mb is None) or (isinstance(stage3_cache_budget_mb, (int, float)) and (stage3_cache_budget_mb > 0))
+    assert (checkpoint_filename is None) or isinstance(checkpoint_filename, str)
+    assert isinstance(checkpoint_interval_seconds, (int, float)) and (checkpoint_interval_seconds > 0)
+    assert (warm_start_build_filename is None) or isinstance(warm_start_build_filename, str)
+    assert (result_cache_directory is None) or isinstance(result_cache_directory, str)
 
     data = {
             "selected_armour_tier"      : selected_armour_tier,
@@ -54,6 +81,23 @@ def writejson_search_parameters(**kwargs):
             "min_health_regen_augment_level": min_health_regen_level,
 
             "skill_states": {k.name: v for (k, v) in skill_states.items()},
+
+            "num_worker_processes": num_worker_processes,
+            "top_k"               : top_k,
+            "time_budget_seconds" : time_budget_seconds,
+            "meet_in_the_middle"  : meet_in_the_middle,
+
+            "vectorized_weapon_evaluation": vectorized_weapon_evaluation,
+            "precomputed_efr_tables"      : precomputed_efr_tables,
+
+            "stage3_cache_budget_mb": stage3_cache_budget_mb,
+
+            "checkpoint_filename"        : checkpoint_filename,
+            "checkpoint_interval_seconds": checkpoint_interval_seconds,
+
+            "warm_start_build_filename": warm_start_build_filename,
+
+            "result_cache_directory": result_cache_directory,
         }
     return json_dumps_formatted(data)
 
@@ -69,6 +113,22 @@ SearchParameters = namedtuple(
         "min_health_regen_augment_level",
 
         "skill_states",
+
+        "num_worker_processes",
+        "top_k",
+        "time_budget_seconds", # None means no time limit.
+        "meet_in_the_middle", # If True, Stage 3 combines two halves of the armour slots separately, then joins them.
+        "vectorized_weapon_evaluation", # If True, Stage 4 uses NumPy to calculate EFRs for many weapons at once.
+        "precomputed_efr_tables", # If True, Stage 4 looks up EFRs from tables precomputed for every skill level.
+        "stage3_cache_budget_mb", # None means Stage 3 keeps everything it caches in memory. (This doesn't cap Stage 3's
+                                  # peak memory. See _find_highest_efr_builds().)
+
+        "checkpoint_filename", # None means we don't save checkpoints.
+        "checkpoint_interval_seconds",
+
+        "warm_start_build_filename", # None means we start the search from scratch.
+
+        "result_cache_directory", # None means we don't cache search results.
     ]
 )
 def readjson_search_parameters(json_str):
@@ -86,6 +146,26 @@ def readjson_search_parameters(json_str):
 
     skill_states_json              = json_data["skill_states"]
 
+    # Get Data: Search Engine Options
+    # (These are all optional.)
+
+    num_worker_processes_json      = json_data.get("num_worker_processes", 1)
+    top_k_json                     = json_data.get("top_k", 1)
+    time_budget_seconds_json       = json_data.get("time_budget_seconds", None)
+    meet_in_the_middle_json        = json_data.get("meet_in_the_middle", False)
+
+    vectorized_weapon_evaluation_json = json_data.get("vectorized_weapon_evaluation", False)
+    precomputed_efr_tables_json       = json_data.get("precomputed_efr_tables", False)
+
+    stage3_cache_budget_mb_json      = json_data.get("stage3_cache_budget_mb", None)
+
+    checkpoint_filename_json         = json_data.get("checkpoint_filename", None)
+    checkpoint_interval_seconds_json = json_data.get("checkpoint_interval_seconds", 300)
+
+    warm_start_build_filename_json   = json_data.get("warm_start_build_filename", None)
+
+    result_cache_directory_json      = json_data.get("result_cache_directory", None)
+
     # Translate Data
 
     selected_armour_tier = None if selected_armour_tier_json is None else Tier[selected_armour_tier_json]
@@ -99,6 +179,23 @@ def readjson_search_parameters(json_str):
             min_health_regen_augment_level = min_health_regen_json,
 
             skill_states = {Skill[k]: v for (k, v) in skill_states_json.items()},
+
+            num_worker_processes = num_worker_processes_json,
+            top_k                = top_k_json,
+            time_budget_seconds  = time_budget_seconds_json,
+            meet_in_the_middle   = meet_in_the_middle_json,
+
+            vectorized_weapon_evaluation = vectorized_weapon_evaluation_json,
+            precomputed_efr_tables       = precomputed_efr_tables_json,
+
+            stage3_cache_budget_mb = stage3_cache_budget_mb_json,
+
+            checkpoint_filename         = checkpoint_filename_json,
+            checkpoint_interval_seconds = checkpoint_interval_seconds_json,
+
+            warm_start_build_filename = warm_start_build_filename_json,
+
+            result_cache_directory = result_cache_directory_json,
         )
 
     # Data Validation
@@ -108,6 +205,40 @@ def readjson_search_parameters(json_str):
         raise ValueError("Selected skill levels must be integers above or equal to zero.")
     elif any((not isinstance(v, int)) or (v < 0) or (v >= len(k.value.states)) for (k, v) in tup.skill_states.items()):
         raise ValueError("Skill states must be integers above or equal to zero.")
+    elif (not isinstance(tup.num_worker_processes, int)) or isinstance(tup.num_worker_processes, bool) \
+                or (tup.num_worker_processes < 1):
+        raise ValueError("The number of worker processes must be an integer above or equal to one.")
+    elif (not isinstance(tup.top_k, int)) or isinstance(tup.top_k, bool) or (tup.top_k < 1):
+        raise ValueError("The number of builds to find (top_k) must be an integer above or equal to one.")
+    elif (tup.time_budget_seconds is not None) and ((not isinstance(tup.time_budget_seconds, (int, float))) \
+                                                        or isinstance(tup.time_budget_seconds, bool) \
+                                                        or (tup.time_budget_seconds <= 0)):
+        raise ValueError("The time budget (time_budget_seconds) must be a number above zero, or null for no limit.")
+    elif not isinstance(tup.meet_in_the_middle, bool):
+        raise ValueError("meet_in_the_middle must be true or false.")
+    elif not isinstance(tup.vectorized_weapon_evaluation, bool):
+        raise ValueError("vectorized_weapon_evaluation must be true or false.")
+    elif tup.vectorized_weapon_evaluation and (not NUMPY_AVAILABLE):
+        raise ValueError("vectorized_weapon_evaluation needs NumPy to be installed.")
+    elif not isinstance(tup.precomputed_efr_tables, bool):
+        raise ValueError("precomputed_efr_tables must be true or false.")
+    elif (tup.stage3_cache_budget_mb is not None) and ((not isinstance(tup.stage3_cache_budget_mb, (int, float))) \
+                                                           or isinstance(tup.stage3_cache_budget_mb, bool) \
+                                                           or (tup.stage3_cache_budget_mb <= 0)):
+        raise ValueError("The Stage 3 cache budget (stage3_cache_budget_mb) must be a number above zero, or null " \
+                         "for no limit.")
+    elif (tup.checkpoint_filename is not None) and (not isinstance(tup.checkpoint_filename, str)):
+        raise ValueError("The checkpoint filename (checkpoint_filename) must be a string, or null to not save checkpoints.")
+    elif (not isinstance(tup.checkpoint_interval_seconds, (int, float))) \
+                or isinstance(tup.checkpoint_interval_seconds, bool) \
+                or (tup.checkpoint_interval_seconds <= 0):
+        raise ValueError("The checkpoint interval (checkpoint_interval_seconds) must be a number above zero.")
+    elif (tup.warm_start_build_filename is not None) and (not isinstance(tup.warm_start_build_filename, str)):
+        raise ValueError("The warm start build filename (warm_start_build_filename) must be a string, or null to " \
+                         "start the search from scratch.")
+    elif (tup.result_cache_directory is not None) and (not isinstance(tup.result_cache_directory, str)):
+        raise ValueError("The result cache directory (result_cache_directory) must be a string, or null to not cache " \
+                         "search results.")
 
     return tup
 
@@ -5,47 +5,89 @@ Filename: unit_testing.py
 Author:   contact@simshadows.com
 """
 
+import json
 import time
 import sys
 import logging
+import pickle
+import os
+import tempfile
+import subprocess
 from copy import copy
 
 from collections import namedtuple, defaultdict, Counter
 
-from .builds       import (Build,
+from .builds       import (NUMPY_AVAILABLE,
+                          Build,
+                          BatchedLookupFromSkills,
+                          EFRLookupGrid,
+                          EFRLookupTable,
                           lookup_from_skills,
                           lookup_from_skills_multiple_states)
-from .search       import _generate_deco_additions
-from .utils        import subtract_deco_slots
+from .search       import (SeenSetBySSB,
+                          DecoAdditionsCache,
+                          CombinationColumns,
+                          EFRCeiling,
+                          SearchResultCache,
+                          _generate_deco_additions,
+                          _generate_slot_combinations, # For testing.
+                          _add_armour_slot, # For testing.
+                          _combine_armour_meet_in_the_middle, # For testing.
+                          _reprune_weapon_combos,
+                          _WeaponCombiningContext, # For testing.
+                          _combine_weapons, # For testing.
+                          _combine_weapons_parallel, # For testing.
+                          _get_search_result_cache_key, # For testing.
+                          _load_warm_start_build) # For testing.
+from .serialize    import readjson_search_parameters
+from .enums        import Tier
+from .utils        import subtract_deco_slots, prune_by_superceding, json_read
 
 from .database_armour      import (ArmourDiscriminator,
                                   ArmourVariant,
                                   ArmourSlot,
-                                  armour_db)
+                                  armour_db,
+                                  easyiterate_armour)
 from .database_charms      import (charms_db,
                                   charms_indexed_by_skill)
-from .database_decorations import Decoration
+from .database_decorations import (Decoration,
+                                  decoration_slot_sizes,
+                                  decoration_skills)
 from .database_misc        import (POWERCHARM_ATTACK_POWER,
                                   POWERTALON_ATTACK_POWER)
-from .database_skills      import Skill
+from .database_skills      import (Skill,
+                                  SetBonus,
+                                  skill_extended_limits,
+                                  set_bonus_stages)
 from .database_weapons     import (WeaponAugmentationScheme,
                                   WeaponUpgradeScheme,
                                   WeaponClass,
-                                  weapon_db)
+                                  WeaponDatabase,
+                                  weapon_db,
+                                  WEAPONS_DATA_FILENAME,
+                                  _obtain_weapon_class_index) # For testing.
 
 from .query_armour      import (_armour_piece_supercedes, # For testing.
+                               prune_easyiterate_armour_db,
                                calculate_armour_contribution)
-from .query_charms      import calculate_skills_dict_from_charm
-from .query_decorations import calculate_decorations_skills_contribution
-from .query_skills      import (clipped_skills_defaultdict,
+from .query_charms      import (get_charms_subset,
+                               calculate_skills_dict_from_charm)
+from .query_decorations import (get_pruned_deco_set,
+                               calculate_decorations_skills_contribution)
+from .query_skills      import (skills_affecting_efr,
+                               clipped_skills_defaultdict,
+                               calculate_possible_set_bonus_combos,
+                               relax_set_bonus_combos,
                                calculate_set_bonus_skills,
-                               calculate_skills_contribution)
+                               calculate_skills_contribution,
+                               SkillsPacker)
 from .query_weapons     import (WeaponAugmentTracker,
                                IBWeaponAugmentType,
                                WeaponUpgradeTracker,
                                IBCWeaponUpgradeType,
                                SafiWeaponStandardUpgradeType,
-                               SafiWeaponSetBonusUpgradeType)
+                               SafiWeaponSetBonusUpgradeType,
+                               calculate_final_weapon_values)
 
 
 logger = logging.getLogger(__name__)
@@ -55,9 +97,20 @@ def run_tests():
     logger.info("Running unit tests.")
 
     _run_tests_lookup()
+    _run_tests_batched_lookup()
     _run_tests_armour_pruning()
     _run_tests_serializing()
     _run_tests_deco_list_generation()
+    _run_tests_skills_packing()
+    _run_tests_seen_set()
+    _run_tests_stage3_engines()
+    _run_tests_weapon_repruning()
+    _run_tests_top_builds_distinct()
+    _run_tests_search_parameters_validation()
+    _run_tests_search_result_cache_key()
+    _run_tests_warm_start_build()
+    _run_tests_weapon_db()
+    _run_tests_database_ids()
 
     logger.info("")
     logger.info("All unit tests passed.")
@@ -753,6 +806,42 @@ def _run_tests_armour_pruning():
     test_not_supercedes_in_reverse("LEGS", "Yian Garuga", "MASTER_RANK", "MR_BETA_PLUS", "Yian Garuga", "MASTER_RANK", \
                                     "MR_ALPHA_PLUS", skill_subset={Skill.CRITICAL_EYE,})
 
+    logger.info("Checking that pruning with the armour indexes gives the same pieces as pruning the whole list.")
+
+    def prune_without_indexes(selected_armour_tier, skill_subset):
+        ret = {}
+        for (gear_slot, piece_list) in easyiterate_armour.items():
+            if selected_armour_tier is not None:
+                piece_list = [x for x in piece_list if (x.armour_set.discriminator.value.tier is selected_armour_tier)]
+            def left_supercedes_right(piece1, piece2):
+                return _armour_piece_supercedes(piece1, piece1.armour_set.set_bonus, piece2, piece2.armour_set.set_bonus, \
+                                                skill_subset=skill_subset)
+            ret[gear_slot] = prune_by_superceding(piece_list, left_supercedes_right)
+        return ret
+
+    for (selected_armour_tier, skill_subset) in [
+                (Tier.MASTER_RANK, {Skill.AGITATOR, Skill.FOCUS, Skill.WEAKNESS_EXPLOIT, Skill.FROSTCRAFT}),
+                (Tier.MASTER_RANK, {Skill.CRITICAL_EYE}),
+                (Tier.HIGH_RANK, {Skill.ATTACK_BOOST, Skill.CRITICAL_BOOST}),
+                (None, {Skill.HANDICRAFT}),
+            ]:
+        expected = prune_without_indexes(selected_armour_tier, skill_subset)
+        result = prune_easyiterate_armour_db(selected_armour_tier, easyiterate_armour, skill_subset=skill_subset)
+        for gear_slot in ArmourSlot:
+            if [id(x) for x in result[gear_slot]] != [id(x) for x in expected[gear_slot]]:
+                def piece_names(pieces):
+                    return [f"{x.armour_set.set_name} {x.armour_set_variant.name}" for x in pieces]
+                missing = piece_names(x for x in expected[gear_slot] if all((x is not y) for y in result[gear_slot]))
+                extra = piece_names(x for x in result[gear_slot] if all((x is not y) for y in expected[gear_slot]))
+                if (len(missing) == 0) and (len(extra) == 0):
+                    difference = "The same pieces were kept, but in a different order."
+                else:
+                    difference = f"Missing: {missing}. Extra: {extra}."
+                tier_name = "no tier" if (selected_armour_tier is None) else selected_armour_tier.name
+                raise ValueError(f"Armour pruning test failed for {gear_slot.name} ({tier_name}, skills " \
+                                 f"{sorted(x.name for x in skill_subset)}). Pruning with the indexes kept " \
+                                 f"{len(result[gear_slot])} pieces rather than {len(expected[gear_slot])}. {difference}")
+
     return True
 
 
@@ -814,6 +903,49 @@ def _run_tests_serializing():
         raise ValueError(f"Test failed. Got {original_results.efr} EFR.")
     if original_results.affinity != 54:
         raise ValueError(f"Test failed. Got {original_results.affinity} affinity.")
+
+    # Now, we test the search combinations sent to worker processes.
+
+    pieces = [charm] + [armour_dict[x] for x in ArmourSlot]
+    skills_packer = SkillsPacker({Skill.AGITATOR, Skill.CRITICAL_EYE})
+    packed_skills = skills_packer.pack({Skill.AGITATOR: 2})
+    combination = (pieces, Counter(decos), packed_skills, defaultdict(lambda : 0))
+    collection = CombinationColumns(skills_packer, len(pieces), [combination])
+    new_collection = pickle.loads(pickle.dumps(collection))
+    if len(new_collection) != 1:
+        raise ValueError("Test failed. Expected one combination.")
+    new_combination = new_collection[0]
+
+    if any((x is not y) for (x, y) in zip(combination[0], new_combination[0])):
+        raise ValueError("Test failed. Pieces don't match.")
+    if (combination[1] != new_combination[1]) or (combination[2] != new_combination[2]):
+        raise ValueError("Test failed. Decorations or skills don't match.")
+    if new_combination[3][SetBonus.TEOSTRA_TECHNIQUE] != 0:
+        raise ValueError("Test failed. Expected a defaultdict for set bonuses.")
+
+    # A collection made by adding an armour slot only refers back to its parent, so we check that we get the same
+    # combination from it, both directly and after pickling, and again after moving its columns to disk.
+
+    parent_collection = CombinationColumns(skills_packer, len(pieces) - 1, \
+                                            [(pieces[:-1], Counter(decos[:-1]), 0, defaultdict(lambda : 0))])
+    piece_combos = [(pieces[-1], (decos[-1],), packed_skills, None)]
+    collection = CombinationColumns.from_additions(parent_collection, piece_combos, [(0, 0, packed_skills, ())])
+    for spill in [False, True]:
+        if spill and (collection.spill_to_disk() == 0):
+            raise ValueError("Test failed. spill_to_disk() didn't move any columns of a collection made with " \
+                             "from_additions() to disk.")
+        where = "after moving columns to disk" if spill else "in memory"
+        for (how, new_combination) in [("directly", collection[0]), \
+                                        ("after pickling", pickle.loads(pickle.dumps(collection))[0])]:
+            if (len(new_combination[0]) != len(pieces)) or any((x is not y) for (x, y) in zip(pieces, new_combination[0])):
+                mismatches = [i for (i, (x, y)) in enumerate(zip(pieces, new_combination[0])) if (x is not y)]
+                raise ValueError(f"Test failed. Pieces don't match after adding an armour slot ({where}, {how}). " \
+                                 f"Expected {len(pieces)} pieces. Got {len(new_combination[0])}, differing at " \
+                                 f"positions {mismatches}.")
+            if (combination[1] != new_combination[1]) or (combination[2] != new_combination[2]):
+                raise ValueError(f"Test failed. Decorations or skills don't match after adding an armour slot " \
+                                 f"({where}, {how}). Expected {(combination[1], combination[2])}. " \
+                                 f"Got {(new_combination[1], new_combination[2])}.")
     
     return True
 
@@ -846,12 +978,18 @@ def _run_tests_deco_list_generation():
     decos_maxsize4 = decos_size4 + decos_maxsize3
     decos = [decos_size1, decos_maxsize2, decos_maxsize3, decos_maxsize4]
 
+    deco_additions_cache = DecoAdditionsCache(decos, max_size=2)
+
     def check_length(expected_length):
         x = _generate_deco_additions(slots, defaultdict(lambda : 0, skills), decos)
         #print("\n".join("[" + ", ".join(f"\"{y.name}\"" for y in deco_combo[0]) + "]" for deco_combo in x))
         #print()
         if len(x) != expected_length:
             raise ValueError(f"Expected {expected_length} results. Instead got {len(x)}.")
+        # The cache should give the same decorations, in the same order, whether or not it's a hit.
+        for _ in range(2):
+            if deco_additions_cache.get(slots, skills) != tuple(tuple(deco_combo[0]) for deco_combo in x):
+                raise ValueError("Cached deco additions don't match.")
 
     slots = []
     skills = {}
@@ -873,6 +1011,11 @@ def _run_tests_deco_list_generation():
 
     check_length(12)
 
+    slots = [1, 2]
+    skills = {Skill.HANDICRAFT: 9} # Unrelated skills and levels past the limits shouldn't matter.
+
+    check_length(12)
+
     #slots = [3, 2, 1]
     #skills = {}
 
@@ -882,8 +1025,638 @@ def _run_tests_deco_list_generation():
     
     return True
 
+def _run_tests_batched_lookup():
+    logger.info("Testing batched lookups and EFR lookup tables.")
+
+    weapon_names = ["ACID_SHREDDER_II", "ROYAL_VENUS_BLADE", "IMMOVABLE_DHARMA", "GREAT_DEMON_ROD", \
+                    "JAGRAS_DEATHCLAW_II", "SAFI_SHATTERSPLITTER"]
+    weapon_combos = []
+    for weapon_name in weapon_names:
+        weapon = weapon_db[weapon_name]
+        for augments_tracker in WeaponAugmentTracker.get_maximized_trackers(weapon, health_regen_minimum=0):
+            for upgrades_tracker in WeaponUpgradeTracker.get_maximized_trackers_pruned(weapon):
+                weapon_combos.append((weapon, augments_tracker, upgrades_tracker))
+    assert len(weapon_combos) > len(weapon_names)
+
+    skill_states_dict = {Skill.AGITATOR: 1, Skill.PEAK_PERFORMANCE: 1, Skill.WEAKNESS_EXPLOIT: 2}
+
+    def get_expected_efrs(skills_dict):
+        ret = []
+        for (weapon, augments_tracker, upgrades_tracker) in weapon_combos:
+            weapon_skill = calculate_final_weapon_values(weapon, augments_tracker, upgrades_tracker).skill
+            w_skills_dict = copy(skills_dict)
+            if weapon_skill is not None:
+                w_skills_dict[weapon_skill] = w_skills_dict.get(weapon_skill, 0) + 1
+            results = lookup_from_skills(weapon, w_skills_dict, skill_states_dict, augments_tracker, upgrades_tracker)
+            ret.append(results.efr)
+        return ret
+
+    # We expect exactly the same values as lookup_from_skills() since we do the same calculations in the same order.
+    def check_lookup(name, get_efrs, get_above, skills_dict):
+        expected_efrs = get_expected_efrs(skills_dict)
+        if list(get_efrs(skills_dict)) != expected_efrs:
+            raise ValueError(f"Test failed. {name} EFR values don't match lookup_from_skills() for {skills_dict}.")
+
+        minimum_efr = sorted(expected_efrs)[len(expected_efrs) // 2]
+        expected_above = [(x, efr) for (x, efr) in zip(weapon_combos, expected_efrs) if (efr > minimum_efr)]
+        if get_above(skills_dict, skill_states_dict, minimum_efr) != expected_above:
+            raise ValueError(f"Test failed. {name} returned the wrong weapon combinations above {minimum_efr} EFR " \
+                             f"for {skills_dict}.")
+
+    # NumPy should only be imported once a batched lookup is used. (We check this in a fresh interpreter since we might
+    # have already imported it in this one.)
+    code = "import sys, src.search; sys.exit(int('numpy' in sys.modules))"
+    repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if subprocess.run([sys.executable, "-c", code], cwd=repo_directory).returncode != 0:
+        raise ValueError("Test failed. Importing the search module also imported NumPy.")
+
+    if NUMPY_AVAILABLE:
+        batched_lookup = BatchedLookupFromSkills(weapon_combos)
+        skills_dicts = [
+                {},
+                {Skill.HANDICRAFT: 2, Skill.CRITICAL_EYE: 4},
+                {Skill.HANDICRAFT: 5, Skill.CRITICAL_BOOST: 3, Skill.ATTACK_BOOST: 7, Skill.NON_ELEMENTAL_BOOST: 1},
+                {Skill.AGITATOR: 5, Skill.PEAK_PERFORMANCE: 3, Skill.WEAKNESS_EXPLOIT: 3, Skill.CRITICAL_BOOST: 1},
+            ]
+        for skills_dict in skills_dicts:
+            check_lookup("Batched lookup", lambda d : batched_lookup.efrs(d, skill_states_dict), batched_lookup.above, \
+                            skills_dict)
+    else:
+        logger.info("Skipping batched lookup tests since NumPy isn't installed.")
+
+    # We keep the EFR lookup table's grid small since it grows exponentially with the number of skills.
+    # FOCUS doesn't affect EFR, so it shouldn't get an axis.
+    table_skills = {Skill.HANDICRAFT, Skill.CRITICAL_BOOST, Skill.FOCUS}
+    efr_lookup_grid = EFRLookupGrid(weapon_combos, table_skills, skill_states_dict)
+    efr_lookup_table = EFRLookupTable(weapon_combos, efr_lookup_grid)
+    skills_dicts = [
+            {},
+            {Skill.HANDICRAFT: 2},
+            {Skill.HANDICRAFT: 5, Skill.CRITICAL_BOOST: 3, Skill.FOCUS: 3},
+            {Skill.HANDICRAFT: 3, Skill.CRITICAL_BOOST: 1},
+        ]
+    for skills_dict in skills_dicts:
+        check_lookup("EFR lookup table", lambda d : [efr_lookup_table.efr(d, i) for i in range(len(weapon_combos))], \
+                        efr_lookup_table.above, skills_dict)
+
+    # Now, we try the skills, skill minimums, and skill states of a real search. (search1_mt_hb3.json's EFR lookup
+    # tables used to be far too big to use at all.)
+    with open("search1_mt_hb3.json", encoding="utf-8") as f:
+        s = readjson_search_parameters(f.read())
+    set_bonus_subset = {x for combo in calculate_possible_set_bonus_combos(s.selected_set_bonus_skills) for x in combo}
+    table_skills = set(s.selected_skills) | {x for y in set_bonus_subset for x in y.value.stages.values()}
+    minimum_levels = {k: v for (k, v) in s.selected_skills.items() if (v > 0)}
+    skill_states_dict = s.skill_states
+
+    efr_lookup_grid = EFRLookupGrid(weapon_combos, table_skills, skill_states_dict, minimum_levels)
+
+    # Every level of every skill up to its extended limit would be 10 times bigger.
+    full_grid_size = len(weapon_combos)
+    for skill in table_skills & skills_affecting_efr:
+        full_grid_size *= skill.value.extended_limit + 1
+    if efr_lookup_grid.get_table_size(weapon_combos) * 10 > full_grid_size:
+        raise ValueError(f"Test failed. EFR lookup tables for search1_mt_hb3.json would need " \
+                         f"{efr_lookup_grid.get_table_size(weapon_combos)} entries for {len(weapon_combos)} " \
+                         f"weapon combinations.")
+
+    # Building a table for all of the weapon combinations would take too long, so we only use a few of them.
+    weapon_combos = weapon_combos[::(len(weapon_combos) // 20)]
+    efr_lookup_table = EFRLookupTable(weapon_combos, efr_lookup_grid)
+    skills_dicts = [
+            minimum_levels,
+            {**minimum_levels, Skill.AGITATOR: 5, Skill.ATTACK_BOOST: 3, Skill.WEAKNESS_EXPLOIT: 3},
+            {**minimum_levels, Skill.AGITATOR: 7, Skill.ATTACK_BOOST: 7, Skill.CRITICAL_EYE: 7, Skill.HANDICRAFT: 5},
+            {**minimum_levels, Skill.CRITICAL_EYE: 2, Skill.HANDICRAFT: 1, Skill.NON_ELEMENTAL_BOOST: 1},
+        ]
+    for skills_dict in skills_dicts:
+        check_lookup("search1_mt_hb3.json EFR lookup table", \
+                        lambda d : [efr_lookup_table.efr(d, i) for i in range(len(weapon_combos))], \
+                        efr_lookup_table.above, skills_dict)
+    return
+
+
+def _run_tests_skills_packing():
+    logger.info("")
+
+    packer = SkillsPacker({Skill.AGITATOR, Skill.CRITICAL_EYE, Skill.NON_ELEMENTAL_BOOST, Skill.WEAKNESS_EXPLOIT})
+
+    def skills_str(skills_dict):
+        return "{" + ", ".join(f"{k.name}: {v}" for (k, v) in skills_dict.items()) + "}"
+
+    def check_skills(packed, expected_skills, what):
+        skills = dict(packer.unpack(packed))
+        if skills != expected_skills:
+            raise ValueError(f"Test failed. Expected {what} to be {skills_str(expected_skills)}. Got {skills_str(skills)}.")
+
+    # Skills outside of the subset are dropped, and levels are clipped.
+    x = packer.pack({Skill.AGITATOR: 3, Skill.CRITICAL_EYE: 9, Skill.HANDICRAFT: 2})
+    check_skills(x, {Skill.AGITATOR: 3, Skill.CRITICAL_EYE: 7}, "packed skills with levels past the limit")
+
+    y = packer.pack({Skill.AGITATOR: 6, Skill.NON_ELEMENTAL_BOOST: 1, Skill.WEAKNESS_EXPLOIT: 2})
+    check_skills(packer.add(x, y), {Skill.AGITATOR: 7, Skill.CRITICAL_EYE: 7, Skill.NON_ELEMENTAL_BOOST: 1, \
+                                    Skill.WEAKNESS_EXPLOIT: 2}, "x + y")
+    check_skills(packer.add(y, y), {Skill.AGITATOR: 7, Skill.NON_ELEMENTAL_BOOST: 1, Skill.WEAKNESS_EXPLOIT: 3}, "y + y")
+
+    if packer.total_level(x) != 10:
+        raise ValueError("Test failed. Wrong total level.")
+    if packer.level(y, Skill.AGITATOR) != 6:
+        raise ValueError("Test failed. Wrong skill level.")
+
+    minimums = packer.pack({Skill.AGITATOR: 3})
+    if (not packer.meets_minimums(x, minimums)) or (not packer.meets_minimums(y, minimums)):
+        raise ValueError("Test failed. Skill minimums should be met.")
+    if packer.meets_minimums(x, y) or packer.meets_minimums(packer.pack({}), minimums):
+        raise ValueError("Test failed. Skill minimums shouldn't be met.")
+
+    if packer.levels(x) != (3, 7, 0, 0): # Fields are ordered by skill name.
+        raise ValueError(f"Test failed. Got levels {packer.levels(x)}.")
+
+    check_skills(packer.min(x, y), {Skill.AGITATOR: 3}, "min(x, y)")
+    check_skills(packer.headroom(x), {Skill.AGITATOR: 4, Skill.NON_ELEMENTAL_BOOST: 1, Skill.WEAKNESS_EXPLOIT: 3}, \
+                    "the headroom of x")
+    clipped_sum = packer.add(x, packer.min(y, packer.headroom(x)))
+    if clipped_sum != packer.add(x, y):
+        raise ValueError(f"Test failed. Adding y clipped to the headroom of x gave " \
+                         f"{skills_str(packer.unpack(clipped_sum))} rather than x + y.")
+
+    return True
+
+
+def _run_tests_seen_set():
+    logger.info("")
+
+    packer = SkillsPacker({Skill.AGITATOR, Skill.CRITICAL_EYE})
+    seen_set = SeenSetBySSB(packer)
+
+    def check_items(expected):
+        if seen_set.items_as_list() != expected:
+            raise ValueError(f"Test failed. Expected the seen-set to keep {expected}. Got {seen_set.items_as_list()}.")
+
+    def add(skills_dict, set_bonuses_dict, object_to_store, **kwargs):
+        seen_set.add(packer.pack(skills_dict), Counter(set_bonuses_dict), object_to_store, **kwargs)
+
+    tt = SetBonus.TEOSTRA_TECHNIQUE
+
+    add({Skill.AGITATOR: 2, Skill.CRITICAL_EYE: 1}, {}, "a")
+    add({Skill.AGITATOR: 2, Skill.CRITICAL_EYE: 1}, {}, "b") # Equal to "a", so the first one wins.
+    add({Skill.AGITATOR: 1}, {}, "c") # Beaten by "a".
+    add({Skill.CRITICAL_EYE: 2}, {}, "d") # Neither beats the other.
+    check_items(["a", "d"])
+
+    add({Skill.AGITATOR: 1}, {tt: 1}, "e", keep_if=(lambda x : False)) # Not beaten, but thrown away.
+    add({Skill.AGITATOR: 3, Skill.CRITICAL_EYE: 2}, {tt: 1}, "f") # Beats everything so far.
+    check_items(["f"])
+
+    add({Skill.AGITATOR: 2, Skill.CRITICAL_EYE: 1}, {}, "g") # Beaten by "f", which evicted "a".
+    add({Skill.AGITATOR: 1}, {tt: 2}, "h")
+    check_items(["f", "h"])
+
+    # Forgetting beaten combinations shouldn't change anything.
+    seen_set = SeenSetBySSB(packer, max_beaten=1)
+    add({Skill.AGITATOR: 2, Skill.CRITICAL_EYE: 1}, {}, "a")
+    add({Skill.AGITATOR: 1}, {}, "b") # Beaten by "a".
+    add({Skill.CRITICAL_EYE: 1}, {}, "c") # Also beaten by "a", and we forget "b".
+    add({Skill.AGITATOR: 1}, {}, "d") # Equal to "b", and still beaten by "a".
+    check_items(["a"])
+
+    return True
+
+
+def _run_tests_stage3_engines():
+    logger.info("")
+
+    skill_subset = {Skill.AGITATOR, Skill.CRITICAL_BOOST, Skill.CRITICAL_EYE, Skill.FOCUS, Skill.WEAKNESS_EXPLOIT}
+    minimum_set_bonus_combos = calculate_possible_set_bonus_combos({Skill.FROSTCRAFT})
+    set_bonus_subset = {x for set_bonus_combo in minimum_set_bonus_combos for x in set_bonus_combo}
+    relaxed_minimum_set_bonus_combos = relax_set_bonus_combos(minimum_set_bonus_combos)
+
+    skills_packer = SkillsPacker(skill_subset)
+    armour = prune_easyiterate_armour_db(Tier.MASTER_RANK, easyiterate_armour, skill_subset=skill_subset)
+    decos = sorted(get_pruned_deco_set(skill_subset), key=lambda x : x.value.slot_size, reverse=True)
+    packed_decos = [None] * len(decoration_skills)
+    for deco in decos:
+        packed_decos[deco.id] = skills_packer.pack(deco.value.skills_dict)
+    deco_additions = DecoAdditionsCache([[x for x in decos if (x.value.slot_size <= size)] for size in range(1, 5)])
+
+    piece_combos = {}
+    for slot in ArmourSlot:
+        piece_combos[slot] = _generate_slot_combinations(armour[slot], deco_additions, packed_decos, skills_packer, \
+                                                            set_bonus_subset, progress_msg_slot=slot.name)
+    slot_order = list(ArmourSlot)
+
+    def charm_collection():
+        return CombinationColumns(skills_packer, 1, (([charm], Counter(), \
+                                                        skills_packer.pack(calculate_skills_dict_from_charm(charm, charm.max_level)), \
+                                                        {}) for charm in get_charms_subset(skill_subset)))
+
+    def add_slots_one_at_a_time(max_beaten=None):
+        c = charm_collection()
+        seen_set = SeenSetBySSB(skills_packer, max_beaten=max_beaten)
+        for (i, slot) in enumerate(slot_order):
+            c = _add_armour_slot(c, piece_combos[slot], skills_packer, relaxed_minimum_set_bonus_combos, \
+                                    len(slot_order) - i, seen_set=seen_set, progress_msg_slot=slot.name)
+        return c
+
+    def meet_in_the_middle(max_beaten=None):
+        return _combine_armour_meet_in_the_middle(charm_collection(), piece_combos, slot_order, skills_packer, \
+                                                    relaxed_minimum_set_bonus_combos, {x: 0 for x in slot_order}, \
+                                                    {x: (x.name, x.name) for x in slot_order}, num_worker_processes=1, \
+                                                    efr_ceiling=None, efr_lower_bound=None, deadline=None, \
+                                                    max_beaten=max_beaten)
+
+    # Both engines only throw away combinations beaten by others, so they should end with the same skills and set
+    # bonuses, even if they pick different pieces to get them.
+    def summarize(collection):
+        return sorted((collection.get_packed_skills(i), collection.get_set_bonuses_tuple(i)) for i in range(len(collection)))
+
+    def describe(packed_skills, sbc_h):
+        skills_str = ", ".join(f"{k.name}: {v}" for (k, v) in skills_packer.unpack(packed_skills).items())
+        set_bonuses_str = ", ".join(f"{k.name}: {v}" for (k, v) in sbc_h)
+        return f"skills {{{skills_str}}} with set bonuses {{{set_bonuses_str}}}"
+
+    expected = summarize(add_slots_one_at_a_time())
+
+    def check(result, engine_description):
+        if result == expected:
+            return
+        missing = [describe(*x) for x in expected if (x not in result)]
+        extra = [describe(*x) for x in result if (x not in expected)]
+        raise ValueError(f"Test failed. {engine_description} gave {len(result)} combinations, but adding one armour " \
+                         f"slot at a time gave {len(expected)}. Missing: {missing[:3]}. Extra: {extra[:3]}.")
+
+    check(summarize(meet_in_the_middle()), "Meet-in-the-middle")
+
+    # Forgetting beaten combinations (see SeenSetBySSB) only means we might check some of them again, so it shouldn't
+    # change what either engine ends with.
+    check(summarize(add_slots_one_at_a_time(max_beaten=1)), "Adding one armour slot at a time with max_beaten=1")
+    check(summarize(meet_in_the_middle(max_beaten=1)), "Meet-in-the-middle with max_beaten=1")
+
+    return True
+
+
+def _run_tests_weapon_repruning():
+    logger.info("")
+
+    # Only the ceiling EFRs (the last element of each tuple) matter here.
+    def group(name, ceiling_efrs):
+        return (name, [(name, None, None, None, x) for x in ceiling_efrs])
+
+    groups = [group("a", [300.0, 250.0, 250.0, 200.0]), group("b", [260.0, 250.0]), group("c", [240.0])]
+
+    def check(expected, **kwargs):
+        result = [(name, [x[4] for x in combo_list]) for (name, combo_list) in _reprune_weapon_combos(groups, **kwargs)]
+        if result != expected:
+            raise ValueError(f"Test failed. Got {result}.")
+
+    check([("a", [300.0, 250.0, 250.0, 200.0]), ("b", [260.0, 250.0]), ("c", [240.0])], minimum_efr_noninclusive=100.0)
+    check([("a", [300.0, 250.0, 250.0]), ("b", [260.0, 250.0])], minimum_efr_noninclusive=240.0)
+    check([("a", [300.0]), ("b", [260.0])], minimum_efr_noninclusive=250.0)
+    check([("a", [300.0, 250.0, 250.0]), ("b", [260.0, 250.0])], minimum_efr_inclusive=250.0)
+    check([], minimum_efr_noninclusive=300.0)
+
+    return True
+
+
+def _run_tests_top_builds_distinct():
+    logger.info("")
+
+    skill_subset = {Skill.AGITATOR, Skill.CRITICAL_EYE, Skill.FOCUS, Skill.WEAKNESS_EXPLOIT}
+    skill_states = {Skill.AGITATOR: 1, Skill.WEAKNESS_EXPLOIT: 2}
+    required_set_bonus_skills = {Skill.FROSTCRAFT}
+    set_bonus_subset = {x for set_bonus_combo in calculate_possible_set_bonus_combos(required_set_bonus_skills) \
+                                for x in set_bonus_combo}
+    skills_packer = SkillsPacker(skill_subset)
+
+    # We only need one weapon combination. (Safi's Shattersplitter has a single size-4 slot.)
+    weapon = weapon_db["SAFI_SHATTERSPLITTER"]
+    augments_tracker = WeaponAugmentTracker.get_instance(weapon)
+    augments_tracker.update_with_serialized_config(json.dumps({"rarity": 12, "aug_level": 3, \
+                                                               "augments": {"AFFINITY_INCREASE": 1}}))
+    upgrades_tracker = WeaponUpgradeTracker.get_instance(weapon)
+    upgrades_tracker.update_with_serialized_config(json.dumps([["ATTACK", 6]] + ([["ATTACK", 5]] * 4)))
+    combination_values = calculate_final_weapon_values(weapon, augments_tracker, upgrades_tracker)
+    ceiling_efr = lookup_from_skills(weapon, {x: x.value.extended_limit for x in skill_subset}, skill_states, \
+                                        augments_tracker, upgrades_tracker).efr
+    group_identification = (None, tuple(sorted(combination_values.slots, reverse=True)))
+    grouped_weapon_combos = [(group_identification, \
+                                [(weapon, augments_tracker, upgrades_tracker, combination_values, ceiling_efr)])]
+
+    decos = sorted(get_pruned_deco_set(skill_subset), key=lambda x : x.value.slot_size, reverse=True)
+    decos = [[x for x in decos if (x.value.slot_size <= size)] for size in range(1, 5)]
+    packed_decos = [None] * len(decoration_skills)
+    for deco in decos[-1]:
+        packed_decos[deco.id] = skills_packer.pack(deco.value.skills_dict)
+
+    ctx = _WeaponCombiningContext(
+            skills_packer              = skills_packer,
+            set_bonus_subset           = set_bonus_subset,
+            required_set_bonus_skills  = required_set_bonus_skills,
+            skills_with_minimum_levels = {},
+            packed_minimum_skills      = skills_packer.pack({}),
+            skill_states               = skill_states,
+            deco_additions             = DecoAdditionsCache(decos),
+            packed_decos               = packed_decos,
+            num_weapon_combos          = 1,
+            top_k                      = 5,
+            efr_ceiling                = EFRCeiling(grouped_weapon_combos, skills_packer, set_bonus_subset, skill_states, \
+                                                        decos),
+            group_lookups              = None,
+        )
+
+    velkhana = armour_db[("Velkhana", ArmourDiscriminator.MASTER_RANK)].variants[ArmourVariant.MR_BETA_PLUS]
+    armour_dict = {x: velkhana[x] for x in ArmourSlot}
+    armour_contribution = calculate_armour_contribution(armour_dict)
+    charm = charms_db["CHALLENGER_CHARM"]
+
+    def combination(deco_counter):
+        skills = Counter(armour_contribution.skills)
+        skills.update(calculate_skills_dict_from_charm(charm, charm.max_level))
+        skills.update(calculate_decorations_skills_contribution(deco_counter))
+        return ([charm] + [armour_dict[x] for x in ArmourSlot], Counter(deco_counter), skills_packer.pack(skills), \
+                    dict(armour_contribution.set_bonuses))
+
+    # These two combinations only differ in which of them has the Tenderizer Jewel in its armour, so they turn into the
+    # same builds once the weapon's slot gets the other decoration.
+    c = CombinationColumns(skills_packer, 6, [combination({Decoration.EXPERT_X2: 1}), \
+                                              combination({Decoration.TENDERIZER: 1})])
+
+    def check(top_builds, engine_description):
+        # We compare the parsed JSON so that the order decorations are listed in doesn't matter.
+        builds_data = [json.loads(build.serialize()) for (_, build) in top_builds]
+        for (i, build_data) in enumerate(builds_data):
+            if build_data in builds_data[:i]:
+                raise ValueError(f"Test failed. {engine_description} returned the same build more than once: " \
+                                 f"{json.dumps(build_data)}")
+        if len(top_builds) != ctx.top_k:
+            raise ValueError(f"Test failed. Expected {engine_description} to return {ctx.top_k} builds. " \
+                             f"Got {len(top_builds)}.")
+
+    check(_combine_weapons(c, grouped_weapon_combos, ctx)[0], "_combine_weapons()")
+    check(_combine_weapons_parallel(c, grouped_weapon_combos, ctx, 2)[0], "_combine_weapons_parallel()")
+
+    return True
+
+
+def _run_tests_search_parameters_validation():
+    logger.info("")
+
+    def get_error(**kwargs):
+        data = {
+                "selected_armour_tier": "MASTER_RANK",
+                "selected_weapon_class": "GREATSWORD",
+                "selected_skills": {"AGITATOR": 0, "FOCUS": 3},
+                "selected_set_bonus_skills": [],
+                "min_health_regen_augment_level": 0,
+                "skill_states": {"AGITATOR": 1},
+            }
+        data.update(kwargs)
+        try:
+            readjson_search_parameters(json.dumps(data))
+        except ValueError as e:
+            return str(e)
+        return None
+
+    error = get_error()
+    if error is not None:
+        raise ValueError(f"Test failed. Valid search parameters were rejected: {error}")
+
+    # JSON booleans are ints in Python, so they need to be rejected separately.
+    for (option, valid_value) in [("num_worker_processes", 2), ("top_k", 3)]:
+        error = get_error(**{option: valid_value})
+        if error is not None:
+            raise ValueError(f"Test failed. Setting {option} to {valid_value} was rejected: {error}")
+        if get_error(**{option: True}) is None:
+            raise ValueError(f"Test failed. Setting {option} to true was accepted.")
+
+    return True
+
+
+def _run_tests_search_result_cache_key():
+    logger.info("")
+
+    def get_search_parameters(**kwargs):
+        data = {
+                "selected_armour_tier": "MASTER_RANK",
+                "selected_weapon_class": "GREATSWORD",
+                "selected_skills": {"AGITATOR": 0, "FOCUS": 3, "WEAKNESS_EXPLOIT": 1},
+                "selected_set_bonus_skills": ["FROSTCRAFT", "MASTERS_TOUCH"],
+                "min_health_regen_augment_level": 1,
+                "skill_states": {"AGITATOR": 1, "WEAKNESS_EXPLOIT": 2},
+            }
+        data.update(kwargs)
+        return readjson_search_parameters(json.dumps(data))
+
+    def key(**kwargs):
+        return _get_search_result_cache_key(get_search_parameters(**kwargs))
+
+    original = key()
+
+    # Options that don't change the result shouldn't change the key.
+    same_result_options = [
+            {"num_worker_processes": 4},
+            {"checkpoint_filename": "x.ckpt"},
+            {"result_cache_directory": "cache"},
+            {"meet_in_the_middle": True},
+            {"stage3_cache_budget_mb": 64},
+        ]
+    for options in same_result_options:
+        if key(**options) != original:
+            raise ValueError(f"Test failed. Setting {options} changed the search result cache key.")
+    # Neither should the order of anything.
+    if key(selected_skills={"WEAKNESS_EXPLOIT": 1, "FOCUS": 3, "AGITATOR": 0},
+           selected_set_bonus_skills=["MASTERS_TOUCH", "FROSTCRAFT"]) != original:
+        raise ValueError("Test failed. Reordering the selected skills changed the search result cache key.")
+
+    if key(selected_skills={"AGITATOR": 0, "FOCUS": 3, "WEAKNESS_EXPLOIT": 2}) == original:
+        raise ValueError("Test failed. Changing a skill minimum didn't change the search result cache key.")
+    if key(top_k=2) == original:
+        raise ValueError("Test failed. Changing top_k didn't change the search result cache key.")
+
+    with tempfile.TemporaryDirectory() as directory:
+        result_cache = SearchResultCache(directory, get_search_parameters())
+        if result_cache.load() is not None:
+            raise ValueError("Test failed. An empty search result cache gave us builds.")
+        result_cache.save([])
+        if result_cache.load() != []:
+            raise ValueError("Test failed. A search with no builds didn't come back from the search result cache.")
+
+        # A truncated file should just be a cache miss.
+        with open(result_cache.filename, encoding="utf-8") as f:
+            data = f.read()
+        with open(result_cache.filename, encoding="utf-8", mode="w") as f:
+            f.write(data[:(len(data) // 2)])
+        if result_cache.load() is not None:
+            raise ValueError("Test failed. A truncated search result cache file gave us builds.")
+
+    return True
+
+
+def _run_tests_warm_start_build():
+    logger.info("")
+
+    search_parameters = {
+            "selected_armour_tier": "MASTER_RANK",
+            "selected_weapon_class": "GREATSWORD",
+            "selected_skills": {"AGITATOR": 0, "FOCUS": 3, "NON_ELEMENTAL_BOOST": 0, "WEAKNESS_EXPLOIT": 1},
+            "selected_set_bonus_skills": ["FROSTCRAFT"],
+            "min_health_regen_augment_level": 1,
+            "skill_states": {"AGITATOR": 1, "WEAKNESS_EXPLOIT": 2},
+        }
+
+    build_data = {
+            "armour": {
+                "HEAD":  ["Velkhana",    "MASTER_RANK", "MR_BETA_PLUS"],
+                "CHEST": ["Velkhana",    "MASTER_RANK", "MR_BETA_PLUS"],
+                "ARMS":  ["Velkhana",    "MASTER_RANK", "MR_BETA_PLUS"],
+                "WAIST": ["Velkhana",    "MASTER_RANK", "MR_BETA_PLUS"],
+                "LEGS":  ["Yian Garuga", "MASTER_RANK", "MR_BETA_PLUS"],
+            },
+            "charm": "CHALLENGER_CHARM",
+            "weapon": "SAFI_SHATTERSPLITTER",
+            "weapon_augments": json.dumps({"rarity": 12, "aug_level": 3, \
+                                           "augments": {"AFFINITY_INCREASE": 1, "HEALTH_REGEN": 1}}),
+            "weapon_upgrades": json.dumps([["ATTACK", 6], ["ATTACK", 5], ["ATTACK", 5], ["ATTACK", 5], ["ATTACK", 5]]),
+            "decorations": {"CHARGER": 3, "CHALLENGER_X2": 1, "ELEMENTLESS": 1, "TENDERIZER": 3},
+        }
+
+    # Returns the error message, or None if the build was accepted.
+    def load(build_data, **search_parameters_changes):
+        return load_with_result(build_data, **search_parameters_changes)[0]
+
+    # Returns a tuple of (error message, result of _load_warm_start_build()). Only one of them is None.
+    def load_with_result(build_data, **search_parameters_changes):
+        s = readjson_search_parameters(json.dumps({**search_parameters, **search_parameters_changes}))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "warm_start_build.json")
+            with open(filename, mode="w") as f:
+                f.write(json.dumps(build_data))
+            try:
+                return (None, _load_warm_start_build(filename, s))
+            except ValueError as e:
+                return (str(e), None)
+
+    (error, result) = load_with_result(build_data)
+    if error is not None:
+        raise ValueError(f"Test failed. A build that meets the search parameters was rejected: {error}")
+
+    # The search should start from exactly the build we gave it, with the EFR the search itself would give it (i.e.
+    # only counting the skills we're searching for).
+    (efr, build) = result
+    if json.loads(build.serialize()) != build_data:
+        raise ValueError(f"Test failed. The warm start build changed when it was loaded. Got: {build.serialize()}")
+    s = readjson_search_parameters(json.dumps(search_parameters))
+    skill_subset = set(s.selected_skills) | s.selected_set_bonus_skills
+    expected_efr = build.calculate_performance(s.skill_states, skill_subset).efr
+    if efr != expected_efr:
+        raise ValueError(f"Test failed. Expected the warm start build to have {expected_efr} EFR. Got {efr}.")
+
+    no_health_regen = {**build_data, "weapon_augments": json.dumps({"rarity": 12, "aug_level": 3, \
+                                                                    "augments": {"AFFINITY_INCREASE": 1}})}
+    error = load(no_health_regen)
+    if (error is None) or ("Health Regen" not in error):
+        raise ValueError(f"Test failed. A build without the minimum Health Regen augment wasn't rejected. Got: {error}")
+    error = load(no_health_regen, min_health_regen_augment_level=0)
+    if error is not None:
+        raise ValueError(f"Test failed. A build was rejected when no Health Regen augment was needed: {error}")
+
+    error = load(build_data, selected_armour_tier="HIGH_RANK")
+    if (error is None) or ("armour tier" not in error):
+        raise ValueError(f"Test failed. A build with armour of the wrong tier wasn't rejected. Got: {error}")
+    error = load(build_data, selected_armour_tier=None)
+    if error is not None:
+        raise ValueError(f"Test failed. A build was rejected when no armour tier was selected: {error}")
+
+    # Stage 4 scores builds on every skill that the set bonuses it tracks can give, so a full Safi'jiiva set should
+    # get True Dragonvein Awakening counted even though we only asked for Dragonvein Awakening.
+    safi_search_parameters_changes = {
+            "selected_skills": {"AGITATOR": 0, "CRITICAL_BOOST": 0},
+            "selected_set_bonus_skills": ["DRAGONVEIN_AWAKENING"],
+            "skill_states": {"AGITATOR": 1, "DRAGONVEIN_AWAKENING": 1, "TRUE_DRAGONVEIN_AWAKENING": 1},
+        }
+    safi_build_data = {
+            **build_data,
+            "armour": {x.name: ["Safi'jiiva", "MASTER_RANK", "MR_BETA_PLUS"] for x in ArmourSlot},
+            "decorations": {"CHALLENGER_X2": 1},
+        }
+    (error, result) = load_with_result(safi_build_data, **safi_search_parameters_changes)
+    if error is not None:
+        raise ValueError(f"Test failed. A full Safi'jiiva build was rejected: {error}")
+    (efr, build) = result
+    s = readjson_search_parameters(json.dumps({**search_parameters, **safi_search_parameters_changes}))
+    expected_efr = build.calculate_performance(s.skill_states, set(s.selected_skills) | \
+                                                {Skill.DRAGONVEIN_AWAKENING, Skill.TRUE_DRAGONVEIN_AWAKENING}).efr
+    efr_without_true_dragonvein = build.calculate_performance(s.skill_states, set(s.selected_skills) | \
+                                                                {Skill.DRAGONVEIN_AWAKENING}).efr
+    if efr != expected_efr:
+        raise ValueError(f"Test failed. Expected a full Safi'jiiva warm start build to have {expected_efr} EFR " \
+                         f"(counting True Dragonvein Awakening). Got {efr}. (Without True Dragonvein Awakening, " \
+                         f"it would have {efr_without_true_dragonvein} EFR.)")
+
+    return True
+
+
+def _run_tests_weapon_db():
+    logger.info("")
+
+    db = WeaponDatabase()
+
+    if db["ROYAL_VENUS_BLADE"].type is not WeaponClass.GREATSWORD:
+        raise ValueError("Test failed. ROYAL_VENUS_BLADE wasn't loaded as a greatsword.")
+
+    for weapon_class in WeaponClass:
+        weapons = db.get_weapons_of_class(weapon_class)
+        if any((weapon.type is not weapon_class) or (weapon_id != weapon.id) for (weapon_id, weapon) in weapons.items()):
+            raise ValueError(f"Test failed. Got a weapon of the wrong class for {weapon_class.name}.")
+
+    # Looking weapons up by ID should give us the exact same weapons in the same order, however they're loaded.
+    if list(db) != list(weapon_db):
+        raise ValueError("Test failed. The weapon IDs aren't in the same order as in the global weapon database.")
+    for (weapon_id, weapon) in weapon_db.items():
+        if db[weapon_id] != weapon:
+            raise ValueError(f"Test failed. {weapon_id} doesn't match the global weapon database.")
+    if sum(len(db.get_weapons_of_class(x)) for x in WeaponClass) != len(db):
+        raise ValueError("Test failed. The weapon classes don't add up to the whole weapon database.")
+
+    # Weapon names must be unique across all weapon classes, not just within one.
+    json_data = json_read(WEAPONS_DATA_FILENAME)
+    greatsword = next(v for v in json_data.values() if v["class"] == "GREATSWORD")
+    json_data["TEST_LONGSWORD"] = dict(greatsword, **{"class": "LONGSWORD"})
+    try:
+        _obtain_weapon_class_index(json_data)
+        raise ValueError("Test failed. A longsword with the same name as a greatsword was accepted.")
+    except ValueError as e:
+        if "Weapon names must be unique." not in str(e):
+            raise
+
+    return True
+
+
+def _run_tests_database_ids():
+    logger.info("")
+
+    for enum_class in [Skill, SetBonus, Decoration]:
+        if [x.id for x in enum_class] != list(range(len(enum_class))):
+            raise ValueError(f"Test failed. {enum_class.__name__} IDs aren't dense.")
+
+    if len(skill_extended_limits) != len(Skill):
+        raise ValueError(f"Test failed. Expected {len(Skill)} skill extended limits. Got {len(skill_extended_limits)}.")
+    for skill in Skill:
+        if skill_extended_limits[skill.id] != skill.value.extended_limit:
+            raise ValueError(f"Test failed. Wrong extended limit for {skill.name}. Expected " \
+                             f"{skill.value.extended_limit}. Got {skill_extended_limits[skill.id]}.")
+
+    for set_bonus in SetBonus:
+        if dict(set_bonus_stages[set_bonus.id]) != set_bonus.value.stages:
+            raise ValueError(f"Test failed. Wrong stages for {set_bonus.name}.")
+
+    for deco in Decoration:
+        if (decoration_slot_sizes[deco.id] != deco.value.slot_size) \
+                or (dict(decoration_skills[deco.id]) != deco.value.skills_dict):
+            raise ValueError(f"Test failed. Wrong slot size or skills for {deco.name}.")
+
+    return True
+
 
 if __name__ == '__main__':
     run_tests()
     sys.exit(0)
-
@@ -42,12 +42,11 @@ def json_dumps_formatted(data):
     return json.dumps(data, sort_keys=True, indent=4)
 
 
-# Also will probably be useful, e.g. when I implement caching.
-#def json_write(relfilepath, *, data=None):
-#    mkdir_recursive(relfilepath)
-#    with open(relfilepath, encoding=ENCODING, mode="w") as f:
-#        f.write(json.dumps(data, sort_keys=True, indent=4))
-#    return
+def json_write(relfilepath, *, data=None):
+    ensure_directory(relfilepath)
+    with open(relfilepath, encoding=ENCODING, mode="w") as f:
+        f.write(json_dumps_formatted(data))
+    return
 
 
 # Recipe from Python 3.8 Itertools documentation.
@@ -105,13 +104,18 @@ def all_unique(iterable_obj):
 #   does not actually supercede the right argument, then the behaviour of this function
 #   is undefined and invalid.
 #
-def prune_by_superceding(iterable, left_supercedes_right, execute_per_iteration=lambda : None):
+#   If should_stop is provided, it gets called before every element is checked. If it ever
+#   returns True, we stop and return None.
+#
+def prune_by_superceding(iterable, left_supercedes_right, execute_per_iteration=lambda : None, should_stop=None):
     assert callable(left_supercedes_right)
 
     ret = []
 
     li = list(iterable)
     for i, right in enumerate(li):
+        if (should_stop is not None) and should_stop():
+            return None
         right_is_never_superceded = True
         for j, left in enumerate(li):
             if i == j: